@@ -20,15 +20,28 @@
 
 try:
     from http.server import BaseHTTPRequestHandler, HTTPServer
-    from socketserver import ThreadingMixIn
+    from socketserver import ThreadingMixIn, TCPServer
 except ImportError:
     from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-    from SocketServer import ThreadingMixIn
+    from SocketServer import ThreadingMixIn, TCPServer
+from collections import namedtuple, OrderedDict
+import hashlib
+import json
 import logging
 import os
 import socket
 from threading import Thread
 
+if __name__ == "__main__":
+    from twisted.internet import gtk3reactor
+    gtk3reactor.install()
+from twisted.internet import reactor
+from twisted.internet.error import CannotListenError
+from twisted.protocols.policies import WrappingFactory
+from twisted.web import http
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
 # This is probably really bad...  But doing relative imports only
 # works for modules.  However, I want to be able to call this Keyserver.py
 # for testing purposes.
@@ -48,14 +61,92 @@ from .__init__ import __version__
 from .network.AvahiPublisher import AvahiPublisher
 
 from .gpgmh import fingerprint_from_keydata
+from .util import format_keys_txt
 
 log = logging.getLogger(__name__)
 
+def make_etag(keydata):
+    "Returns the quoted entity tag for the keydata"
+    return '"%s"' % hashlib.sha256(keydata).hexdigest()[:32]
+
+
+def etag_matches(if_none_match, etag):
+    "Whether the If-None-Match header value matches the entity tag"
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(',')]
+    # We may compare weakly for If-None-Match
+    tags = [t[2:] if t.startswith('W/') else t for t in tags]
+    return '*' in tags or etag in tags
+
+
+def parse_range(value, length):
+    """Returns the (first, last) byte positions of a Range header value
+
+    Only a single byte range is supported; None is returned
+    for anything else, which means that the Range is ignored.
+    ValueError is raised if the range cannot be satisfied.
+    """
+    unit, _, ranges = value.partition('=')
+    if unit.strip() != 'bytes' or ',' in ranges:
+        return None
+    first, sep, last = ranges.strip().partition('-')
+    try:
+        if not sep:
+            return None
+        elif not first:
+            # The last bytes, e.g. -500
+            first, last = max(0, length - int(last)), length - 1
+        else:
+            first = int(first)
+            last = min(int(last), length - 1) if last else length - 1
+    except ValueError:
+        return None
+    if first > last or first >= length:
+        raise ValueError("Cannot satisfy %r for %d bytes" % (value, length))
+    return first, last
+
+
+class PreparedResponse(namedtuple("PreparedResponse",
+        "keydata etag head response not_modified")):
+    """The complete responses for a keydata, rendered once
+
+    head is the status line and the headers of the full response,
+    which is head plus the body.  not_modified answers a matching
+    If-None-Match.
+    """
+    @staticmethod
+    def render_head(protocol_version, status, headers):
+        lines = ['%s %s' % (protocol_version, status)]
+        lines += ['%s: %s' % header for header in headers]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    @classmethod
+    def from_keydata(cls, keydata, protocol_version, server_version, ctype):
+        etag = make_etag(keydata)
+        headers = [
+            ('Server', server_version),
+            ('ETag', etag),
+            ('Accept-Ranges', 'bytes'),
+        ]
+        head = cls.render_head(protocol_version, '200 OK', headers + [
+            ('Content-Type', ctype),
+            ('Content-Length', len(keydata)),
+        ])
+        not_modified = cls.render_head(protocol_version, '304 Not Modified',
+                                       headers)
+        return cls(keydata, etag, head, head + keydata, not_modified)
+
+
 class KeyRequestHandlerBase(BaseHTTPRequestHandler):
     '''This is the "base class" which needs to be given access
     to the key to be served. So you will not use this class,
     but create a use one inheriting from this class. The subclass
     must also define a keydata field.
+
+    The responses are rendered once per keydata and sent with a
+    single sendall.  HEAD, If-None-Match and single byte Ranges
+    are supported.
     '''
     server_version = 'GNOME-Keysign/' + '%s' % __version__
 
@@ -63,9 +154,56 @@ class KeyRequestHandlerBase(BaseHTTPRequestHandler):
     # https://tools.ietf.org/html/rfc2015#section-7
     ctype = 'application/pgp-keys'
 
+    # Set by get_prepared on the class serving the keydata
+    prepared = None
+
+    def get_prepared(self):
+        prepared = self.prepared
+        if prepared is None or prepared.keydata is not self.keydata:
+            prepared = PreparedResponse.from_keydata(self.keydata,
+                self.protocol_version, self.server_version, self.ctype)
+            type(self).prepared = prepared
+        return prepared
+
     def do_GET(self):
-        f = self.send_head(self.keydata)
-        self.wfile.write(self.keydata)
+        self.send_prepared()
+
+    def do_HEAD(self):
+        self.send_prepared(body=False)
+
+    def send_prepared(self, body=True):
+        prepared = self.get_prepared()
+        if etag_matches(self.headers.get('If-None-Match'), prepared.etag):
+            data = prepared.not_modified
+        elif not body:
+            data = prepared.head
+        elif self.headers.get('Range'):
+            data = self.render_range(prepared, self.headers.get('Range'))
+        else:
+            data = prepared.response
+        self.connection.sendall(data)
+
+    def render_range(self, prepared, value):
+        keydata = prepared.keydata
+        length = len(keydata)
+        headers = [('Server', self.server_version), ('ETag', prepared.etag)]
+        try:
+            byte_range = parse_range(value, length)
+        except ValueError:
+            return PreparedResponse.render_head(self.protocol_version,
+                '416 Range Not Satisfiable', headers + [
+                    ('Content-Range', 'bytes */%d' % length),
+                    ('Content-Length', 0),
+                ])
+        if byte_range is None:
+            return prepared.response
+        first, last = byte_range
+        return PreparedResponse.render_head(self.protocol_version,
+            '206 Partial Content', headers + [
+                ('Content-Type', self.ctype),
+                ('Content-Range', 'bytes %d-%d/%d' % (first, last, length)),
+                ('Content-Length', last - first + 1),
+            ]) + keydata[first:last + 1]
 
     def send_head(self, keydata=None):
         kd = keydata if keydata else self.keydata
@@ -78,37 +216,295 @@ class KeyRequestHandlerBase(BaseHTTPRequestHandler):
 class ThreadedKeyserver(ThreadingMixIn, HTTPServer):
     '''The keyserver in a threaded fashion'''
     address_family = socket.AF_INET6
-
-    def __init__(self, server_address, *args, **kwargs):
-        if issubclass(self.__class__, object):
-            super(ThreadedKeyserver, self).__init__(server_address, *args, **kwargs)
-        else:
-            HTTPServer.__init__(self, server_address, *args, **kwargs)
-            # WTF? There is no __init__..?
-            # ThreadingMixIn.__init__(self, server_address, *args, **kwargs)
-
-        def server_bind(self):
-            # Override this method to be sure v6only is false: we want to
-            # listen to both IPv4 and IPv6!
-            self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, False)
-            HTTPServer.server_bind(self)
-
+    # The connection threads must not keep the program alive
+    daemon_threads = True
+
+    def server_bind(self):
+        # Override this method to be sure v6only is false: we want to
+        # listen to both IPv4 and IPv6!
+        self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, False)
+        # HTTPServer.server_bind looks up our FQDN, which may take
+        # long and which we do not need.
+        TCPServer.server_bind(self)
+        host, port = self.server_address[:2]
+        self.server_name = host
+        self.server_port = port
+
+
+def candidate_ports(port, tries):
+    """Returns the ports to try binding to
+
+    Port 0 lets the kernel pick a free port, so there is
+    only one to try.  Otherwise, we try tries ports from port.
+    """
+    if not port:
+        return [0]
+    return range(port, port + tries)
+
+
+class KeyResource(Resource):
+    """Serves the keys by their fingerprint
+
+    /keys/<fpr> has the key with that fingerprint and /keys/
+    lists the fingerprints of all keys as JSON.  / has the key
+    if there is only one, because that is where older clients
+    look for it, and the list otherwise.
+    """
+    isLeaf = True
+    ctype = KeyRequestHandlerBase.ctype
+
+    def __init__(self, keys=None):
+        Resource.__init__(self)
+        # Maps the upper case fingerprint to the keydata
+        self.keys = OrderedDict() if keys is None else keys
+        # Maps id(keydata) to (keydata, etag, headers)
+        self._prepared = {}
+
+    def get_prepared(self, keydata):
+        "Returns the entity tag and the headers for keydata, computed once"
+        prepared = self._prepared.get(id(keydata))
+        if prepared is None or prepared[0] is not keydata:
+            if len(self._prepared) >= len(self.keys):
+                # Forget the keys which are not served anymore
+                served = set(id(k) for k in self.keys.values())
+                for key in list(self._prepared):
+                    if key not in served:
+                        del self._prepared[key]
+            etag = make_etag(keydata).encode('ascii')
+            headers = [
+                (b'Content-Type', self.ctype.encode('ascii')),
+                (b'Accept-Ranges', b'bytes'),
+            ]
+            prepared = (keydata, etag, headers)
+            self._prepared[id(keydata)] = prepared
+        return prepared[1:]
+
+    def render_GET(self, request):
+        request.setHeader(b'Server',
+            KeyRequestHandlerBase.server_version.encode('ascii'))
+        path = [p for p in request.postpath if p]
+        if not path and len(self.keys) == 1:
+            return self.render_key(request, next(iter(self.keys.values())))
+        elif path in ([], [b'keys']):
+            return self.render_index(request)
+        elif len(path) == 2 and path[0] == b'keys':
+            fpr = path[1].decode('ascii', 'replace').upper()
+            keydata = self.keys.get(fpr)
+            if keydata is not None:
+                return self.render_key(request, keydata)
+        request.setResponseCode(404)
+        return b''
+
+    def render_key(self, request, keydata):
+        etag, headers = self.get_prepared(keydata)
+        for name, value in headers:
+            request.setHeader(name, value)
+        # Twisted answers HEAD requests by dropping the body
+        if request.setETag(etag) == http.CACHED:
+            return b''
+        value = request.getHeader(b'Range')
+        if value:
+            return self.render_range(request, keydata,
+                                     value.decode('latin-1'))
+        return keydata
+
+    def render_range(self, request, keydata, value):
+        length = len(keydata)
+        try:
+            byte_range = parse_range(value, length)
+        except ValueError:
+            request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            request.setHeader(b'Content-Range',
+                              ('bytes */%d' % length).encode('ascii'))
+            return b''
+        if byte_range is None:
+            return keydata
+        first, last = byte_range
+        request.setResponseCode(http.PARTIAL_CONTENT)
+        request.setHeader(b'Content-Range', ('bytes %d-%d/%d' %
+                          (first, last, length)).encode('ascii'))
+        return keydata[first:last + 1]
+
+    def render_index(self, request):
+        request.setHeader(b'Content-Type', b'application/json')
+        return json.dumps({'keys': list(self.keys)}).encode('utf-8')
+
+
+class ConnectionLimitingFactory(WrappingFactory):
+    """Refuses connections beyond max_connections and keeps track
+    of the open ones so that they can be dropped on shutdown.
+    """
+    def __init__(self, wrappedFactory, max_connections=64):
+        WrappingFactory.__init__(self, wrappedFactory)
+        self.max_connections = max_connections
+        self.refused = 0
+
+    def buildProtocol(self, addr):
+        if len(self.protocols) >= self.max_connections:
+            self.refused += 1
+            log.warning("Refusing connection from %s: %d connections open",
+                        addr, len(self.protocols))
+            return None
+        return WrappingFactory.buildProtocol(self, addr)
+
+    def abort_connections(self):
+        for protocol in list(self.protocols):
+            protocol.transport.abortConnection()
+
+
+class KeyServer(object):
+    """Serves keys over HTTP from the reactor and announces them via Avahi
+
+    The sockets are handled by the (gtk3)reactor, so no threads are
+    involved.  HTTP/1.1 connections are kept alive until they have
+    been idle for timeout seconds.  At most max_connections are
+    accepted at once.  Call start() to serve and stop() to
+    close the listening socket and drop all open connections.
+
+    Keys can be added and removed while serving.  All keys
+    share the one listener and Avahi service, the TXT record of
+    which advertises the key IDs of the served keys.
+    """
+    def __init__(self, keydata=None, fpr=None, port=0, tries=10,
+                 max_connections=64, timeout=30, publish=True):
+        self.port = port
+        self.tries = tries
+        self.publish = publish
+        self.keys = OrderedDict()
+        if keydata is not None:
+            self.add_key(keydata, fpr)
+        self.site = site = Site(KeyResource(self.keys), timeout=timeout)
+        self.factory = ConnectionLimitingFactory(site, max_connections)
+        self.listening_port = None
+        self.avahi_publisher = None
+
+    def add_key(self, keydata, fpr=None):
+        "Serves the keydata, replacing a key with the same fingerprint"
+        fpr = (fpr or fingerprint_from_keydata(keydata)).upper()
+        self.keys[fpr] = keydata
+        self.update_txt()
+        return fpr
+
+    def remove_key(self, fpr):
+        "Stops serving the key with the given fingerprint"
+        del self.keys[fpr.upper()]
+        self.update_txt()
+
+    def service_txt(self):
+        txt = {
+            'version': __version__,
+        }
+        txt.update(format_keys_txt(self.keys))
+        if len(self.keys) == 1:
+            # Older clients only know about this one
+            txt['fingerprint'] = next(iter(self.keys))
+        return txt
+
+    def update_txt(self):
+        if self.avahi_publisher:
+            self.avahi_publisher.update_txt(self.service_txt())
+
+    def listen(self):
+        "Listens on the first free port and returns its number"
+        for port_i in candidate_ports(self.port, self.tries):
+            try:
+                log.info('Trying port %d', port_i)
+                # "::" also accepts IPv4 connections
+                self.listening_port = reactor.listenTCP(
+                    port_i, self.factory, interface='::')
+            except CannotListenError as e:
+                log.info("Cannot listen on %d: %s", port_i, e)
+            else:
+                return self.listening_port.getHost().port
+        raise CannotListenError('::', self.port,
+            "None of the ports starting at %d is free" % self.port)
+
+    def start(self):
+        "Starts serving and publishing the keys and returns the port"
+        port = self.listen()
+        log.info('Serving now on %s', self.listening_port.getHost())
+        if self.publish:
+            service_txt = self.service_txt()
+            log.info('Requesting Avahi with txt: %s', service_txt)
+            name = 'HTTP Keyserver'
+            if self.keys:
+                name += ' %s' % next(iter(self.keys))
+            try:
+                self.avahi_publisher = AvahiPublisher(
+                    service_port=port,
+                    service_name=name,
+                    service_txt=service_txt,
+                    # The keydata is too big for Avahi; it crashes
+                    service_type='_gnome-keysign._tcp',
+                )
+                self.avahi_publisher.add_service()
+            except Exception:
+                # Nobody would find the port, so we do not keep it open
+                log.exception("Could not publish via Avahi")
+                self.avahi_publisher = None
+                self.listening_port.stopListening()
+                self.listening_port = None
+                raise
+        return port
+
+    def stop(self):
+        "Stops publishing and serving, dropping any open connection"
+        if self.avahi_publisher:
+            log.info("Removing Avahi Service")
+            self.avahi_publisher.remove_service()
+            self.avahi_publisher = None
+        if self.listening_port:
+            log.info("Shutting down %r", self.listening_port)
+            self.listening_port.stopListening()
+            self.listening_port = None
+        self.factory.abort_connections()
+
+    # For those that use a ServeKeyThread
+    shutdown = stop
 
 
 class ServeKeyThread(Thread):
     '''Serves requests and manages the server in separates threads.
     You can create an object and call start() to let it run.
     If you want to stop serving, call shutdown().
+
+    This is kept for those that do not run a Twisted reactor.
+    Use the KeyServer otherwise.
     '''
 
-    def __init__(self, data, fpr, port=9001, *args, **kwargs):
-        '''Initializes the server to serve the data'''
+    def __init__(self, data, fpr, port=0, tries=10, *args, **kwargs):
+        '''Initializes the server to serve the data
+
+        With port 0, any free port is used.  Otherwise, the
+        first free one of tries ports starting at port is used.
+        '''
         self.keydata = data
         self.fpr = fpr
         self.port = port
+        self.tries = tries
         super(ServeKeyThread, self).__init__(*args, **kwargs)
         self.daemon = True
         self.httpd = None
+        self.avahi_publisher = None
+
+
+    def bind(self, HandlerClass, port, **kwargs):
+        '''Binds the HTTPd to the first free port and returns it
+
+        socket.error is raised if none is free.
+        '''
+        error = None
+        for port_i in candidate_ports(port, self.tries):
+            try:
+                log.info('Trying port %d', port_i)
+                server_address = ('', port_i)
+                self.httpd = ThreadedKeyserver(server_address, HandlerClass, **kwargs)
+            except socket.error as e:
+                log.info("Cannot bind to %d: %s", port_i, e)
+                error = e
+            else:
+                return self.httpd.socket.getsockname()[1]
+        raise error
 
 
     def start(self, data=None, fpr=None, port=None, *args, **kwargs):
@@ -119,13 +515,14 @@ class ServeKeyThread(Thread):
         However, you probably need to start
         dbus.mainloop.glib.DBusGMainLoop (set_as_default=True)
         in order for this work.
+
+        The port is bound before the service is published via Avahi,
+        so we publish once, with the port that we actually have.
         '''
 
-        port = port or self.port or 9001
+        port = self.port if port is None else port
         fpr = fpr or self.fpr
 
-        tries = 10
-
         kd = data if data else self.keydata
 
         class KeyRequestHandler(KeyRequestHandlerBase):
@@ -133,45 +530,22 @@ class ServeKeyThread(Thread):
             keydata = kd
         HandlerClass = KeyRequestHandler
 
-        for port_i in (port + p for p in range(tries)):
-            try:
-                log.info('Trying port %d', port_i)
-                server_address = ('', port_i)
-                self.httpd = ThreadedKeyserver(server_address, HandlerClass, **kwargs)
-
-                ###
-                # This is a bit of a hack, it really should be
-                # in some lower layer, such as the place were
-                # the socket is created and listen()ed on.
-                service_txt = {
-                    'fingerprint': fpr,
-                    'version': __version__,
-                }
-
-
-                log.info('Requesting Avahi with txt: %s', service_txt)
-
-                self.avahi_publisher = ap = AvahiPublisher(
-                    service_port = port_i,
-                    service_name = 'HTTP Keyserver %s' % fpr,
-                    service_txt = service_txt,
-                    # self.keydata is too big for Avahi; it crashes
-                    service_type = '_gnome-keysign._tcp',
-                )
-                log.info('Trying to add Avahi Service')
-                ap.add_service()
-
-            except socket.error as value:
-                errno = value.errno
-                if errno == 10054 or errno == 32:
-                    # This seems to be harmless
-                    break
-            else:
-                break
-
-            finally:
-                pass
-
+        bound_port = self.bind(HandlerClass, port, **kwargs)
+
+        service_txt = {
+            'fingerprint': fpr,
+            'version': __version__,
+        }
+        log.info('Requesting Avahi with txt: %s', service_txt)
+        self.avahi_publisher = ap = AvahiPublisher(
+            service_port = bound_port,
+            service_name = 'HTTP Keyserver %s' % fpr,
+            service_txt = service_txt,
+            # self.keydata is too big for Avahi; it crashes
+            service_type = '_gnome-keysign._tcp',
+        )
+        log.info('Trying to add Avahi Service')
+        ap.add_service()
 
         super(ServeKeyThread, self).start(*args, **kwargs)
 
@@ -202,26 +576,19 @@ class ServeKeyThread(Thread):
     def shutdown(self):
         '''Sends shutdown to the underlying httpd'''
         log.info("Removing Avahi Service")
-        self.avahi_publisher.remove_service()
+        if self.avahi_publisher:
+            self.avahi_publisher.remove_service()
         log.info("Shutting down httpd %r", self.httpd)
         self.httpd.shutdown()
+        self.httpd.server_close()
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
-    import dbus, time
-    dbus.mainloop.glib.DBusGMainLoop (set_as_default=True)
-    def stop_thread(t, seconds=5):
-        log.info('Sleeping %d seconds, then stopping', seconds)
-        time.sleep(seconds)
-        t.shutdown()
-
     import sys
     if len(sys.argv) >= 2:
         fname = sys.argv[1]
         KEYDATA = open(fname, 'rb').read()
-        # FIXME: Someone needs to determine the fingerprint
-        #        of the data just read
         fpr = fingerprint_from_keydata(KEYDATA)
     else:
         KEYDATA = b'Example data'
@@ -232,16 +599,12 @@ if __name__ == '__main__':
     else:
         timeout = 5
 
-    t = ServeKeyThread(KEYDATA, fpr)
-    stop_t = Thread(target=stop_thread, args=(t,timeout))
-    stop_t.daemon = True
-    t.start()
-    stop_t.start()
-    while True:
-        log.info('joining stop %s', stop_t.isAlive())
-        stop_t.join(1)
-        log.info('joining t %s', t.isAlive())
-        t.join(1)
-        if not t.isAlive() or not stop_t.isAlive():
-            break
-    log.warn('Last line')
+    def stop():
+        server.stop()
+        reactor.stop()
+
+    server = KeyServer(KEYDATA, fpr)
+    server.start()
+    log.info('Serving for %d seconds, then stopping', timeout)
+    reactor.callLater(timeout, stop)
+    reactor.run()
@@ -16,33 +16,176 @@
 #    You should have received a copy of the GNU General Public License
 #    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import logging
+import multiprocessing
+from multiprocessing.util import Finalize
+import os
 import sys
+import time
 
-from .util import sign_keydata_and_send
+from .gpgmh import fingerprint_from_keydata
+from .gpgmh import sign_keydata_and_encrypt, SigningSession
+from .gpgmeh import temp_context_pool
+from .pgppackets import split_keys
+from .util import send_signed_uids
 
 if sys.version_info.major < 3:
     input = raw_input
 
+log = logging.getLogger(__name__)
+
+# Each worker process signs in its own session
+session = None
+
+
+def init_session(only_new_certifications=False):
+    "Sets up the SigningSession of the current process"
+    global session
+    session = SigningSession(
+        only_new_certifications=only_new_certifications)
+    # Run when the worker exits after the pool has been closed.
+    # Workers leave via os._exit, so atexit handlers do not run.
+    Finalize(session, session.close, exitpriority=10)
+    Finalize(temp_context_pool, temp_context_pool.close, exitpriority=5)
+
+
+def iter_keys(paths):
+    """Yields (source, keydata) for each key in the given files
+
+    Directories are searched for files, non-recursively.
+    A file may hold several keys.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            fnames = [os.path.join(path, f) for f in sorted(os.listdir(path))
+                      if not f.startswith('.')]
+            fnames = [f for f in fnames if os.path.isfile(f)]
+        else:
+            fnames = [path]
+
+        for fname in fnames:
+            with open(fname, 'rb') as f:
+                data = f.read()
+            try:
+                keys = split_keys(data)
+            except ValueError:
+                log.exception("Could not read keys from %s", fname)
+                # Leave it to GnuPG to deal with it
+                keys = [data]
+            for i, keydata in enumerate(keys):
+                source = fname if len(keys) == 1 else "%s:%d" % (fname, i)
+                yield source, keydata
+
+
+def sign(job):
+    """Signs the key of a (source, keydata) job in this process' session
+
+    Returns a (result, signed UIDs) tuple where result is
+    a dictionary for the summary.
+    """
+    source, keydata = job
+    result = {'source': source, 'fingerprint': None, 'uids': 0,
+              'ok': False, 'error': None, 'pid': os.getpid()}
+    signed_uids = []
+    start = time.time()
+    try:
+        result['fingerprint'] = fingerprint_from_keydata(keydata)
+        signed_uids = list(sign_keydata_and_encrypt(keydata,
+                                                    session=session))
+        result['uids'] = len(signed_uids)
+        result['ok'] = True
+    except Exception as e:
+        log.exception("Could not sign %s", source)
+        result['error'] = "%s: %s" % (type(e).__name__, e)
+    result['seconds'] = round(time.time() - start, 3)
+    return result, signed_uids
+
+
+def write_signed_uids(fingerprint, signed_uids, output_dir):
+    "Writes the encrypted signatures to output_dir and returns the filenames"
+    fnames = []
+    for i, (uid, encrypted_key) in enumerate(signed_uids, start=1):
+        fname = os.path.join(output_dir, "%s-%d.asc" % (fingerprint, i))
+        with open(fname, 'wb') as f:
+            f.write(encrypted_key)
+        fnames.append(fname)
+    return fnames
+
 
 def main():
     import argparse
-    parser = argparse.ArgumentParser(description="Sign an OpenPGP key from a file.  The program will open each file, exrtact exactly one OpenPGP key, sign each UID separately, encrypt and send each signed UID using xdg-email.")
-    parser.add_argument("file", nargs='+', type=argparse.FileType('rb'),
-        help="File containing OpenPGP keys")
+    parser = argparse.ArgumentParser(description="Sign an OpenPGP key from a file.  The program will open each file, exrtact the OpenPGP keys, sign each UID separately, encrypt and send each signed UID using xdg-email.")
+    parser.add_argument("file", nargs='+',
+        help="File containing OpenPGP keys, or a directory of such files")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="Number of processes to sign with.  Each one has its own "
+             "signing keyring but uses your gpg-agent.")
+    parser.add_argument("-o", "--output-dir",
+        help="Write the encrypted signatures to this directory "
+             "rather than sending emails")
+    parser.add_argument("--summary", type=argparse.FileType('w'),
+        help="Write a JSON line per key to this file, '-' for stdout")
+    parser.add_argument("--only-new-certifications", action='store_true',
+        help="Send only the certifications made now rather than "
+             "all the certifications the UIDs have")
     args = parser.parse_args()
+    # The installed script calls us directly, but the progress should
+    # be shown.  This does nothing if logging has been set up already.
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+            format='%(message)s')
 
-    log = logging.getLogger(__name__)
     log.debug('Running main with args: %s', args)
-    for fhandle in args.file:
-        data = fhandle.read()
-        log.info("Calling %r to sign %s", sign_keydata_and_send, fhandle.name)
-        tmpfiles = list(sign_keydata_and_send(keydata=data))
-    log.info("Finished signing. " +
-             "We're only waiting for the signature " +
-             "files to be picked up. " +
-             "Press any key to quit the application.")
-    input()
+    jobs = iter_keys(args.file)
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs, initializer=init_session,
+            initargs=(args.only_new_certifications,))
+        results = pool.imap(sign, jobs)
+    else:
+        pool = None
+        init_session(args.only_new_certifications)
+        results = (sign(job) for job in jobs)
+
+    if args.output_dir and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    tmpfiles = []
+    n = failed = 0
+    start = time.time()
+    try:
+        for n, (result, signed_uids) in enumerate(results, start=1):
+            fingerprint = result['fingerprint']
+            if result['ok']:
+                if args.output_dir:
+                    result['files'] = write_signed_uids(
+                        fingerprint, signed_uids, args.output_dir)
+                else:
+                    tmpfiles += list(send_signed_uids(fingerprint,
+                                                      signed_uids))
+            else:
+                failed += 1
+            log.info("[%d] %s %s: %d UIDs in %.2fs%s", n, result['source'],
+                     fingerprint, result['uids'], result['seconds'],
+                     "" if result['ok'] else " FAILED: " + result['error'])
+            if args.summary:
+                args.summary.write(json.dumps(result, sort_keys=True) + "\n")
+                args.summary.flush()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        else:
+            session.close()
+    log.info("Signed %d keys in %.2fs, %d failed",
+             n - failed, time.time() - start, failed)
+
+    if tmpfiles:
+        log.info("Finished signing. " +
+                 "We're only waiting for the signature " +
+                 "files to be picked up. " +
+                 "Press any key to quit the application.")
+        input()
+    return 1 if failed else 0
 
 
 if __name__ == '__main__':
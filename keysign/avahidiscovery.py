@@ -16,13 +16,17 @@
 #    You should have received a copy of the GNU General Public License
 #    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import namedtuple, OrderedDict
 import logging
 import os
+import socket
 import sys
+import time
 
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, HTTPError, Timeout
 
 from gi.repository import GObject, GLib
+from twisted.internet.defer import Deferred, CancelledError, succeed
 
 
 if  __name__ == "__main__" and __package__ is None:
@@ -39,6 +43,7 @@ if  __name__ == "__main__" and __package__ is None:
 
 
 from .util import strip_fingerprint, download_key_http, parse_barcode
+from .util import parse_keys_txt, HTTPKeyDownloader
 
 try:
     from .gpgmh import fingerprint_from_keydata
@@ -51,40 +56,344 @@ from .util import mac_verify
 
 log = logging.getLogger(__name__)
 
+def race_downloads(candidates, download, verify, stagger=0.25, clock=None):
+    """Downloads from all candidates in parallel, first verified wins
+
+    Like Happy Eyeballs, a download is started every stagger seconds,
+    or as soon as the previous one has failed, until one has
+    passed verify.  The others are then cancelled.
+    download is called with a candidate and returns a Deferred.
+    The returned Deferred fires with the verified data, or None.
+    Cancelling it cancels all downloads.
+    """
+    if clock is None:
+        from twisted.internet import reactor as clock
+    candidates = iter(candidates)
+    pending = []
+    state = {'timer': None, 'exhausted': False}
+
+    def cancel_all():
+        if state['timer'] is not None and state['timer'].active():
+            state['timer'].cancel()
+        state['timer'] = None
+        for d in list(pending):
+            d.cancel()
+
+    def finish(data):
+        if not result.called:
+            cancel_all()
+            result.callback(data)
+
+    def start_next():
+        state['timer'] = None
+        try:
+            candidate = next(candidates)
+        except StopIteration:
+            state['exhausted'] = True
+            if not pending:
+                finish(None)
+            return
+        log.debug("Starting download from %r", candidate)
+        d = download(candidate)
+        pending.append(d)
+        d.addCallbacks(downloaded, failed,
+                       callbackArgs=(d, candidate), errbackArgs=(d, candidate))
+        if not result.called and not d.called:
+            state['timer'] = clock.callLater(stagger, start_next)
+
+    def downloaded(data, d, candidate):
+        pending.remove(d)
+        if result.called:
+            return
+        try:
+            verified = verify(data)
+        except ValueError:
+            log.exception("Could not verify the data from %r", candidate)
+            verified = False
+        if verified:
+            log.info("Downloaded a verified key from %r", candidate)
+            finish(data)
+        else:
+            log.info("The data from %r could not be verified", candidate)
+            next_now()
+
+    def failed(failure, d, candidate):
+        pending.remove(d)
+        if result.called or failure.check(CancelledError):
+            return
+        log.info("Error downloading from %r: %s",
+                 candidate, failure.getErrorMessage())
+        next_now()
+
+    def next_now():
+        if state['timer'] is not None and state['timer'].active():
+            state['timer'].cancel()
+            state['timer'] = None
+        if state['exhausted']:
+            if not pending:
+                finish(None)
+        elif state['timer'] is None:
+            start_next()
+
+    result = Deferred(lambda d: cancel_all())
+    start_next()
+    return result
+
+
+class DiscoveredService(namedtuple("DiscoveredService",
+        "name address port fingerprint keyids last_seen ttl")):
+    """A service we have discovered via Avahi
+
+    fingerprint is the one advertised by services serving a single
+    key, keyids the set of key IDs advertised by those serving
+    several, or None.  The service expires ttl seconds after
+    it has last been seen, unless ttl is None.
+    """
+    @property
+    def key(self):
+        return (self.name, self.address, self.port)
+
+    def expired(self, now):
+        return self.ttl is not None and now - self.last_seen > self.ttl
+
+
+class DiscoveredServices(object):
+    """The services we have discovered, indexed by name and fingerprint
+
+    A service with the same name may be seen on several addresses,
+    e.g. with IPv4 and IPv6, so each address is an entry of its own.
+    Avahi tells us when a service goes away, so ttl defaults to None.
+    """
+    def __init__(self, ttl=None, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        # (name, address, port) -> DiscoveredService
+        self._services = OrderedDict()
+        # name -> set of keys
+        self._by_name = {}
+        # fingerprint or key ID -> set of keys
+        self._by_fpr = {}
+        # keys of the services advertising key IDs
+        self._with_keyids = set()
+
+    def __len__(self):
+        return len(self._services)
+
+    def __iter__(self):
+        return iter(list(self._services.values()))
+
+    def __repr__(self):
+        return "<DiscoveredServices %r>" % list(self._services.values())
+
+    def _index(self, service):
+        fprs = [service.fingerprint] if service.fingerprint else []
+        return fprs + list(service.keyids or [])
+
+    def add(self, name, address, port, fingerprint=None, keyids=None,
+            ttl=None):
+        "Adds the service, or updates it if we have seen it before"
+        ttl = self.ttl if ttl is None else ttl
+        fingerprint = fingerprint.upper() if fingerprint else fingerprint
+        service = DiscoveredService(name, address, port, fingerprint,
+                                    keyids, self.clock(), ttl)
+        self._remove(service.key)
+        key = service.key
+        self._services[key] = service
+        self._by_name.setdefault(name, set()).add(key)
+        for fpr in self._index(service):
+            self._by_fpr.setdefault(fpr, set()).add(key)
+        if keyids is not None:
+            self._with_keyids.add(key)
+        return service
+
+    def _remove(self, key):
+        service = self._services.pop(key, None)
+        if service is None:
+            return None
+        self._by_name[service.name].discard(key)
+        if not self._by_name[service.name]:
+            del self._by_name[service.name]
+        for fpr in self._index(service):
+            self._by_fpr[fpr].discard(key)
+            if not self._by_fpr[fpr]:
+                del self._by_fpr[fpr]
+        self._with_keyids.discard(key)
+        return service
+
+    def remove(self, name):
+        "Removes all services with that name and returns them"
+        return [self._remove(key) for key in list(self._by_name.get(name, ()))]
+
+    def get(self, name):
+        "Returns the services with that name"
+        return [self._services[key] for key in self._by_name.get(name, ())]
+
+    def expire(self):
+        "Removes the services which have expired and returns them"
+        now = self.clock()
+        return [self._remove(s.key) for s in self if s.expired(now)]
+
+    def find(self, fpr):
+        """Returns the services advertising the fingerprint,
+        either as a whole or by its key ID"""
+        self.expire()
+        fpr = fpr.upper()
+        keys = self._by_fpr.get(fpr, set()) | self._by_fpr.get(fpr[-16:], set())
+        return [self._services[key] for key in keys]
+
+    def with_keyids(self):
+        "Returns the services advertising key IDs rather than a fingerprint"
+        return [self._services[key] for key in self._with_keyids]
+
+
+class KeyPrefetcher(object):
+    """Downloads advertised keys ahead of time into a bounded LRU cache
+
+    At most concurrency downloads run at once.  The others wait,
+    and if more than size are waiting, the oldest are dropped.
+    download is called with a candidate and returns a Deferred.
+    """
+    def __init__(self, download, size=32, concurrency=4):
+        self.download = download
+        self.size = size
+        self.concurrency = concurrency
+        # fingerprint -> keydata, the least recently used first
+        self.keys = OrderedDict()
+        # fingerprint -> candidate, the oldest first
+        self.waiting = OrderedDict()
+        self.running = set()
+
+    def add(self, fpr, candidate):
+        "Prefetches the key from the candidate, unless we have it already"
+        if fpr in self.keys or fpr in self.running:
+            return
+        self.waiting.pop(fpr, None)
+        self.waiting[fpr] = candidate
+        while len(self.waiting) > self.size:
+            self.waiting.popitem(last=False)
+        self.start_next()
+
+    def start_next(self):
+        while self.waiting and len(self.running) < self.concurrency:
+            fpr, candidate = self.waiting.popitem(last=False)
+            self.start(fpr, candidate)
+
+    def start(self, fpr, candidate):
+        self.running.add(fpr)
+
+        def downloaded(keydata):
+            if fingerprint_from_keydata(keydata) != fpr:
+                log.info("Prefetched key from %r is not %s", candidate, fpr)
+                return
+            log.info("Prefetched %s from %r", fpr, candidate)
+            self.keys[fpr] = keydata
+            while len(self.keys) > self.size:
+                self.keys.popitem(last=False)
+
+        def failed(failure):
+            log.info("Could not prefetch %s from %r: %s",
+                     fpr, candidate, failure.getErrorMessage())
+
+        def done(result):
+            self.running.discard(fpr)
+            self.start_next()
+
+        d = self.download(candidate)
+        d.addCallbacks(downloaded, failed)
+        d.addBoth(done)
+        return d
+
+    def get(self, fpr, verify):
+        "Returns the prefetched key for fpr if it passes verify"
+        keydata = self.keys.get(fpr)
+        if keydata is None:
+            return None
+        if not verify(keydata):
+            log.info("The prefetched key for %s does not verify", fpr)
+            return None
+        self.keys[fpr] = self.keys.pop(fpr)
+        return keydata
+
+
 class AvahiKeysignDiscovery(GObject.GObject):
     "A client discovery using Avahi"
 
     __gsignals__ = {
         # Gets emitted whenever a new server has been found or has been removed.
         # Is also emitted shortly after an object has been created.
+        # Changes in quick succession cause a single emission.
         str("list-changed"): (GObject.SIGNAL_RUN_LAST, None, (int,)),
     }
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, ttl=None, coalesce_ms=200, prefetch=False,
+                 prefetch_size=32, prefetch_concurrency=4,
+                 avahi_browser=None, *args, **kwargs):
         super(AvahiKeysignDiscovery, self).__init__(*args, **kwargs)
         self.log = logging.getLogger(__name__)
         # We should probably try to put this constant in a more central place
         avahi_service_type = '_gnome-keysign._tcp'
-        self.avahi_browser = AvahiBrowser(service=avahi_service_type)
+        if avahi_browser is None:
+            avahi_browser = AvahiBrowser(service=avahi_service_type)
+        self.avahi_browser = avahi_browser
         self.avahi_browser.connect('new_service', self.on_new_service)
         self.avahi_browser.connect('remove_service', self.on_remove_service)
-        self.discovered_services = []
+        self.discovered_services = DiscoveredServices(ttl=ttl)
+        self.coalesce_ms = coalesce_ms
+        self.list_changed_source = None
+        # If prefetch is set, we download the advertised keys as soon as
+        # we see them, so that find_key only needs to check the MAC.
+        self.prefetcher = None
+        if prefetch:
+            self.prefetcher = KeyPrefetcher(self.download, prefetch_size,
+                                            prefetch_concurrency)
+        # Created when needed, because it needs the reactor
+        self.downloader = None
         # It seems we cannot emit directly...
-        GLib.idle_add(lambda: self.emit("list-changed",
-            len(self.discovered_services)))
+        GLib.idle_add(self.emit_list_changed)
+
+    def emit_list_changed(self):
+        self.list_changed_source = None
+        self.discovered_services.expire()
+        self.emit("list-changed", len(self.discovered_services))
+        return False
+
+    def list_changed(self):
+        "Emits list-changed soon, unless that is already scheduled"
+        if self.list_changed_source is None:
+            self.list_changed_source = GLib.timeout_add(self.coalesce_ms,
+                self.emit_list_changed)
 
     def on_new_service(self, browser, name, address, port, txt_dict):
         published_fpr = txt_dict.get('fingerprint', None)
-        self.log.info("discovered something: %s %s:%i:%s",
-                      name, address, port, published_fpr)
+        # Servers offering many keys advertise their key IDs
+        keyids = parse_keys_txt(txt_dict)
+        self.log.info("discovered something: %s %s:%i:%s %s",
+                      name, address, port, published_fpr, keyids)
         if not address.startswith('fe80::'):
             # We intend to ignore IPv6 link local addresses, because it seems
             # that you cannot just connect to that address without also
             # knowing which NIC the address belongs to.
             # http://serverfault.com/a/794967
-            # FIXME: Use something more sane like attr.s instead of the tuple
-            self.discovered_services += ((name, address, port, published_fpr), )
-            self.emit("list-changed", len(self.discovered_services))
+            service = self.discovered_services.add(name, address, port,
+                                                   published_fpr, keyids)
+            self.list_changed()
+            if self.prefetcher is not None and service.fingerprint:
+                self.prefetch_key(service)
+
+    def prefetch_key(self, service):
+        """Downloads the key advertised by the service into the
+        prefetched keys, if we do not have it already"""
+        candidate = (service.address, service.port,
+                     None if service.keyids is None else service.fingerprint)
+        self.prefetcher.add(service.fingerprint, candidate)
+
+    def get_prefetched(self, userdata):
+        "Returns the prefetched key for the userdata if it passes verify_key"
+        if self.prefetcher is None:
+            return None
+        cleaned = strip_fingerprint(parse_barcode(userdata)["fingerprint"])
+        return self.prefetcher.get(cleaned.upper(),
+            lambda keydata: self.verify_key(keydata, userdata))
 
     def on_remove_service(self, browser, service_type, name):
         '''Handler for the on_remove signal from AvahiBrowser
@@ -97,59 +406,103 @@ class AvahiKeysignDiscovery(GObject.GObject):
         self.remove_discovered_service(name)
 
     def remove_discovered_service(self, name):
-        '''Removes server-side clients from discovered_services list
-        when the server name with fpr is a match.'''
-        for client in self.discovered_services:
-            if client[0] == name:
-                self.discovered_services.remove(client)
-                self.emit("list-changed", len(self.discovered_services))
+        '''Removes the services with that name from the
+        discovered_services'''
+        if self.discovered_services.remove(name):
+            self.list_changed()
         self.log.info("Clients currently in list '%s'",
                       self.discovered_services)
 
+    def iter_candidates(self, fpr):
+        """Yields (address, port, fingerprint) of the services that
+        advertise the key, either by its fingerprint or its key ID.
+        The fingerprint is None for services which serve a single key only.
+        """
+        # A service updates its TXT record when it serves another key,
+        # so we do not need to ask the ones not advertising it.
+        for service in self.discovered_services.find(fpr):
+            yield (service.address, service.port,
+                   None if service.keyids is None else fpr)
+
+    def verify_key(self, keydata, userdata):
+        "Whether the keydata is the key the userdata refers to"
+        cleaned = strip_fingerprint(parse_barcode(userdata)["fingerprint"])
+        return fingerprint_from_keydata(keydata) == cleaned.upper()
+
     def find_key(self, userdata):
         "Returns the key if it thinks it found one..."
         self.log.info("Trying to find key with %r", userdata)
         parsed = parse_barcode(userdata)
         cleaned = strip_fingerprint(parsed["fingerprint"])
-        downloaded_key = None
-        # FIXME: Replace with attr.ib
-        for (name, address, port, fpr) in self.discovered_services:
-            if cleaned == fpr:
-                # This is blocking :-/
-                try:
-                    downloaded_key = download_key_http(address, port)
-                    if fingerprint_from_keydata(downloaded_key) != cleaned:
-                        continue
-                except ConnectionError:
-                    self.log.exception("Error downloading from %r:%r",
-                                  address, port)
+        downloaded_key = self.get_prefetched(userdata)
+        if downloaded_key:
+            return downloaded_key
+        for (address, port, fpr) in self.iter_candidates(cleaned):
+            # This is blocking :-/
+            try:
+                keydata = download_key_http(address, port, fpr)
+                if self.verify_key(keydata, userdata):
+                    downloaded_key = keydata
+                    break
+            except (ConnectionError, HTTPError, Timeout, socket.timeout,
+                    ValueError):
+                # The ValueError is KeyDataRejected if the data did
+                # not look like a key, or it comes from verify_key
+                # if it was not a key after all.  We try the next one.
+                self.log.exception("Error downloading from %r:%r",
+                              address, port)
         return downloaded_key
 
-class AvahiKeysignDiscoveryWithMac(AvahiKeysignDiscovery):
-    def find_key(self, userdata):
-        "Returns the key if it thinks it found one which also matched the MAC"
-        key = super(AvahiKeysignDiscoveryWithMac, self).find_key(userdata)
-        if key:
-            # For now, we cannot assume that a MAC exists, simply because
-            # currently the MAC is only transferred via the barcode.
-            # The user, however, might as well enter the fingerprint
-            # manually.  Unless we stop allowing that, we won't have a MAC.
-            mac = parse_barcode(userdata).get("MAC", [None])[0]
-            if mac is None:
-                # This is the ugly shortcut which exists for legacy reasons
-                verified_key = key
-            else:
-                mac_key = fingerprint_from_keydata(key)
-                verified = mac_verify(mac_key.encode('ascii'), key, mac)
-                if verified:
-                    verified_key = key
-                else:
-                    self.log.info("MAC validation failed: %r", verified)
-                    verified_key = None
-        else:
-            verified_key = None
+    def download(self, candidate):
+        "Downloads from an (address, port, fingerprint) and returns a Deferred"
+        if self.downloader is None:
+            self.downloader = HTTPKeyDownloader()
+        return self.downloader.download(*candidate)
+
+    def stop(self):
+        """Cancels the downloads and closes the kept connections
 
-        return verified_key
+        Returns a Deferred firing once the connections are closed.
+        """
+        downloader, self.downloader = self.downloader, None
+        if downloader is None:
+            return succeed(None)
+        return downloader.close()
+
+    def fetch_key(self, userdata, stagger=0.25):
+        """Downloads the key from all candidates in parallel
+
+        Returns a Deferred firing with the first key which passes
+        verify_key, or None.  See race_downloads.
+        """
+        self.log.info("Trying to fetch key with %r", userdata)
+        keydata = self.get_prefetched(userdata)
+        if keydata:
+            return succeed(keydata)
+        parsed = parse_barcode(userdata)
+        cleaned = strip_fingerprint(parsed["fingerprint"])
+        return race_downloads(self.iter_candidates(cleaned), self.download,
+                              lambda keydata: self.verify_key(keydata, userdata),
+                              stagger=stagger)
+
+class AvahiKeysignDiscoveryWithMac(AvahiKeysignDiscovery):
+    def verify_key(self, keydata, userdata):
+        "Whether the keydata is the key the userdata refers to and matches the MAC"
+        if not super(AvahiKeysignDiscoveryWithMac, self).verify_key(keydata, userdata):
+            return False
+        # For now, we cannot assume that a MAC exists, simply because
+        # currently the MAC is only transferred via the barcode.
+        # The user, however, might as well enter the fingerprint
+        # manually.  Unless we stop allowing that, we won't have a MAC.
+        mac = parse_barcode(userdata).get("MAC", [None])[0]
+        if mac is None:
+            # This is the ugly shortcut which exists for legacy reasons
+            return True
+        mac_key = fingerprint_from_keydata(keydata)
+        verified = mac_verify(mac_key.encode('ascii'), keydata, mac)
+        if not verified:
+            self.log.info("MAC validation failed: %r", verified)
+        return verified
 
 def main(args):
     log = logging.getLogger(__name__)
@@ -22,6 +22,10 @@ import argparse
 import logging
 import os
 
+if __name__ == "__main__":
+    from twisted.internet import gtk3reactor
+    gtk3reactor.install()
+from twisted.internet import reactor
 
 if __name__ == "__main__" and __package__ is None:
     logging.getLogger().error("You seem to be trying to execute " +
@@ -36,22 +40,33 @@ if __name__ == "__main__" and __package__ is None:
     __package__ = str('keysign')
 
 from .__init__ import __version__
-from .gpgmh import get_usable_keys, get_public_key_data
+from .gpgmh import get_usable_keys
 from .i18n import _
-from .util import mac_generate, format_fingerprint
+from .util import format_fingerprint, OfferPayload
 from . import Keyserver
 
 log = logging.getLogger(__name__)
 
 
 class AvahiHTTPOffer:
-    "Spawns a local HTTP daemon and announces it via Avahi"
-    def __init__(self, key):
+    """Spawns a local HTTP daemon and announces it via Avahi
+
+    If a running keyserver is given, the key is added to it
+    rather than to a new one, so that many keys can share it.
+    """
+    def __init__(self, key, minimal=True, payload=None, keyserver=None):
         self.key = key
-        self.fingerprint = fingerprint = key.fingerprint
-        self.keydata = keydata = get_public_key_data(fingerprint)
-        self.keyserver = Keyserver.ServeKeyThread(keydata, fingerprint)
-        self.mac = mac_generate(fingerprint.encode('ascii'), keydata)
+        if payload is None:
+            payload = OfferPayload.from_key(key, minimal=minimal)
+        self.payload = payload
+        self.fingerprint = fingerprint = payload.fingerprint
+        self.keydata = keydata = payload.keydata
+        self.shared = keyserver is not None
+        if self.shared:
+            self.keyserver = keyserver
+        else:
+            self.keyserver = Keyserver.KeyServer()
+        self.mac = payload.mac
 
     def start(self):
         """Starts offering the key"""
@@ -61,30 +76,44 @@ class AvahiHTTPOffer:
                                 fingerprint, mac)
 
         log.info("Requesting to start")
-        self.keyserver.start()
+        self.keyserver.add_key(self.keydata, fingerprint)
+        if not self.shared:
+            self.keyserver.start()
 
         return format_fingerprint(self.key.fingerprint), discovery_info
 
     def stop(self):
         "Stops offering the key"
         log.info("Requesting to shutdown")
-        self.keyserver.shutdown()
+        if self.shared:
+            self.keyserver.remove_key(self.fingerprint)
+        else:
+            self.keyserver.stop()
 
 
 def main(args):
     if not args:
         raise ValueError("You must provide an argument to identify the key")
 
+    def cancel():
+        try: input_ = raw_input
+        except NameError: input_ = input
+        input_("Press Enter to stop")
+        reactor.callFromThread(stop)
+
+    def stop():
+        offer.stop()
+        reactor.stop()
+
     key = get_usable_keys(pattern=args[0])[0]
     offer = AvahiHTTPOffer(key)
     discovery_info = offer.start()
     print (_("Offering key: {}").format(key))
     print (_("Discovery info: {}").format(discovery_info))
     print (_("Press Enter to stop"))
-    try: input_ = raw_input
-    except NameError: input_ = input
-    input_("Press Enter to stop")
-    offer.stop()
+    # Wait for the user without blocking the reactor
+    reactor.callInThread(cancel)
+    reactor.run()
 
 
 if __name__ == "__main__":
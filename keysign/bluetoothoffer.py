@@ -29,16 +29,19 @@ if __name__ == "__main__" and __package__ is None:
     __package__ = str('keysign')
 
 from .errors import NoBluezDbus, NoAdapter, UnpoweredAdapter
-from .gpgmh import get_public_key_data, get_usable_keys
+from .gpgmh import get_usable_keys
 from .i18n import _
-from .util import get_local_bt_address, mac_generate
+from .util import get_local_bt_address, OfferPayload
 
 log = logging.getLogger(__name__)
 
 
 class BluetoothOffer:
-    def __init__(self, key, port=3, size=1024):
+    def __init__(self, key, port=3, size=1024, minimal=True, payload=None):
         self.key = key
+        if payload is None:
+            payload = OfferPayload.from_key(key, minimal=minimal)
+        self.payload = payload
         self.port = port
         self.size = size
         self.server_socket = None
@@ -60,9 +63,8 @@ class BluetoothOffer:
                     # We are sure that a connection is available, so we can call
                     # accept() without deferring it to a thread
                     client_socket, address = self.server_socket.accept()
-                    key_data = get_public_key_data(self.key.fingerprint)
-                    kd_decoded = key_data.decode('utf-8')
-                    yield threads.deferToThread(client_socket.sendall, kd_decoded)
+                    yield threads.deferToThread(client_socket.sendall,
+                                                self.payload.keydata)
                     log.info("Key has been sent")
                     client_socket.shutdown(socket.SHUT_RDWR)
                     client_socket.close()
@@ -148,9 +150,8 @@ def main(args):
         print(_("Press Enter to exit"))
 
     key = get_usable_keys(pattern=args[0])[0]
-    file_key_data = get_public_key_data(key.fingerprint)
-    hmac = mac_generate(key.fingerprint.encode('ascii'), file_key_data)
     offer = BluetoothOffer(key)
+    hmac = offer.payload.mac
 
     offer.allocate_code().addCallback(code_generated)
     reactor.run()
@@ -27,6 +27,7 @@ if __name__ == "__main__" and __package__ is None:
 
 from .gpgmh import fingerprint_from_keydata
 from .i18n import _
+from .ingest import KeyBuffer
 from .util import mac_verify
 
 log = logging.getLogger(__name__)
@@ -43,6 +44,7 @@ class BluetoothReceive:
     def find_key(self, bt_mac, mac):
         self.client_socket = BluetoothSocket(RFCOMM)
         message = b""
+        buf = None
         try:
             self.client_socket.setblocking(False)
             try:
@@ -59,17 +61,22 @@ class BluetoothReceive:
                     log.info("Connection established")
                     self.client_socket.setblocking(True)
                     success = True
+                    buf = KeyBuffer('bluetooth')
                     # try to receive until the sender closes the connection
                     try:
                         while True:
                             part_message = self.client_socket.recv(self.size)
                             log.debug("Read %d bytes: %r", len(part_message), part_message)
-                            message += part_message
+                            if not part_message:
+                                break
+                            buf.write(part_message)
                     except BluetoothError as be:
                         if be.args[0] == "(104, 'Connection reset by peer')":
                             log.info("Bluetooth connection closed, let's check if we downloaded the key")
                         else:
                             raise be
+            if buf:
+                message = buf.getvalue()
             mac_key = fingerprint_from_keydata(message)
             verified = None
             if mac:
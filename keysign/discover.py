@@ -1,7 +1,6 @@
 import logging
 
-from twisted.internet import threads
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, CancelledError
 from wormhole.errors import LonelyError
 
 from .wormholereceive import WormholeReceive
@@ -29,12 +28,15 @@ class Discover:
             self.worm_code = userdata
         self.userdata = userdata
         self.app_id = app_id
+        # We only stop the discovery if it is ours
+        self.own_discovery = not discovery
         if discovery:
             self.discovery = discovery
         else:
             self.discovery = AvahiKeysignDiscoveryWithMac()
         self.worm = None
         self.bt = None
+        self.avahi_d = None
         self.stopped = False
 
     @inlineCallbacks
@@ -46,7 +48,11 @@ class Discover:
         log.info("Trying to use this code with Avahi: %s", self.userdata)
         
         try:
-            key_data = yield threads.deferToThread(self.discovery.find_key, self.userdata)
+            self.avahi_d = self.discovery.fetch_key(self.userdata)
+            key_data = yield self.avahi_d
+        except CancelledError:
+            log.info("Downloading via Avahi has been cancelled")
+            key_data = None
         except ValueError as e:
             key_data = None
             success = False
@@ -96,6 +102,11 @@ class Discover:
 
     def stop(self):
         self.stopped = True
+        # Do not wait for the downloads to time out
+        if self.avahi_d:
+            self.avahi_d.cancel()
+        if self.own_discovery:
+            self.discovery.stop()
         # WormholeReceive needs to be stopped because right now after the 'start()'
         # it continues trying to connect until it does or we stop it.
         if self.worm:
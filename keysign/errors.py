@@ -20,3 +20,11 @@ class AvahiException(Exception):
 
 class NoAvahiDbus(AvahiException):
     """The required avahi dbus is not available"""
+
+
+class SigningCancelled(Exception):
+    """The user has cancelled signing the key"""
+
+
+class KeyDataRejected(ValueError):
+    """The received data is too big or cannot be a key"""
@@ -19,6 +19,7 @@ from __future__ import unicode_literals
 from collections import namedtuple
 from datetime import datetime
 import logging
+import re
 import warnings
 
 log = logging.getLogger(__name__)
@@ -69,6 +70,62 @@ def parse_uid(uid, errors='replace'):
     return (name, comment, email)
 
 
+def split_uid(uid):
+    """Splits a UID string into its name, comment, and email component
+
+    This follows what gpgme does when it parses a UID, so that
+    the components are the same whether or not the UID came
+    from gpgme.  In particular, an email address is only
+    recognised if it is enclosed in angle brackets.
+    """
+    parts = {}
+    in_name = in_email = in_comment = 0
+    start = 0
+
+    def set_part(part, end):
+        if part not in parts:
+            parts[part] = uid[start:end].rstrip(' \t')
+
+    for i, c in enumerate(uid):
+        if in_email:
+            if c == '<':
+                # Not legal but anyway
+                in_email += 1
+            elif c == '>':
+                in_email -= 1
+                if not in_email:
+                    set_part('email', i)
+        elif in_comment:
+            if c == '(':
+                in_comment += 1
+            elif c == ')':
+                in_comment -= 1
+                if not in_comment:
+                    set_part('comment', i)
+        elif c in '<(':
+            if in_name:
+                set_part('name', i)
+                in_name = 0
+            if c == '<':
+                in_email = 1
+            else:
+                in_comment = 1
+            start = i + 1
+        elif not in_name and c not in ' \t':
+            in_name = 1
+            start = i
+    if in_name:
+        set_part('name', len(uid))
+
+    return (parts.get('name', ''), parts.get('comment', ''),
+            parts.get('email', ''))
+
+
+def tokenize(s):
+    "Returns the lower-cased words of a name or an email for searching"
+    return [t for t in re.split(r'[^\w.@+-]+', s.lower()) if t]
+
+
 def parse_expiry(value):
     """Takes either a string, an epoch, or a datetime and converts
     it to a datetime.
@@ -175,3 +232,18 @@ class UID(namedtuple("UID", "expiry uid name comment email")):
         expiry = None  #  FIXME: Maybe UIDs don't expire themselves but via the binding signature
 
         return cls(expiry, rawuid, name, comment, email)
+
+    @classmethod
+    def from_bytes(cls, uid):
+        "Creates a new UID from the raw bytes of a UID packet"
+        # We decode like the gpgme bindings do and then
+        # make the result renderable, see from_gpgme.
+        decoded = uid.decode('utf-8', 'surrogateescape')
+        name, comment, email = split_uid(decoded)
+        rawuid = to_valid_utf8_string(decoded)
+        name = to_valid_utf8_string(name)
+        comment = '' # FIXME: Like from_gpgme, we don't do comments yet
+        email = to_valid_utf8_string(email)
+        expiry = None
+
+        return cls(expiry, rawuid, name, comment, email)
@@ -17,18 +17,30 @@
 #    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
 
+import atexit
+from binascii import hexlify
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+from itertools import islice
 import logging
 import os  # The SigningKeyring uses os.symlink for the agent
-from subprocess import check_output
+import shutil
+from subprocess import check_call, check_output, CalledProcessError
 import sys
 from tempfile import mkdtemp
+import threading
+import time
 import platform
+import re
 
 import gpg
 from gpg.constants import PROTOCOL_OpenPGP
 
 
-from .gpgkey import Key, UID
+from .errors import SigningCancelled
+from .gpgkey import Key, UID, tokenize
+from .pgppackets import parse_key, split_uids
 
 texttype = unicode if sys.version_info.major < 3 else str
 
@@ -113,8 +125,16 @@ def del_uids(uids):
 
 
 def sign_key(uid=0, sign_cmd=u"sign", expire=False, check=3,
-             error_cb=None):
+             error_cb=None, cancelled=None, signed_cb=None):
+    """Answers GnuPG's edit prompts for signing the UIDs of a key
+
+    uid may also be a list of UID numbers, which are then signed one
+    after the other in the same session.  Before each of them, we
+    quit without saving if cancelled() returns True.  signed_cb is
+    called with the number of each UID once it has been signed.
+    """
     log.info("Signing key uid %r", uid)
+    uids = uid if isinstance(uid, (list, tuple)) else [uid]
     status, prompt = yield None
     if status == u"status_code_lost": # Yeah, such a constant does not exist *sigh*
         # We are here, because the agent on the host is too old for
@@ -127,51 +147,66 @@ def sign_key(uid=0, sign_cmd=u"sign", expire=False, check=3,
     assert status == gpg.constants.STATUS_GET_LINE, "Expected status to be GET_LINE, but is %r" % status
     assert prompt == u"keyedit.prompt"
 
-    status, prompt = yield u"uid %d" % uid
-    # We ignore GOT_IT...
-    # assert status == gpg.constants.STATUS_GOT_IT
-
-    #status, prompt = yield None
-    assert status == gpg.constants.STATUS_GET_LINE
-
-    status, prompt = yield sign_cmd
-    # We ignore GOT_IT...
-    # assert status == gpg.constants.STATUS_GOT_IT
-
-    while prompt != 'keyedit.prompt':
-        if prompt == 'keyedit.sign_all.okay':
-            status, prompt = yield 'Y'
-        elif prompt == 'sign_uid.expire':
-            status, prompt = yield '%s' % ('Y' if expire else 'N')
-        elif prompt == 'sign_uid.class':
-            status, prompt = yield '%d' % check
-        elif prompt == 'sign_uid.okay':
-            status, prompt = yield 'Y'
-        elif status == gpg.constants.STATUS_INV_SGNR:
-            # seems to happen if you have an expired
-            # (or otherwise unsuable) signing key.
-            # The CONSIDERED line should have been issued
-            # with details.
-            # We don't maintain that state at the moment which is
-            # a bit unfortunate as we cannot properly detect
-            # when we have no usable key at all rather than
-            # one key being expired.
-            log.warn("INV_SGNR: %r", prompt)
-            status, prompt = yield None
-        elif status == gpg.constants.STATUS_PINENTRY_LAUNCHED:
-            status, prompt = yield None
-        elif status == gpg.constants.STATUS_GOT_IT:
-            status, prompt = yield None
-        elif status == gpg.constants.STATUS_ALREADY_SIGNED:
-            status, prompt = yield u'Y'
-        elif status == gpg.constants.STATUS_ERROR:
-            if error_cb:
-                error_cb(prompt)
+    for n, uid in enumerate(uids):
+        if cancelled is not None and cancelled():
+            log.info("Cancelled before signing uid %r", uid)
+            status, prompt = yield u"quit"
+            if prompt == 'keyedit.save.okay':
+                yield u"N"
+            return
+
+        if n:
+            # Deselect the UID we have just signed
+            status, prompt = yield u"uid 0"
+            assert status == gpg.constants.STATUS_GET_LINE
+
+        status, prompt = yield u"uid %d" % uid
+        # We ignore GOT_IT...
+        # assert status == gpg.constants.STATUS_GOT_IT
+
+        #status, prompt = yield None
+        assert status == gpg.constants.STATUS_GET_LINE
+
+        status, prompt = yield sign_cmd
+        # We ignore GOT_IT...
+        # assert status == gpg.constants.STATUS_GOT_IT
+
+        while prompt != 'keyedit.prompt':
+            if prompt == 'keyedit.sign_all.okay':
+                status, prompt = yield 'Y'
+            elif prompt == 'sign_uid.expire':
+                status, prompt = yield '%s' % ('Y' if expire else 'N')
+            elif prompt == 'sign_uid.class':
+                status, prompt = yield '%d' % check
+            elif prompt == 'sign_uid.okay':
+                status, prompt = yield 'Y'
+            elif status == gpg.constants.STATUS_INV_SGNR:
+                # seems to happen if you have an expired
+                # (or otherwise unsuable) signing key.
+                # The CONSIDERED line should have been issued
+                # with details.
+                # We don't maintain that state at the moment which is
+                # a bit unfortunate as we cannot properly detect
+                # when we have no usable key at all rather than
+                # one key being expired.
+                log.warn("INV_SGNR: %r", prompt)
+                status, prompt = yield None
+            elif status == gpg.constants.STATUS_PINENTRY_LAUNCHED:
+                status, prompt = yield None
+            elif status == gpg.constants.STATUS_GOT_IT:
+                status, prompt = yield None
+            elif status == gpg.constants.STATUS_ALREADY_SIGNED:
+                status, prompt = yield u'Y'
+            elif status == gpg.constants.STATUS_ERROR:
+                if error_cb:
+                    error_cb(prompt)
+                else:
+                    raise RuntimeError("Error signing key: %s" % prompt)
+                status, prompt = yield None
             else:
-                raise RuntimeError("Error signing key: %s" % prompt)
-            status, prompt = yield None
-        else:
-            raise AssertionError("Unexpected state %r %r" % (status, prompt))
+                raise AssertionError("Unexpected state %r %r" % (status, prompt))
+        if signed_cb:
+            signed_cb(uid)
 
     yield u"save"
 
@@ -182,53 +217,66 @@ def UIDExport(keydata, uid_i):
     """Export only the UID of a key.
     Unfortunately, GnuPG does not provide smth like
     --export-uid-only in order to obtain a UID and its
-    signatures."""
-    log.debug("Deletion of UID %r from %r", uid_i, keydata)
+    signatures.  So we split the key's packets ourselves."""
+    log.debug("Export of UID %r from %r", uid_i, keydata)
     if not uid_i >= 1:
         log.debug("Raising because uid: %r", uid_i)
         raise ValueError("Expected UID to be >= 1, but is %r", uid_i)
-    ctx = TempContext()
-    ctx.op_import(keydata)
-    result = ctx.op_import_result()
-    if result.considered != 1 or result.imported != 1:
-        raise ValueError("Expected exactly one key in keydata. %r" % result)
-    else:
-        assert len(result.imports) == 1
-        fpr = result.imports[0].fpr
-        key = ctx.get_key(fpr)
-        uids_to_remove = {i for i in range(1, len(key.uids)+1)}
-        uids_to_remove.remove(uid_i)
-        if uids_to_remove:
-            sink = gpg.Data()
-            ctx.interact(key,
-                GenEdit(del_uids(uids_to_remove)).edit_cb,
-                fnc_value=sink, sink=sink)
-            sink.seek(0, 0)
-            log.debug("Data after UIDExport: %s", sink.read())
-        uid_data = gpg.Data()
-        ctx.op_export_keys([key], 0, uid_data)
-        uid_data.seek(0, 0)
-        uid_bytes = uid_data.read()
-        log.debug("UID %r: %r", uid_i, uid_bytes)
-        return uid_bytes
+    uids_data = split_uids(keydata)
+    if uid_i > len(uids_data):
+        raise ValueError("Expected UID to be <= %d, but is %r" %
+                         (len(uids_data), uid_i))
+    uid_bytes = uids_data[uid_i - 1]
+    log.debug("UID %r: %r", uid_i, uid_bytes)
+    return uid_bytes
+
+
+def export_uids_from_context(ctx, key, certified_by=None, since=0):
+    """Yields the gpgme UID and the exported data of each UID of a key
+
+    The key is exported only once and then split into its UIDs.
+    We export the key in binary form, because we only
+    split it up again.  See pgppackets.split_uids for
+    certified_by and since.
+    """
+    armor = ctx.armor
+    ctx.armor = False
+    try:
+        sink = gpg.Data()
+        ctx.op_export_keys([key], 0, sink)
+        sink.seek(0, 0)
+        keydata = sink.read()
+    finally:
+        ctx.armor = armor
+
+    uids_data = split_uids(keydata, certified_by=certified_by, since=since)
+    # The packets are in the same order as GnuPG lists the UIDs.
+    if len(uids_data) != len(key.uids):
+        raise ValueError("Expected %d UIDs in exported key, but found %d" %
+                         (len(key.uids), len(uids_data)))
+    for uid, uid_data in zip(key.uids, uids_data):
+        yield (uid, uid_data)
+
 
 def export_uids(keydata):
     """Export each valid and non-revoked UID of a key"""
-    ctx = TempContext()
-    ctx.op_import(keydata)
-    result = ctx.op_import_result()
-    log.debug("ExportUIDs: Imported %r", result)
-    if result.considered != 1 or result.imported != 1:
-        raise ValueError("Expected exactly one key in keydata. %r" % result)
-    else:
+    with temp_context() as ctx:
+        ctx.op_import(keydata)
+        result = ctx.op_import_result()
+        log.debug("ExportUIDs: Imported %r", result)
+        if result.considered != 1 or result.imported != 1:
+            raise ValueError("Expected exactly one key in keydata. %r" % result)
         assert len(result.imports) == 1
         fpr = result.imports[0].fpr
         key = ctx.get_key(fpr)
-        for i, uid in enumerate(key.uids, start=1):
-            log.info("Potentially deleting UID %d: %r", i, uid)
-            if not uid.invalid and not uid.revoked:
-                uid_data = UIDExport(keydata, i)
-                yield (uid.uid, uid_data)
+        # We need to be done with the context before it
+        # goes back to the pool, so we don't yield from in here.
+        exported = [(uid.uid, uid_data) for uid, uid_data
+                    in export_uids_from_context(ctx, key)
+                    if not uid.invalid and not uid.revoked]
+
+    for uid, uid_data in exported:
+        yield (uid, uid_data)
 
 
 
@@ -255,34 +303,256 @@ class DirectoryContext(gpg.Context):
         self.homedir = homedir
 
 class TempContext(DirectoryContext):
+    """A context in a fresh temporary homedir
+
+    The homedir is not removed automatically.  Call cleanup() or
+    use the context in a with statement.  If you only need a
+    scratch keyring for a short while, rather use temp_context()
+    which hands out wiped contexts from a pool.
+    """
     def __init__(self):
         self.homedir = mkdtemp()
         super(TempContext, self).__init__(homedir=self.homedir)
 
-    def __del__(self):
+    def wipe(self):
+        """Removes all keys and resets the context's settings
+
+        The agent's sockets are left alone so that a running
+        agent continues to serve this homedir.
+        """
+        log.debug("Wiping %r", self.homedir)
+        for name in os.listdir(self.homedir):
+            if name.startswith('S.'):
+                continue
+            path = os.path.join(self.homedir, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        self.armor = False
+        self.signers = []
+        self.set_keylist_mode(gpg.constants.KEYLIST_MODE_LOCAL)
+
+    def kill_agent(self):
+        "Stops any agent that GnuPG might have spawned for the homedir"
+        cmd = ["gpgconf", "--homedir", self.homedir, "--kill", "all"]
+        try:
+            check_call(cmd)
+        except (OSError, CalledProcessError):
+            log.exception("Could not stop the agent for %r", self.homedir)
+
+    def cleanup(self):
+        "Stops the homedir's agent and removes the homedir"
+        log.debug("Cleaning up %r", self.homedir)
+        self.kill_agent()
+        shutil.rmtree(self.homedir, ignore_errors=True)
+        gpgconf_dirs.forget(self.homedir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.cleanup()
+        return super(TempContext, self).__exit__(exc_type, exc_value, tb)
+
+
+class TempContextPool(object):
+    """A bounded pool of TempContexts
+
+    Creating a TempContext means creating a new homedir, and
+    potentially a new agent, every time.  The pool hands out
+    contexts which are wiped before they are reused.  Contexts
+    which do not fit into the pool anymore are cleaned up.
+    """
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                self.hits += 1
+                return self._free.pop()
+            self.misses += 1
+        return TempContext()
+
+    def release(self, ctx):
         try:
-            # shutil.rmtree(self.homedir, ignore_errors=True)
-            pass
-        except:
-            log.exception("During cleanup of %r", self.homedir)
+            ctx.wipe()
+        except Exception:
+            log.exception("Could not wipe %r, discarding it", ctx.homedir)
+            ctx.cleanup()
+            return
+
+        with self._lock:
+            if len(self._free) < self.maxsize:
+                self._free.append(ctx)
+                ctx = None
+        if ctx:
+            ctx.cleanup()
+
+    @contextmanager
+    def context(self):
+        "Yields a fresh TempContext and puts it back to the pool afterwards"
+        ctx = self.acquire()
+        try:
+            yield ctx
+        finally:
+            self.release(ctx)
+
+    def close(self):
+        "Cleans up all contexts currently in the pool"
+        with self._lock:
+            free, self._free = self._free, []
+        log.info("Closing TempContext pool: %r", self.stats())
+        for ctx in free:
+            ctx.cleanup()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'free': len(self._free)}
+
+
+temp_context_pool = TempContextPool()
+atexit.register(temp_context_pool.close)
+
+def temp_context():
+    """Returns a context manager for a TempContext from the pool
+
+    Don't let the context escape the with statement, because it
+    will be wiped and handed out again.
+    """
+    return temp_context_pool.context()
+
+
+def zbase32(data):
+    "Encodes bytes with the z-base-32 alphabet, like GnuPG's zb32_encode"
+    alphabet = "ybndrfg8ejkmcpqxot1uwisza345h769"
+    bits = int(hexlify(data), 16) if data else 0
+    nbits = len(data) * 8
+    # We pad to a multiple of 5 bits
+    padding = -nbits % 5
+    bits <<= padding
+    nbits += padding
+    return "".join(alphabet[(bits >> shift) & 0x1f]
+                   for shift in range(nbits - 5, -1, -5))
+
+
+class GpgconfDirs(object):
+    """Resolves and caches the directories gpgconf --list-dirs reports
+
+    We run gpgconf once per homedir and remember all of its dirs.
+    For fresh homedirs, e.g. from mkdtemp, we can also predict the
+    socket directory the way GnuPG derives it: either the homedir
+    itself or "d.<zbase32 of the hashed homedir>" in the runtime
+    directory, if that exists.  Once a prediction has been verified
+    with gpgconf, we stop asking gpgconf for other homedirs.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.avoided = 0
+        self.runtime_dir = None
+        self.verified = False
+        self._dirs = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def parse(output):
+        if not isinstance(output, texttype):
+            output = output.decode('utf-8')
+        dirs = {}
+        for line in output.splitlines():
+            name, sep, value = line.partition(':')
+            if sep:
+                # gpgconf percent-escapes colons and other special characters
+                dirs[name] = re.sub(r'%([0-9a-fA-F]{2})',
+                                    lambda m: chr(int(m.group(1), 16)), value)
+        return dirs
+
+    def _gpgconf(self, homedir):
+        homedir_cmd = ["--homedir", homedir] if homedir else []
+        cmd = ["gpgconf"] + homedir_cmd + ["--list-dirs"]
+        self.calls += 1
+        dirs = self.parse(check_output(cmd))
+        log.debug("gpgconf dirs for %r: %r", homedir, dirs)
+        return dirs
+
+    def predict_socketdir(self, homedir):
+        "Returns where GnuPG puts the sockets for a non-default homedir"
+        if self.runtime_dir:
+            digest = hashlib.sha1(os.path.abspath(homedir).encode('utf-8'))
+            name = "d." + zbase32(digest.digest()[:15])
+            socketdir = os.path.join(self.runtime_dir, name)
+            if os.path.isdir(socketdir):
+                return socketdir
+        return homedir
+
+    def _learn(self, homedir, dirs):
+        socketdir = dirs.get('socketdir')
+        if not homedir:
+            # The default homedir's sockets live in the runtime dir, if any
+            if socketdir and socketdir != dirs.get('homedir'):
+                self.runtime_dir = socketdir
+        elif not self.verified and socketdir:
+            if self.predict_socketdir(homedir) == socketdir:
+                self.verified = True
+            else:
+                log.info("Could not predict the socketdir %r for %r",
+                         socketdir, homedir)
+
+    def get(self, homedir=None):
+        "Returns a dictionary with the dirs of homedir"
+        with self._lock:
+            dirs = self._dirs.get(homedir)
+            if dirs is not None:
+                self.avoided += 1
+                return dirs
+
+            # We need the default dirs to know the runtime dir
+            if homedir and None not in self._dirs:
+                self._dirs[None] = self._gpgconf(None)
+                self._learn(None, self._dirs[None])
+
+            if homedir and self.verified:
+                socketdir = self.predict_socketdir(homedir)
+                dirs = {'homedir': homedir, 'socketdir': socketdir,
+                        'agent-socket': os.path.join(socketdir, 'S.gpg-agent')}
+                self.avoided += 1
+            else:
+                dirs = self._gpgconf(homedir)
+                self._learn(homedir, dirs)
+            self._dirs[homedir] = dirs
+            return dirs
+
+    def forget(self, homedir):
+        "Removes homedir from the cache, e.g. when it has been deleted"
+        with self._lock:
+            self._dirs.pop(homedir, None)
+
+    def stats(self):
+        return {'calls': self.calls, 'avoided': self.avoided,
+                'verified': self.verified, 'cached': len(self._dirs)}
+
+
+gpgconf_dirs = GpgconfDirs()
+
 
 def get_agent_socket_path_for_homedir(homedir):
-    homedir_cmd = ["--homedir", homedir] if homedir else []
-    cmd = ["gpgconf"] + homedir_cmd + \
-          ["--list-dirs", "agent-socket"]
-    path = check_output(cmd).strip()
+    path = gpgconf_dirs.get(homedir)['agent-socket']
     log.info("Path for %r: %r", homedir, path)
     return path
 
 
 class TempContextWithAgent(TempContext):
+    agent_path = None
+
     def __init__(self, oldctx):
         super(TempContextWithAgent, self).__init__()
         homedir = self.homedir
         log.info("new homedir: %r", homedir)
-        assert (len(list(self.keylist())) == 0)
-        assert (len(list(self.keylist(secret=True))) == 0)
-
 
         old_homedir = oldctx.engine_info.home_dir if oldctx else None
 
@@ -290,38 +560,48 @@ class TempContextWithAgent(TempContext):
         old_agent_path = get_agent_socket_path_for_homedir(old_homedir)
         new_agent_path = get_agent_socket_path_for_homedir(homedir)
         os.symlink(old_agent_path, new_agent_path)
+        self.agent_path = new_agent_path
 
-        assert len(list(self.keylist())) == 0
-        assert len(list(self.keylist(secret=True))) == 0
+        try:
+            self.import_signers(oldctx)
+        except Exception:
+            self.cleanup()
+            raise
 
+    def import_signers(self, oldctx):
+        "Makes all secret keys of oldctx known in one export and import"
         secret_keys = list(oldctx.keylist(secret=True))
         log.info("old secret keys: %r", secret_keys)
-        for key in secret_keys:
-            log.debug("Making %r known in new ctx", key)
-            def export_key(fpr):
-                # FIXME: The Context should really be able to export()
-                public_key = gpg.Data()
-                oldctx.op_export(fpr, 0, public_key)
-                public_key.seek(0, os.SEEK_SET)
-                return public_key
-            keydata = export_key(key.subkeys[0].fpr)
-            self.op_import(keydata)
+        if secret_keys:
+            # We only need the public keys here.  The agent, i.e. the
+            # user's agent, holds the secret parts.
+            public_keys = gpg.Data()
+            oldctx.op_export_keys(secret_keys, 0, public_keys)
+            public_keys.seek(0, os.SEEK_SET)
+            self.op_import(public_keys)
             result = self.op_import_result()
-            # Hrm. Only gpgme>=1.9 has a repr for the result, I think
             log.debug("Import result: %r", result)
-            log.debug("Import result imports: %r", result.imports)
-            log.debug("Import result considered: %r", result.considered)
-            assert len(result.imports) >= 1
-            i = result.imports[0]
-            # 0 is success, I guess.
-            assert i.result == 0
-            log.debug("Import result i result status: %r %r %r", i.result, i.status, i.fpr)
-            log.debug("Import result GPGME_IMPORT_NEW: %r", i.status & gpg.constants.IMPORT_NEW)
-
-
-        assert len(list(self.keylist())) == len(secret_keys)
-        log.info("new secret keys: %r", list(self.keylist(secret=True)))
-        assert len(secret_keys) == len(list(self.keylist(secret=True)))
+            failed = [i for i in result.imports if i.result != 0]
+            if failed:
+                raise ValueError("Could not import %r" % [i.fpr for i in failed])
+
+        # One pass to check that each of our keys can be used for signing
+        expected = set(key.fpr for key in secret_keys)
+        found = set(key.fpr for key in self.keylist(secret=True))
+        log.info("new secret keys: %r", found)
+        if expected != found:
+            raise ValueError("Expected secret keys %r, but got %r" %
+                             (expected, found))
+
+    def kill_agent(self):
+        """We must not stop the agent, because it is the user's agent.
+        We only remove our link to it."""
+        if not self.agent_path:
+            return
+        try:
+            os.unlink(self.agent_path)
+        except OSError:
+            log.exception("Could not remove agent link %r", self.agent_path)
 
 
 
@@ -333,29 +613,126 @@ class TempContextWithAgent(TempContext):
 
 
 
-def openpgpkey_from_data(keydata):
-    c = TempContext()
-    c.op_import(gpg.Data(keydata))
-    result = c.op_import_result()
-    log.debug("Import Result: %s", result)
-    if result.imported != 1:
-        raise ValueError("Keydata did not contain exactly one key, but %r" %
-            result.imported)
-    else:
-        imported = result.imports
-        import_ = imported[0]
-        fpr = import_.fpr
-        key = c.get_key(fpr)
-        return Key.from_gpgme(key)
+class KeyDataCache(object):
+    """A bounded LRU cache of parsed keys, keyed by the SHA-256 of the keydata
+
+    The same keydata is looked at several times while receiving a key,
+    e.g. for discovery, for the MAC, and for signing.  The Key we
+    return is immutable, so we can hand out the same object every time.
+    """
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # The number of hits for keys which GnuPG had to import for us
+        self.imports_saved = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(keydata):
+        if isinstance(keydata, texttype):
+            keydata = keydata.encode('utf-8')
+        return hashlib.sha256(keydata).digest()
+
+    def get(self, keydata, verified=False):
+        """Returns the cached Key for keydata, parsing it if necessary
+
+        With verified, we only return a Key that GnuPG has imported,
+        because we do not check the self-signatures of the UIDs.
+        """
+        digest = self.digest(keydata)
+        with self._lock:
+            entry = self._entries.pop(digest, None)
+            if entry is not None:
+                self._entries[digest] = entry
+                key, imported = entry
+                if imported or not verified:
+                    self.hits += 1
+                    if imported:
+                        self.imports_saved += 1
+                    return key
+            self.misses += 1
+
+        if verified:
+            key, imported = openpgpkey_from_data_gpg(keydata), True
+        else:
+            key, imported = _openpgpkey_from_data(keydata)
+
+        with self._lock:
+            self._entries[digest] = (key, imported)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return key
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'imports_saved': self.imports_saved,
+                'size': len(self._entries)}
+
+
+def _openpgpkey_from_data(keydata):
+    """Returns the Key for keydata and whether GnuPG had to import it
 
+    We parse the key ourselves if we can, because that is much
+    cheaper than importing it into a temporary keyring.
+    GnuPG is used for anything we do not understand.
+    """
+    try:
+        return parse_key(keydata), False
+    except ValueError as e:
+        log.debug("Could not parse key, trying GnuPG: %s", e)
+        return openpgpkey_from_data_gpg(keydata), True
 
 
-def get_public_key_data(fpr, homedir=None):
+keydata_cache = KeyDataCache()
+
+
+def openpgpkey_from_data(keydata, verified=False):
+    """Returns a gpgkey.Key for the single key in keydata
+
+    Without verified, the UIDs may include some which GnuPG would
+    not import.  Pass verified if the UIDs are shown to the user.
+    """
+    return keydata_cache.get(keydata, verified=verified)
+
+
+def openpgpkey_from_data_gpg(keydata):
+    "Returns a gpgkey.Key for keydata by importing it into a temporary keyring"
+    with temp_context() as c:
+        c.op_import(gpg.Data(keydata))
+        result = c.op_import_result()
+        log.debug("Import Result: %s", result)
+        if result.imported != 1:
+            raise ValueError("Keydata did not contain exactly one key, but %r" %
+                result.imported)
+        else:
+            imported = result.imports
+            import_ = imported[0]
+            fpr = import_.fpr
+            key = c.get_key(fpr)
+            return Key.from_gpgme(key)
+
+
+
+def get_public_key_data(fpr, homedir=None, minimal=False):
+    """Returns the armored public key for fpr
+
+    With minimal, GnuPG leaves out all signatures but the most
+    recent self-signatures, like the receiving side's minimise_key.
+    """
     c = DirectoryContext(homedir)
     c.armor = True
     sink = gpg.Data()
+    mode = gpg.constants.EXPORT_MODE_MINIMAL if minimal else 0
     # FIXME: There will probably be an export() function
-    c.op_export(fpr, 0, sink)
+    c.op_export(fpr, mode, sink)
     sink.seek(0, os.SEEK_SET)
     keydata = sink.read()
     log.debug("Exported %r: %r", fpr, keydata)
@@ -383,82 +760,359 @@ def get_usable_keys_from_context(ctx, pattern="", secret=False):
             ]
     return keys
 
+
+def get_homedir(homedir=None):
+    "Returns the directory GnuPG uses if homedir is None"
+    if homedir:
+        return homedir
+    return os.environ.get('GNUPGHOME') or os.path.expanduser('~/.gnupg')
+
+
+class KeyringSnapshot(object):
+    """The usable keys of a keyring, indexed for pattern lookups
+
+    Walking a large keyring with gpgme takes seconds, so we do it
+    once and answer patterns from memory.  We stat the keyring
+    files on every lookup and take a new snapshot once they change.
+
+    Hexadecimal patterns are looked up as fingerprints or key IDs
+    of the primary key or of a subkey.  "<email>" matches the email
+    exactly.  Other patterns match, like with GnuPG, if they are a
+    case-insensitive substring of a UID.  We also return the keys
+    which have all the words of the pattern in the name or the email,
+    in whichever order.
+    """
+    watched_files = ('pubring.kbx', 'pubring.gpg', 'trustdb.gpg',
+                     'private-keys-v1.d', 'secring.gpg')
+
+    def __init__(self, homedir=None, secret=False):
+        self.homedir = homedir
+        self.secret = secret
+        self.builds = 0
+        self.lookups = 0
+        self._state = None
+        self._keys = []
+        # find() holds the lock while _iter_build publishes the snapshot
+        self._lock = threading.RLock()
+
+    def keyring_state(self):
+        "Returns something that changes when the keyring changes"
+        homedir = get_homedir(self.homedir)
+        state = []
+        for name in self.watched_files:
+            try:
+                st = os.stat(os.path.join(homedir, name))
+            except OSError:
+                state.append((name, None))
+            else:
+                state.append((name, st.st_mtime, st.st_size, st.st_ino))
+        return tuple(state)
+
+    def _iter_build(self):
+        """Walks the keyring and yields the usable keys as they come
+
+        The new snapshot only takes effect once the walk has finished.
+        """
+        state = self.keyring_state()
+        ctx = DirectoryContext(homedir=self.homedir)
+        keys = []
+        by_id = {}
+        by_email = {}
+        by_token = {}
+        for gpgme_key in ctx.keylist(secret=self.secret):
+            if not is_usable(gpgme_key):
+                continue
+            if self.secret and not gpgme_key.subkeys[0].secret:
+                continue
+            i = len(keys)
+            key = Key.from_gpgme(gpgme_key)
+            keys.append(key)
+            for subkey in gpgme_key.subkeys:
+                fpr = subkey.fpr.upper()
+                for id_ in (fpr, fpr[-16:], fpr[-8:]):
+                    by_id.setdefault(id_, set()).add(i)
+            for uid in key.uidslist:
+                if uid.email:
+                    by_email.setdefault(uid.email.lower(), set()).add(i)
+                for token in tokenize(uid.name + ' ' + uid.email):
+                    by_token.setdefault(token, set()).add(i)
+            yield key
+
+        with self._lock:
+            self._keys = keys
+            self._by_id = by_id
+            self._by_email = by_email
+            self._by_token = by_token
+            self._haystacks = ['\n'.join(uid.uid.lower()
+                                          for uid in key.uidslist)
+                               for key in keys]
+            self._state = state
+            self.builds += 1
+        log.debug("Took snapshot of %d keys in %r", len(keys), self.homedir)
+
+    def is_fresh(self):
+        return self.keyring_state() == self._state
+
+    def refresh(self):
+        "Takes a new snapshot if the keyring has changed"
+        if not self.is_fresh():
+            for key in self._iter_build():
+                pass
+
+    def _find(self, pattern):
+        if not pattern:
+            return range(len(self._keys))
+
+        hexpattern = pattern[2:] if pattern.lower().startswith('0x') else pattern
+        if (len(hexpattern) in (8, 16, 40)
+                and re.match(r'^[0-9a-fA-F]+$', hexpattern)):
+            return self._by_id.get(hexpattern.upper(), ())
+
+        needle = pattern.lower()
+        if needle.startswith('<') and needle.endswith('>'):
+            return self._by_email.get(needle[1:-1], ())
+
+        hits = set(i for i, haystack in enumerate(self._haystacks)
+                   if needle in haystack)
+        tokens = tokenize(needle)
+        if tokens:
+            hits.update(set.intersection(*(self._by_token.get(t, set())
+                                           for t in tokens)))
+        return hits
+
+    def find(self, pattern=""):
+        "Returns a list of the usable Keys matching pattern"
+        with self._lock:
+            self.refresh()
+            self.lookups += 1
+            return [self._keys[i] for i in sorted(self._find(pattern))]
+
+    def iter_find(self, pattern="", chunksize=50):
+        """Yields lists of at most chunksize usable Keys matching pattern
+
+        Without a pattern and with an outdated snapshot, the keys are
+        yielded while the keyring is being walked, so that the first
+        chunk is available long before the walk has finished.
+        """
+        if pattern or self.is_fresh():
+            keys = iter(self.find(pattern))
+        else:
+            self.lookups += 1
+            keys = self._iter_build()
+        while True:
+            chunk = list(islice(keys, chunksize))
+            if not chunk:
+                break
+            yield chunk
+
+
+keyring_snapshots = {}
+keyring_snapshots_lock = threading.Lock()
+
+def get_keyring_snapshot(homedir=None, secret=False):
+    "Returns the KeyringSnapshot for the given keyring"
+    key = (get_homedir(homedir), secret)
+    with keyring_snapshots_lock:
+        snapshot = keyring_snapshots.get(key)
+        if snapshot is None:
+            snapshot = KeyringSnapshot(homedir=homedir, secret=secret)
+            keyring_snapshots[key] = snapshot
+    return snapshot
+
+
 def get_usable_keys(pattern="", homedir=None):
     '''Uses get_keys on the keyring and filters for
     non revoked, expired, disabled, or invalid keys'''
     log.debug('Retrieving keys for %s, %s', pattern, homedir)
-    ctx = DirectoryContext(homedir=homedir)
-    return get_usable_keys_from_context(ctx,
-    	pattern=pattern, secret=False)
+    snapshot = get_keyring_snapshot(homedir=homedir, secret=False)
+    return snapshot.find(pattern)
 
 def get_usable_secret_keys(pattern="", homedir=None):
     '''Returns all secret keys which can be used to sign a key'''
-    ctx = DirectoryContext(homedir=homedir)
-    return get_usable_keys_from_context(ctx,
-    	pattern=pattern, secret=True)
+    snapshot = get_keyring_snapshot(homedir=homedir, secret=True)
+    return snapshot.find(pattern)
+
+def iter_usable_keys(pattern="", homedir=None, chunksize=50):
+    '''Like get_usable_keys, but yields lists of at most chunksize keys'''
+    snapshot = get_keyring_snapshot(homedir=homedir, secret=False)
+    return snapshot.iter_find(pattern, chunksize=chunksize)
+
+def iter_usable_secret_keys(pattern="", homedir=None, chunksize=50):
+    '''Like get_usable_secret_keys, but yields lists of keys'''
+    snapshot = get_keyring_snapshot(homedir=homedir, secret=True)
+    return snapshot.iter_find(pattern, chunksize=chunksize)
 
 
 
 
 def minimise_key(keydata):
     "Returns the public key exported under the MINIMAL mode"
-    ctx = TempContext()
-    ctx.op_import(keydata)
-    result = ctx.op_import_result()
-    if result.considered != 1 and result.imported != 1:
-        raise ValueError("Expected to load exactly one key. %r", result)
-    else:
-        imports = [i for i in result.imports
-                   if i.status == gpg.constants.IMPORT_NEW]
-        log.debug("Import %r", result)
-        assert len(imports) == 1
-        fpr = result.imports[0].fpr
-        key = ctx.get_key(fpr)
-        sink = gpg.Data()
-        ctx.op_export_keys([key], gpg.constants.EXPORT_MODE_MINIMAL, sink)
-        sink.seek(0, 0)
-        minimised_key = sink.read()
-        return minimised_key
-
-def sign_keydata_and_encrypt(keydata, error_cb=None, homedir=None):
-    oldctx = DirectoryContext(homedir)
-    ctx = TempContextWithAgent(oldctx)
-    # We're trying to sign with all available secret keys
-    available_secret_keys = [key for key in ctx.keylist(secret=True)
-        if not key.disabled or key.revoked or key.invalid or key.expired]
-    log.debug('Setting available sec keys to: %r', available_secret_keys)
-    ctx.signers = available_secret_keys
-
-    ctx.op_import(minimise_key(keydata))
-    result = ctx.op_import_result()
-    if result.considered != 1 and result.imported != 1:
-        raise ValueError("Expected to load exactly one key. %r", result)
-    else:
-        imports = result.imports
-        assert len(imports) == 1
-        fpr = result.imports[0].fpr
+    with temp_context() as ctx:
+        ctx.op_import(keydata)
+        result = ctx.op_import_result()
+        if result.considered != 1 and result.imported != 1:
+            raise ValueError("Expected to load exactly one key. %r", result)
+        else:
+            imports = [i for i in result.imports
+                       if i.status == gpg.constants.IMPORT_NEW]
+            log.debug("Import %r", result)
+            assert len(imports) == 1
+            fpr = result.imports[0].fpr
+            key = ctx.get_key(fpr)
+            sink = gpg.Data()
+            ctx.op_export_keys([key], gpg.constants.EXPORT_MODE_MINIMAL, sink)
+            sink.seek(0, 0)
+            minimised_key = sink.read()
+            return minimised_key
+
+class SigningSession(object):
+    """Signs any number of keys in one ephemeral signing homedir
+
+    The homedir, the link to the user's agent, and the user's secret
+    keys are set up once, when the first key is signed.  Each key we
+    sign is deleted from the homedir again, so that it cannot end up
+    in the exports for the next key.  Call close(), or use the session
+    in a with statement, to remove the homedir.
+
+    By default, we encrypt the key with all its subkeys and
+    signatures but only one UID.  With only_new_certifications,
+    the data only consists of the primary key, the UID, its
+    self-signatures, and the certifications we have just made.
+    It thus stays small no matter how many signatures the key
+    carries.  The owner of the key has the subkeys and the direct
+    signatures already.  UIDs which GnuPG has not certified anew,
+    e.g. because they were already signed, are then left out.
+    """
+    def __init__(self, homedir=None, only_new_certifications=False):
+        self.homedir = homedir
+        self.only_new_certifications = only_new_certifications
+        self.signed = 0
+        self._ctx = None
+        self._signers = set()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_ctx(self):
+        if self._ctx is None:
+            oldctx = DirectoryContext(self.homedir)
+            ctx = TempContextWithAgent(oldctx)
+            # We're trying to sign with all available secret keys
+            available_secret_keys = [key for key in ctx.keylist(secret=True)
+                if not key.disabled or key.revoked or key.invalid or key.expired]
+            log.debug('Setting available sec keys to: %r', available_secret_keys)
+            ctx.signers = available_secret_keys
+            self._signers = set(key.fpr for key in available_secret_keys)
+            self._ctx = ctx
+        return self._ctx
+
+    def _purge(self, ctx, fpr):
+        "Removes the signed key so that the next run starts clean"
+        if fpr in self._signers:
+            # The key now carries our signature and we must not delete
+            # the secret key.  We rather prepare a new homedir next time.
+            log.debug("Signed one of our own keys, discarding %r", ctx.homedir)
+            self.close()
+            return
+        ctx.op_delete(ctx.get_key(fpr), False)
+        ctx.armor = False
+        ctx.set_keylist_mode(gpg.constants.KEYLIST_MODE_LOCAL)
+
+    def sign_and_encrypt(self, keydata, error_cb=None,
+                         progress_cb=None, cancel=None):
+        """Signs each UID of the key in keydata and encrypts it to the key
+
+        Returns a list of (UID, encrypted data) tuples.
+
+        progress_cb is called with the number of UIDs certified, the
+        number of UIDs to certify, and the UID which has just been
+        certified.  Revoked and invalid UIDs are not counted.
+        If cancel, a threading.Event, is set, we raise SigningCancelled
+        before we certify or encrypt the next UID.  Either way, the
+        certifications we have made so far are deleted with the key.
+        """
+        with self._lock:
+            ctx = self._get_ctx()
+            imported = []
+            try:
+                ctx.op_import(minimise_key(keydata))
+                result = ctx.op_import_result()
+                imported = [i.fpr for i in result.imports if not i.result]
+                if result.considered != 1 and result.imported != 1:
+                    raise ValueError("Expected to load exactly one key. %r", result)
+                imports = result.imports
+                assert len(imports) == 1
+                fpr = result.imports[0].fpr
+                signed = list(self._sign_and_encrypt(ctx, fpr, error_cb,
+                                                     progress_cb, cancel))
+            finally:
+                for fpr in imported:
+                    # _purge discards the whole homedir for our own keys
+                    if self._ctx is ctx:
+                        self._purge(ctx, fpr)
+            self.signed += 1
+            return signed
+
+    def _sign_and_encrypt(self, ctx, fpr, error_cb, progress_cb, cancel):
+        def check_cancelled():
+            if cancel is not None and cancel.is_set():
+                raise SigningCancelled(fpr)
+
+        check_cancelled()
         key = ctx.get_key(fpr)
+        # The signatures are at least as new as this
+        since = int(time.time())
+        # We certify the UIDs one after the other in one session, so
+        # that we can report progress and stop before the next one.
+        uid_numbers = [i for i, uid in enumerate(key.uids, start=1)
+                       if not (uid.revoked or uid.invalid)]
+        done = []
+        def signed_cb(i):
+            done.append(i)
+            if progress_cb:
+                progress_cb(len(done), len(uid_numbers),
+                            UID.from_gpgme(key.uids[i - 1]))
+        cancelled = cancel.is_set if cancel is not None else None
         sink = gpg.Data()
         # There is op_keysign, but it's only available with gpg 2.1.12
-        ctx.interact(key, GenEdit(sign_key(error_cb=error_cb)).edit_cb, sink=sink)
+        ctx.interact(key, GenEdit(sign_key(uid=uid_numbers, error_cb=error_cb,
+                                           cancelled=cancelled,
+                                           signed_cb=signed_cb)).edit_cb,
+                     sink=sink)
         sink.seek(0, 0)
         log.debug("Sink after signing: %r", sink.read())
+        check_cancelled()
 
-        signed_sink = gpg.Data()
         ctx.set_keylist_mode(gpg.constants.KEYLIST_MODE_SIGS)
+        # The encrypted UIDs are meant to be sent via email
         ctx.armor = True
-        ctx.op_export_keys([key], 0, signed_sink)
-        signed_sink.seek(0, 0)
-        signed_keydata = signed_sink.read()
-        log.debug("Signed Key: %s", signed_keydata)
         # Do I have to re-get the key to make the signatures known?
         key = ctx.get_key(fpr)
 
-        for i, uid in enumerate(key.uids, start=1):
+        if self.only_new_certifications:
+            certified_by = self._signers
+        else:
+            certified_by, since = None, 0
+        uids = export_uids_from_context(ctx, key,
+                                        certified_by=certified_by, since=since)
+        signer_ids = set(fpr[-16:] for fpr in self._signers)
+        for i, (uid, uid_data) in enumerate(uids, start=1):
+            check_cancelled()
             if uid.revoked or uid.invalid:
                 continue
+            elif (since and not crashing_gpgme
+                  and not any(sig.keyid in signer_ids
+                              and sig.timestamp >= since
+                              for sig in uid.signatures)):
+                # GnuPG did not certify it, e.g. because it was
+                # ALREADY_SIGNED, so we have nothing to send.
+                log.info("UID %d has no new certification, skipping it", i)
+                continue
             else:
-                uid_data = UIDExport(signed_keydata, i)
                 # FIXME: Check whether this bug is resolved and the remove this conditional
                 # https://bugs.debian.org/cgi-bin/bugreport.cgi?bug=884900
                 if not crashing_gpgme:
@@ -471,3 +1125,28 @@ def sign_keydata_and_encrypt(keydata, error_cb=None, homedir=None):
                                                always_trust=True,
                                                sign=False)
                 yield (UID.from_gpgme(uid), ciphertext)
+
+    def close(self):
+        "Removes the signing homedir"
+        ctx, self._ctx = self._ctx, None
+        self._signers = set()
+        if ctx:
+            ctx.cleanup()
+
+
+def sign_keydata_and_encrypt(keydata, error_cb=None, homedir=None,
+                             session=None, progress_cb=None, cancel=None):
+    """Yields (UID, encrypted data) for each signed UID of the key
+
+    Pass a SigningSession if you want to sign several keys.
+    Otherwise, a session is set up for this key only.
+    See SigningSession.sign_and_encrypt for progress_cb and cancel.
+    """
+    kwargs = dict(error_cb=error_cb, progress_cb=progress_cb, cancel=cancel)
+    if session is None:
+        with SigningSession(homedir) as session:
+            signed = session.sign_and_encrypt(keydata, **kwargs)
+    else:
+        signed = session.sign_and_encrypt(keydata, **kwargs)
+    for uid_and_ciphertext in signed:
+        yield uid_and_ciphertext
@@ -40,5 +40,8 @@ openpgpkey_from_data = gpg.openpgpkey_from_data
 get_public_key_data = gpg.get_public_key_data
 fingerprint_from_keydata = gpg.fingerprint_from_keydata
 get_usable_secret_keys = gpg.get_usable_secret_keys
+iter_usable_keys = gpg.iter_usable_keys
+iter_usable_secret_keys = gpg.iter_usable_secret_keys
 sign_keydata_and_encrypt = gpg.sign_keydata_and_encrypt
+SigningSession = gpg.SigningSession
 
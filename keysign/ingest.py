@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#    Copyright 2018 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""Receiving key data from the network
+
+Whatever transport we receive a key over, we do not trust the peer
+to send a sensible amount of data.  A KeyBuffer collects the data
+as it arrives, rejects it as soon as it exceeds the maximum size
+or does not start like a key, and records the throughput.
+"""
+
+import logging
+import threading
+import time
+
+from .errors import KeyDataRejected
+from .pgppackets import check_key_prefix
+
+log = logging.getLogger(__name__)
+
+# Minimal keys are a few KB, but photos can make them much larger
+MAX_KEY_SIZE = 4 * 1024 * 1024
+
+# How much we allocate if we do not know how much we will receive
+INITIAL_SIZE = 16 * 1024
+
+
+class TransportStats(object):
+    "Sums up the received key data per transport"
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, transport, size, seconds, rejected=False):
+        with self._lock:
+            stats = self._stats.setdefault(transport, {
+                'transfers': 0, 'rejected': 0, 'bytes': 0, 'seconds': 0.0})
+            stats['transfers'] += 1
+            stats['rejected'] += int(rejected)
+            stats['bytes'] += size
+            stats['seconds'] += seconds
+
+    def get(self):
+        "Returns the stats per transport, including the throughput in bytes/s"
+        with self._lock:
+            result = {}
+            for transport, stats in self._stats.items():
+                stats = dict(stats)
+                stats['throughput'] = (stats['bytes'] / stats['seconds']
+                                       if stats['seconds'] else None)
+                result[transport] = stats
+            return result
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+
+transport_stats = TransportStats()
+
+
+class KeyBuffer(object):
+    """Collects the key data received over a transport
+
+    The buffer is allocated up front, with expected_size if the
+    peer has told us how much to expect.  KeyDataRejected, a
+    ValueError, is raised by write as soon as the data exceeds
+    max_size or cannot be the beginning of a key.
+    """
+    def __init__(self, transport, max_size=MAX_KEY_SIZE, expected_size=None):
+        self.transport = transport
+        self.max_size = max_size
+        if expected_size is not None and expected_size > max_size:
+            self.reject("%s announced %d bytes, but we accept at most %d" %
+                        (transport, expected_size, max_size), 0)
+        self.buffer = bytearray(min(expected_size or INITIAL_SIZE, max_size))
+        self.size = 0
+        self.checked = False
+        self.started = time.time()
+        self.finished = None
+
+    def reject(self, message, size):
+        transport_stats.record(self.transport, size, 0, rejected=True)
+        log.warning("Rejecting key data: %s", message)
+        raise KeyDataRejected(message)
+
+    def write(self, data):
+        end = self.size + len(data)
+        if end > self.max_size:
+            self.reject("%s sent more than %d bytes" %
+                        (self.transport, self.max_size), end)
+        if end > len(self.buffer):
+            # Grow geometrically to not copy too often
+            grow = max(end, min(2 * len(self.buffer), self.max_size))
+            self.buffer.extend(bytearray(grow - len(self.buffer)))
+        self.buffer[self.size:end] = data
+        self.size = end
+        if not self.checked:
+            try:
+                self.checked = check_key_prefix(self.buffer[:self.size])
+            except ValueError as e:
+                self.reject("%s: %s" % (self.transport, e), end)
+
+    def getvalue(self):
+        "Finishes receiving and returns the data as bytes"
+        if self.finished is None:
+            self.finished = time.time()
+            seconds = self.finished - self.started
+            transport_stats.record(self.transport, self.size, seconds)
+            log.info("Received %d bytes via %s in %.3fs",
+                     self.size, self.transport, seconds)
+        return bytes(self.buffer[:self.size])
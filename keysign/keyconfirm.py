@@ -46,6 +46,7 @@ if  __name__ == "__main__" and __package__ is None:
 
 
 from .gpgmh import get_usable_keys
+from .i18n import _
 from .scan_barcode import ScalingImage
 from .util import format_fingerprint
 
@@ -87,6 +88,11 @@ class PreSignWidget(Gtk.VBox):
     __gsignals__ = {
         str('sign-key-confirmed'): (GObject.SIGNAL_RUN_LAST, None,
                                     (GObject.TYPE_PYOBJECT,)),
+        str('sign-key-cancelled'): (GObject.SIGNAL_RUN_LAST, None,
+                                    (GObject.TYPE_PYOBJECT,)),
+        # The number of UIDs signed, the number of UIDs, the latest UID
+        str('signing-progress'): (GObject.SIGNAL_RUN_FIRST, None,
+                                  (int, int, GObject.TYPE_PYOBJECT)),
     }
 
     def __init__(self, key, pixbuf=None, builder=None):
@@ -106,6 +112,17 @@ class PreSignWidget(Gtk.VBox):
 
         confirm_btn = builder.get_object("confirm_sign_button")
         confirm_btn.connect("clicked", self.on_confirm_button_clicked)
+        self.confirm_btn = confirm_btn
+
+        self.progressbar = Gtk.ProgressBar(show_text=True, hexpand=True)
+        cancel_btn = Gtk.Button.new_with_mnemonic(_("_Cancel"))
+        cancel_btn.connect("clicked", self.on_cancel_button_clicked)
+        self.progressbox = Gtk.Box(spacing=6, margin=6, no_show_all=True)
+        self.progressbox.pack_start(self.progressbar, True, True, 0)
+        self.progressbox.pack_end(cancel_btn, False, False, 0)
+        self.progressbar.show()
+        cancel_btn.show()
+        self.pack_end(self.progressbox, False, False, 0)
 
         self.key = key
 
@@ -133,6 +150,25 @@ class PreSignWidget(Gtk.VBox):
     def on_confirm_button_clicked(self, buttonObject, *args):
         self.emit('sign-key-confirmed', self.key, *args)
 
+    def on_cancel_button_clicked(self, button):
+        self.progressbar.set_text(_("Cancelling ..."))
+        self.emit('sign-key-cancelled', self.key)
+
+    def signing_started(self):
+        "Shows the progress bar instead of allowing to confirm again"
+        self.confirm_btn.set_sensitive(False)
+        self.progressbar.set_fraction(0)
+        self.progressbar.set_text(_("Signing ..."))
+        self.progressbox.show()
+
+    def do_signing_progress(self, done, total, uid):
+        self.progressbar.set_fraction(float(done) / total if total else 1)
+        self.progressbar.set_text(uid.uid)
+
+    def signing_finished(self):
+        self.progressbox.hide()
+        self.confirm_btn.set_sensitive(True)
+
 
 
 class PreSignApp(Gtk.Application):
@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 from __future__ import unicode_literals
+from bisect import bisect_left
 import logging
 import os
+import re
 
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk
+from gi.repository import Gio  # for the ListStore
 from gi.repository import GObject  # for __gsignals__
 from gi.repository import GLib  # for markup_escape_text
 
@@ -21,7 +24,8 @@ if  __name__ == "__main__" and __package__ is None:
     #sys.modules["keysign"] = mod
     __package__ = str('keysign')
 
-from .gpgmh import get_usable_keys
+from .gpgkey import tokenize
+from .gpgmh import get_usable_keys, iter_usable_keys
 from .i18n import _
 from .util import fix_infobar
 
@@ -30,11 +34,11 @@ log = logging.getLogger(__name__)
 class ListBoxRowWithKey(Gtk.ListBoxRow):
     "A simple extension of a Gtk.ListBoxRow to also hold a key object"
 
-    def __init__(self, key):
+    def __init__(self, key, markup=None):
         super(ListBoxRowWithKey, self).__init__()
         self.key = key
 
-        s = self.format(key)
+        s = markup if markup is not None else self.format(key)
         label = Gtk.Label(s, use_markup=True, xalign=0)
         self.add(label)
 
@@ -63,14 +67,10 @@ class ListBoxRowWithKey(Gtk.ListBoxRow):
         items = ('name', 'email', 'expiry')
         format_dict = {k: ""+(uid._asdict()[k] or "")
                           for k in items}
-        log.info("format dicT: %r", format_dict)
-        d = {k: (log.debug("handling kv: %r %r", k, v),
-                  cls.glib_markup_escape_text_to_text(
-                    "{}".format(v)))[1]
+        d = {k: cls.glib_markup_escape_text_to_text("{}".format(v))
              for k, v in format_dict.items()}
-        log.info("Formatting UID %r", d)
         s = fmt.format(**d)
-        log.info("Formatted UID: %r", s)
+        log.debug("Formatted UID: %r", s)
         return s
 
 
@@ -84,12 +84,74 @@ class ListBoxRowWithKey(Gtk.ListBoxRow):
 
         d = {k: GLib.markup_escape_text("{}".format(v))
              for k,v in key._asdict().items()}
-        log.info("Formatting key %r", d)
         s = fmt.format(**d)
-        log.info("Formatted key: %r", s)
+        log.debug("Formatted key: %r", s)
         return s
 
 
+class KeyItem(GObject.Object):
+    "Holds a key in the KeyListWidget's model"
+
+    def __init__(self, key):
+        super(KeyItem, self).__init__()
+        self.key = key
+        self._markup = None
+
+    @property
+    def markup(self):
+        "The key formatted for a label, computed when first needed"
+        if self._markup is None:
+            self._markup = ListBoxRowWithKey.format(self.key)
+        return self._markup
+
+
+class KeyIndex(object):
+    """Finds the positions of keys by prefixes of the words in their UIDs
+
+    The words of the names and emails as well as the fingerprint
+    and the key IDs are kept in a sorted list, so that a prefix
+    is a range which we find by bisecting.
+    """
+    def __init__(self):
+        self._entries = []
+        self._sorted = True
+
+    def add(self, i, key):
+        fpr = key.fingerprint.lower()
+        tokens = {fpr, fpr[-16:], fpr[-8:]}
+        for uid in key.uidslist:
+            tokens.update(tokenize(uid.name or ""))
+            for token in tokenize(uid.email or ""):
+                # Both "joe@example.com" and "example" should find it
+                tokens.add(token)
+                tokens.update(t for t in re.split(r'[@.+-]', token) if t)
+        self._entries.extend((t, i) for t in tokens)
+        self._sorted = False
+
+    def _prefix(self, prefix):
+        entries = self._entries
+        hits = set()
+        for j in range(bisect_left(entries, (prefix,)), len(entries)):
+            token, i = entries[j]
+            if not token.startswith(prefix):
+                break
+            hits.add(i)
+        return hits
+
+    def search(self, query):
+        "Returns the sorted positions of the keys matching all words of query"
+        if not self._sorted:
+            self._entries.sort()
+            self._sorted = True
+        hits = None
+        for word in tokenize(query):
+            found = self._prefix(word)
+            hits = found if hits is None else hits & found
+            if not hits:
+                break
+        return sorted(hits or ())
+
+
 class KeyListWidget(Gtk.HBox):
     """A Gtk Widget representing a list of OpenPGP Keys
     
@@ -115,8 +177,14 @@ class KeyListWidget(Gtk.HBox):
                                # The selected key
     }
 
-    def __init__(self, keys, builder=None):
-        "Sets the widget up with the given keys"
+    def __init__(self, keys=None, builder=None, chunks=None):
+        """Sets the widget up with the given keys
+
+        Instead of a list of keys, you can pass an iterable of lists
+        of keys as chunks, e.g. from gpgmh.iter_usable_keys.
+        The chunks are added from an idle handler, so the first keys
+        show up before the whole keyring has been walked.
+        """
         super(KeyListWidget, self).__init__()
         self.log = logging.getLogger(__name__)
         self.log.debug("KLW with keys: %r", keys)
@@ -136,31 +204,130 @@ class KeyListWidget(Gtk.HBox):
 
         self.listbox = builder.get_object("keys_listbox")
         self.code_spinner = builder.get_object("code_spinner")
+        self.keys_spinner = builder.get_object("keys_spinner")
+        self.infobar = builder.get_object("infobar")
         self.ib = builder.get_object('infobar_internet')
         fix_infobar(self.ib)
         self.label_ib = builder.get_object('label_internet')
 
-        if len(list(keys)) <= 0:
-            infobar = builder.get_object("infobar")
-            infobar.show()
-            l = Gtk.Label("You don't have any OpenPGP keys")
-            self.listbox.add(l)
+        self.searchentry = builder.get_object("keys_searchentry")
+        self.placeholder = Gtk.Label(_("You don't have any OpenPGP keys"))
+        # We only show it once we know that there are no keys
+        self.placeholder.set_no_show_all(True)
+        self.listbox.set_placeholder(self.placeholder)
+
+        # All the keys we have, in the order we have received them
+        self.items = []
+        self.index = KeyIndex()
+        self.query = ""
+        # The keys which are currently shown
+        self.store = Gio.ListStore(item_type=KeyItem)
+        self.listbox.bind_model(self.store, self.create_row)
+
+        self.n_keys = 0
+        self.listbox.connect('row-activated', self.on_row_activated)
+        self.listbox.connect('row-selected', self.on_row_selected)
+        self.listbox.connect('key-press-event', self.on_listbox_key_press)
+        self.searchentry.connect('search-changed', self.on_search_changed)
+
+        self._chunks = None
+        self._loader = None
+        if chunks is None:
+            self.add_keys(keys or [])
+            self.on_keys_loaded()
         else:
-            for key in keys:
-                self.log.debug("Adding key: %r", key)
-                lbr = ListBoxRowWithKey(key)
-                lbr.props.margin_bottom = 5
-                self.listbox.add(lbr)
-            self.listbox.connect('row-activated', self.on_row_activated)
-            self.listbox.connect('row-selected', self.on_row_selected)
+            self._chunks = iter(chunks)
+            self.keys_spinner.show()
+            self.keys_spinner.start()
+            self._loader = GLib.idle_add(self.on_load_chunk)
+            self.connect('destroy', self.on_destroy)
+
+    @staticmethod
+    def create_row(item):
+        lbr = ListBoxRowWithKey(item.key, markup=item.markup)
+        lbr.props.margin_bottom = 5
+        lbr.show_all()
+        return lbr
+
+    def add_keys(self, keys):
+        new_items = []
+        # Only the new keys are searched, so that we do not sort
+        # the whole index for every chunk that arrives
+        new_index = KeyIndex() if self.query else None
+        for key in keys:
+            i = len(self.items)
+            item = KeyItem(key)
+            self.items.append(item)
+            self.index.add(i, key)
+            if new_index is not None:
+                new_index.add(i, key)
+            new_items.append(item)
+        self.n_keys = len(self.items)
+
+        if new_index is not None:
+            new_items = [self.items[i] for i in new_index.search(self.query)]
+        self.store.splice(self.store.get_n_items(), 0, new_items)
+
+    def filter(self, query):
+        "Shows only the keys matching query, or all keys if it is empty"
+        self.query = query.strip()
+        if self.query:
+            items = [self.items[i] for i in self.index.search(self.query)]
+            self.placeholder.set_text(_("No keys match your search"))
+        else:
+            items = self.items
+            self.placeholder.set_text(_("You don't have any OpenPGP keys"))
+        self.store.splice(0, self.store.get_n_items(), items)
+
+    def on_search_changed(self, searchentry):
+        self.filter(searchentry.get_text())
+
+    def on_listbox_key_press(self, listbox, event):
+        "Forwards typing in the list to the search entry"
+        handled = self.searchentry.handle_event(event)
+        if handled:
+            self.searchentry.grab_focus_without_selecting()
+        return handled
+
+    def on_load_chunk(self):
+        "Adds the next chunk of keys, returns False once all are there"
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            chunk = None
+        except Exception:
+            self.log.exception("Could not load keys")
+            chunk = None
+
+        if chunk is None:
+            self._loader = None
+            self.on_keys_loaded()
+            return False
+
+        self.log.debug("Adding %d keys", len(chunk))
+        self.add_keys(chunk)
+        return True
+
+    def on_keys_loaded(self):
+        self._chunks = None
+        self.keys_spinner.stop()
+        self.keys_spinner.hide()
+        self.placeholder.show()
+        if self.n_keys <= 0:
+            self.infobar.show()
+
+    def on_destroy(self, widget):
+        if self._loader:
+            GLib.source_remove(self._loader)
+            self._loader = None
 
 
     def on_row_activated(self, keylistwidget, row):
-        if row:
+        if isinstance(row, ListBoxRowWithKey):
             self.emit('key-activated', row.key)
 
     def on_row_selected(self, keylistwidget, row):
-        if row:
+        if isinstance(row, ListBoxRowWithKey):
             self.emit('key-selected', row.key)
 
 
@@ -175,7 +342,7 @@ class App(Gtk.Application):
         window.set_title("Key List")
 
         if not self.kpw:
-            self.kpw = KeyListWidget(get_usable_keys())
+            self.kpw = KeyListWidget(chunks=iter_usable_keys())
         self.kpw.connect('key-activated', self.on_key_activated)
         self.kpw.connect('key-selected', self.on_key_selected)
         window.add(self.kpw)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+#    Copyright 2018 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""Measures how the keyservers cope with many concurrent downloaders
+
+The server runs in this process on loopback, without Avahi.
+The clients run in worker processes, so that the thread count and
+the memory usage we report are those of the server.
+
+    python -m keysign.keyserverbench --server twisted -c 50 -n 20 key.asc
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import threading
+import time
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+from .Keyserver import KeyRequestHandlerBase, ThreadedKeyserver
+
+log = logging.getLogger(__name__)
+
+
+def proc_status():
+    "Returns the number of threads and the RSS in KB of this process"
+    threads = rss = None
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('Threads:'):
+                threads = int(line.split()[1])
+            elif line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+    return threads, rss
+
+
+class Sampler(threading.Thread):
+    """Records the maximum thread count and RSS while running
+
+    The threads counted are those in excess of baseline,
+    i.e. the threads which existed before the server started.
+    """
+    def __init__(self, interval=0.05, baseline=1):
+        super(Sampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.baseline = baseline
+        self.max_threads = 0
+        self.max_rss = 0
+        self.finished = threading.Event()
+
+    def sample(self):
+        threads, rss = proc_status()
+        # We do not want to count ourselves
+        self.max_threads = max(self.max_threads,
+                               threads - self.baseline - 1)
+        self.max_rss = max(self.max_rss, rss)
+
+    def run(self):
+        while not self.finished.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.sample()
+        self.finished.set()
+        self.join()
+
+
+def serve_threaded(keydata):
+    "Starts the threaded keyserver and returns (port, stop function)"
+    kd = keydata
+    class KeyRequestHandler(KeyRequestHandlerBase):
+        keydata = kd
+    httpd = ThreadedKeyserver(('', 0), KeyRequestHandler)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+
+    def stop():
+        httpd.shutdown()
+        httpd.server_close()
+
+    return httpd.socket.getsockname()[1], stop
+
+
+def serve_twisted(keydata):
+    "Starts the reactor's keyserver in a thread and returns (port, stop function)"
+    from twisted.internet import reactor
+    from .Keyserver import KeyServer
+
+    server = KeyServer(keydata, 'F' * 40, port=0, tries=1, publish=False)
+    started = threading.Event()
+    ports = []
+
+    def start():
+        ports.append(server.start())
+        started.set()
+
+    def stop():
+        reactor.callFromThread(server.stop)
+        reactor.callFromThread(reactor.stop)
+        t.join()
+
+    reactor.callWhenRunning(start)
+    t = threading.Thread(target=reactor.run,
+                         kwargs={'installSignalHandlers': False})
+    t.daemon = True
+    t.start()
+    started.wait()
+    return ports[0], stop
+
+
+SERVERS = {
+    'threaded': serve_threaded,
+    'twisted': serve_twisted,
+}
+
+
+def download(job):
+    """Downloads the key as often as requested
+
+    Returns a (latencies in seconds, number of errors) tuple.
+    """
+    port, requests, keepalive, size = job
+    latencies = []
+    errors = 0
+    conn = None
+    for i in range(requests):
+        start = time.time()
+        try:
+            if conn is None:
+                conn = HTTPConnection('127.0.0.1', port, timeout=30)
+            conn.request('GET', '/')
+            response = conn.getresponse()
+            body = response.read()
+            if response.status != 200 or len(body) != size:
+                errors += 1
+            if not keepalive or response.will_close:
+                conn.close()
+                conn = None
+        except Exception:
+            log.exception("Request failed")
+            errors += 1
+            conn = None
+        else:
+            latencies.append(time.time() - start)
+    if conn:
+        conn.close()
+    return latencies, errors
+
+
+def percentile(values, p):
+    "Returns the p-th percentile of the sorted values"
+    if not values:
+        return None
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def run(keydata, server='threaded', clients=10, requests=10, keepalive=True):
+    "Runs the benchmark and returns the results as a dictionary"
+    # The workers must be forked before the server threads exist
+    pool = multiprocessing.Pool(clients)
+    try:
+        # The pool has its own helper threads, which we do not count
+        sampler = Sampler(baseline=proc_status()[0])
+        port, stop = SERVERS[server](keydata)
+        sampler.start()
+        jobs = [(port, requests, keepalive, len(keydata))] * clients
+        start = time.time()
+        results = pool.map(download, jobs)
+        seconds = time.time() - start
+        sampler.stop()
+        stop()
+    finally:
+        pool.close()
+        pool.join()
+
+    latencies = sorted(l for ls, _ in results for l in ls)
+    errors = sum(e for _, e in results)
+    return {
+        'server': server,
+        'clients': clients,
+        'requests': requests,
+        'keepalive': keepalive,
+        'keysize': len(keydata),
+        'completed': len(latencies),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'req_per_sec': round(len(latencies) / seconds, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        'max_threads': sampler.max_threads,
+        'max_rss_kb': sampler.max_rss,
+        'python': platform.python_version(),
+        'time': int(time.time()),
+    }
+
+
+def main(args=sys.argv[1:]):
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the keyserver "
+        "on loopback with many concurrent clients")
+    parser.add_argument("file", nargs='?',
+        help="File with the key to serve; some random bytes otherwise")
+    parser.add_argument("-s", "--server", choices=sorted(SERVERS),
+        default='threaded', help="The keyserver implementation")
+    parser.add_argument("-c", "--clients", type=int, default=10,
+        help="Number of concurrent clients")
+    parser.add_argument("-n", "--requests", type=int, default=10,
+        help="Number of requests each client makes")
+    parser.add_argument("--no-keepalive", dest='keepalive',
+        action='store_false', help="Open a new connection for each request")
+    parser.add_argument("-o", "--output", type=argparse.FileType('a'),
+        help="Append the results as a JSON line to this file")
+    args = parser.parse_args(args)
+
+    if args.file:
+        with open(args.file, 'rb') as f:
+            keydata = f.read()
+    else:
+        keydata = os.urandom(4096)
+
+    results = run(keydata, args.server, args.clients, args.requests,
+                  args.keepalive)
+    print(json.dumps(results, sort_keys=True, indent=2))
+    if args.output:
+        args.output.write(json.dumps(results, sort_keys=True) + "\n")
+    return 1 if results['errors'] else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+            format='%(name)s (%(levelname)s): %(message)s')
+    sys.exit(main())
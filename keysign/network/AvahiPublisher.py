@@ -91,6 +91,20 @@ class AvahiPublisher:
                 self.service_txt)
         group.Commit()
 
+    def update_txt(self, service_txt):
+        '''Replaces the TXT record of the service, if it has been added'''
+        self.service_txt = avahi.dict_to_txt_array(service_txt)
+        if self.group is not None:
+            self.log.info("Updating service '%s' with txt '%s'",
+                self.service_name, service_txt)
+            self.group.UpdateServiceTxt(
+                avahi.IF_UNSPEC,    #interface
+                avahi.PROTO_UNSPEC, #protocol
+                dbus.UInt32 (0),    #flags
+                self.service_name, self.service_type,
+                self.domain,
+                self.service_txt)
+
     def remove_service(self):
         '''Publishes services to be removed with name, stype, and domain.'''
         self.log.info("Removing with fpr '%s'", self.service_txt)
@@ -116,6 +130,7 @@ class AvahiPublisher:
                 name = self.server.GetAlternativeServiceName(self.service_name)
                 self.log.warn("Service name collision, changing name to '%s'",
                     name)
+                self.service_name = name
                 self.remove_service()
                 self.add_service()
 
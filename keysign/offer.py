@@ -1,6 +1,8 @@
 import logging
 from twisted.internet.defer import inlineCallbacks, returnValue
 
+from .util import OfferPayload
+
 from .wormholeoffer import WormholeOffer
 from .avahioffer import AvahiHTTPOffer
 try:
@@ -12,8 +14,19 @@ log = logging.getLogger(__name__)
 
 
 class Offer:
-    def __init__(self, key, app_id=None, w_code=None):
+    """Offers a key via Avahi, and possibly via wormhole and Bluetooth
+
+    The MAC in the QR code is computed over the key data offered via
+    Avahi.  The receiver checks it on whatever transport it gets the
+    key from, so all transports must send the very same bytes.
+    We thus send the same armored export everywhere, because
+    wormhole and Bluetooth transfer text.  With minimal, that export
+    only has the self-signatures, which is all the receiver keeps.
+    The data is exported once and shared by all transports.
+    """
+    def __init__(self, key, app_id=None, w_code=None, minimal=True):
         self.key = key
+        self.payload = OfferPayload.from_key(key, minimal=minimal)
         self.app_id = app_id
         self.w_code = w_code
         self.w_offer = None
@@ -23,18 +36,18 @@ class Offer:
 
     @inlineCallbacks
     def allocate_code(self, worm=True):
-        self.a_offer = AvahiHTTPOffer(self.key)
+        self.a_offer = AvahiHTTPOffer(self.key, payload=self.payload)
         a_info = self.a_offer.start()
         code, a_data = a_info
         discovery_data = [a_data]
         if worm:
-            self.w_offer = WormholeOffer(self.key)
+            self.w_offer = WormholeOffer(self.key, payload=self.payload)
             w_info = yield self.w_offer.allocate_code()
             code, w_data = w_info
             if w_data:
                 discovery_data.append(w_data)
         if BluetoothOffer:
-            self.bt_offer = BluetoothOffer(self.key)
+            self.bt_offer = BluetoothOffer(self.key, payload=self.payload)
             self.b_data = yield self.bt_offer.allocate_code()
             if self.b_data:
                 discovery_data.append(self.b_data)
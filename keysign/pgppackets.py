@@ -0,0 +1,612 @@
+#!/usr/bin/env python
+#    Copyright 2018 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""Minimal handling of OpenPGP packets as defined in RFC 4880
+
+We do not intend to implement OpenPGP here.  GnuPG does that for us.
+But some operations, like splitting a key into its UIDs, are
+very expensive when done via GnuPG, because it requires us to
+create keyrings and to run edit sessions.  Those operations only
+shuffle packets around, so we do them here on the raw packets.
+Similarly, determining a key's fingerprint and UIDs does not
+require a keyring.
+
+We do not verify any signature here.  Whatever we parse is only
+used for display and for comparing fingerprints.  Anything that
+is not understood raises a ValueError so that callers can fall
+back to GnuPG.
+"""
+from __future__ import unicode_literals
+
+import base64
+from binascii import hexlify
+import codecs
+from collections import namedtuple
+import hashlib
+import logging
+
+from .gpgkey import Key, UID
+
+log = logging.getLogger(__name__)
+
+
+# RFC 4880, Section 4.3
+TAG_SIGNATURE = 2
+TAG_SECRET_KEY = 5
+TAG_PUBLIC_KEY = 6
+TAG_SECRET_SUBKEY = 7
+TAG_TRUST = 12
+TAG_UID = 13
+TAG_PUBLIC_SUBKEY = 14
+TAG_UAT = 17
+
+PRIMARY_KEY_TAGS = (TAG_PUBLIC_KEY, TAG_SECRET_KEY)
+SUBKEY_TAGS = (TAG_PUBLIC_SUBKEY, TAG_SECRET_SUBKEY)
+
+# RFC 4880, Section 5.2.1
+SIGTYPE_CERTIFICATIONS = (0x10, 0x11, 0x12, 0x13)
+SIGTYPE_DIRECT_KEY = 0x1F
+
+# RFC 4880, Section 5.2.3.1
+SUBPACKET_CREATION_TIME = 2
+SUBPACKET_KEY_EXPIRATION_TIME = 9
+SUBPACKET_ISSUER = 16
+SUBPACKET_PRIMARY_UID = 25
+SUBPACKET_ISSUER_FINGERPRINT = 33
+
+# The number of MPIs of the public key per algorithm, RFC 4880, Section 5.5.2
+PUBKEY_ALGO_MPIS = {
+    1: 2,   # RSA
+    2: 2,   # RSA Encrypt-Only
+    3: 2,   # RSA Sign-Only
+    16: 3,  # Elgamal
+    17: 4,  # DSA
+    20: 3,  # Elgamal (formerly sign and encrypt)
+}
+# RFC 6637 and the EdDSA draft: an OID followed by one MPI
+PUBKEY_ALGO_ECDH = 18
+PUBKEY_ALGO_ECDSA = 19
+PUBKEY_ALGO_EDDSA = 22
+
+ARMOR_BEGIN = b'-----BEGIN PGP '
+ARMOR_END = b'-----END PGP '
+
+
+class Packet(namedtuple("Packet", "tag offset body_offset end")):
+    """A packet's position in a buffer
+
+    We do not copy the packets' data but rather keep the offsets.
+    The full packet, i.e. including the header, is
+    buffer[offset:end], the body is buffer[body_offset:end].
+    """
+
+    def raw(self, data):
+        "Returns the full packet, including its header, from data"
+        return data[self.offset:self.end]
+
+    def body(self, data):
+        "Returns the packet's body from data"
+        return data[self.body_offset:self.end]
+
+
+def crc24(data):
+    "The checksum used in ASCII armor, RFC 4880, Section 6.1"
+    crc = 0xB704CE
+    for octet in bytearray(data):
+        crc ^= octet << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864CFB
+    return crc & 0xFFFFFF
+
+
+def ctb_tag(ctb):
+    "Returns the tag of a packet header's first octet, or None"
+    if not ctb & 0x80:
+        return None
+    return ctb & 0x3f if ctb & 0x40 else (ctb >> 2) & 0x0f
+
+
+def strip_preamble(data):
+    "Removes leading whitespace and a UTF-8 byte order mark"
+    data = data.lstrip()
+    if data.startswith(codecs.BOM_UTF8):
+        data = data[len(codecs.BOM_UTF8):].lstrip()
+    return data
+
+
+def is_armored(data):
+    """Returns whether data looks like ASCII armored OpenPGP data
+
+    Binary keys start with the header of a key packet.
+    Armored data may be preceded by arbitrary text.
+    """
+    data = strip_preamble(data)
+    return (bool(data) and ctb_tag(bytearray(data[:1])[0]) not in PRIMARY_KEY_TAGS
+            and ARMOR_BEGIN in data)
+
+
+def starts_with_text(data):
+    "Whether data starts with a UTF-8 character rather than a packet header"
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        # We may not have received the whole character yet
+        decoder.decode(bytes(data[:4]))
+    except UnicodeDecodeError as e:
+        return e.start > 0
+    return True
+
+
+def check_key_prefix(data, max_preamble=4096):
+    """Checks whether data may be the beginning of a key
+
+    This allows rejecting garbage before it has been received
+    completely.  Returns True if data starts like a key, and False
+    if more data is needed to tell.  A ValueError is raised if
+    data cannot be the beginning of a key.
+
+    Binary keys start with a key packet.  Anything else, including
+    non-ASCII text, may be the preamble of an armored key.
+    """
+    stripped = strip_preamble(bytes(data[:max_preamble + len(ARMOR_BEGIN)]))
+    if not stripped:
+        return False
+    tag = ctb_tag(bytearray(stripped[:1])[0])
+    if tag in PRIMARY_KEY_TAGS:
+        return True
+    if tag is not None and not starts_with_text(stripped):
+        raise ValueError("Data starts with a packet of tag %d "
+                         "rather than a key" % tag)
+    if ARMOR_BEGIN in stripped:
+        return True
+    if len(data) > max_preamble:
+        raise ValueError("No armor found in the first %d bytes" % max_preamble)
+    return False
+
+
+def dearmor(data):
+    """Returns the binary OpenPGP data of possibly armored data
+
+    If the data is not armored, it is returned as is.
+    Multiple armored blocks are concatenated.
+    A ValueError is raised if the armor is broken.
+    """
+    try:
+        # The armor is ASCII, but the text before it may not be
+        data = data.encode('utf-8')
+    except AttributeError:
+        # We are probably bytes already
+        pass
+
+    if not is_armored(data):
+        return bytes(data)
+
+    blocks = []
+    lines = iter(strip_preamble(data).splitlines())
+    for line in lines:
+        if not line.startswith(ARMOR_BEGIN):
+            continue
+        # Skip the armor headers, which end with an empty line
+        for line in lines:
+            if not line.strip():
+                break
+        body = []
+        checksum = None
+        for line in lines:
+            line = line.strip()
+            if line.startswith(ARMOR_END):
+                break
+            elif line.startswith(b'='):
+                checksum = line[1:]
+            else:
+                body.append(line)
+        else:
+            raise ValueError("Armored data is missing its END line")
+
+        try:
+            block = base64.b64decode(b''.join(body))
+        except (TypeError, ValueError) as e:
+            raise ValueError("Cannot decode armored data: %s" % e)
+        if checksum:
+            expected = bytearray(base64.b64decode(checksum))
+            expected = (expected[0] << 16) | (expected[1] << 8) | expected[2]
+            if crc24(block) != expected:
+                raise ValueError("Armor checksum mismatch")
+        blocks.append(block)
+
+    if not blocks:
+        raise ValueError("No armored block found")
+    return b''.join(blocks)
+
+
+def parse_header(data, offset):
+    """Parses the packet header at offset
+
+    Returns a tuple of the packet's tag, the offset of its body,
+    and the offset of its end.  Packets with partial body lengths
+    are rejected, because they must not occur in keys.
+    """
+    size = len(data)
+    ctb = data[offset]
+    if not ctb & 0x80:
+        raise ValueError("Invalid packet header %#x at %d" % (ctb, offset))
+
+    if ctb & 0x40:
+        # New format packet
+        tag = ctb & 0x3f
+        if offset + 1 >= size:
+            raise ValueError("Truncated packet header at %d" % offset)
+        o1 = data[offset + 1]
+        if o1 < 192:
+            body_offset = offset + 2
+            length = o1
+        elif o1 < 224:
+            if offset + 2 >= size:
+                raise ValueError("Truncated packet header at %d" % offset)
+            body_offset = offset + 3
+            length = ((o1 - 192) << 8) + data[offset + 2] + 192
+        elif o1 == 255:
+            body_offset = offset + 6
+            if body_offset > size:
+                raise ValueError("Truncated packet header at %d" % offset)
+            length = int_from_bytes(data[offset + 2:body_offset])
+        else:
+            raise ValueError("Partial body length for tag %d at %d" %
+                             (tag, offset))
+    else:
+        # Old format packet
+        tag = (ctb >> 2) & 0x0f
+        length_type = ctb & 0x03
+        if length_type == 3:
+            # Indeterminate length, i.e. until the end of the data
+            body_offset = offset + 1
+            length = size - body_offset
+        else:
+            length_octets = 1 << length_type
+            body_offset = offset + 1 + length_octets
+            if body_offset > size:
+                raise ValueError("Truncated packet header at %d" % offset)
+            length = int_from_bytes(data[offset + 1:body_offset])
+
+    end = body_offset + length
+    if end > size:
+        raise ValueError("Packet with tag %d at %d exceeds the data (%d > %d)"
+                         % (tag, offset, end, size))
+    return tag, body_offset, end
+
+
+def int_from_bytes(data):
+    "Returns the big endian integer of data"
+    value = 0
+    for octet in bytearray(data):
+        value = (value << 8) | octet
+    return value
+
+
+def iter_packets(data):
+    """Yields a Packet for each packet found in the binary data
+
+    The data is not copied.  You probably want to pass a memoryview
+    or bytes.  Use Packet.raw or Packet.body to get the actual bytes.
+    """
+    offset = 0
+    size = len(data)
+    while offset < size:
+        tag, body_offset, end = parse_header(data, offset)
+        yield Packet(tag, offset, body_offset, end)
+        offset = end
+
+
+def split_uids(keydata, certified_by=None, since=0):
+    """Splits a key into one transferable public key per UID
+
+    For each UID packet, in the order they appear in the key,
+    a key is returned which consists of the primary key,
+    its direct signatures, the UID with its signatures, and
+    all the subkeys with their signatures.  User attributes,
+    e.g. photos, are dropped.
+
+    This is what GnuPG would produce if you deleted all but one
+    UID in an edit session.  But it's much cheaper.
+
+    If certified_by, a collection of fingerprints, is given, we only
+    keep the UIDs' self-signatures and the certifications which these
+    keys have made at or after since.  We then also leave out the
+    direct signatures and the subkeys.  That is all the owner of
+    the key needs to import the new certifications.
+
+    A ValueError is raised if keydata does not contain exactly one key.
+    """
+    data = memoryview(dearmor(keydata))
+
+    primary = []
+    uids = []
+    subkeys = []
+    current = None
+    for packet in iter_packets(data):
+        tag = packet.tag
+        if tag in PRIMARY_KEY_TAGS:
+            if primary:
+                raise ValueError("Expected exactly one key, "
+                                 "but found another one at %d" % packet.offset)
+            current = primary
+        elif current is None:
+            raise ValueError("Expected a key packet, but got tag %d" % tag)
+        elif tag == TAG_UID:
+            current = []
+            uids.append(current)
+        elif tag == TAG_UAT:
+            # We neither want the attribute nor its signatures
+            current = []
+            continue
+        elif tag in SUBKEY_TAGS:
+            current = subkeys
+        elif tag == TAG_TRUST:
+            # These are local to a keyring and should not travel
+            continue
+        current.append(packet)
+
+    if not primary:
+        raise ValueError("Expected exactly one key, but found none")
+
+    def join(packets):
+        return b''.join(p.raw(data).tobytes() for p in packets)
+
+    if certified_by is not None:
+        primary_fpr = fingerprint(primary[0].body(data))
+        issuers = set(certified_by) | {primary_fpr}
+
+        def is_wanted(packet):
+            if packet.tag != TAG_SIGNATURE:
+                return True
+            sig = parse_signature(packet.body(data))
+            if any(sig.is_issued_by(fpr) for fpr in issuers):
+                return sig.is_issued_by(primary_fpr) or sig.created >= since
+            return False
+
+        primary = primary[:1]
+        uids = [list(filter(is_wanted, uid)) for uid in uids]
+        subkeys = []
+
+    head = join(primary)
+    tail = join(subkeys)
+    log.debug("Splitting key into %d UIDs", len(uids))
+    return [head + join(uid) + tail for uid in uids]
+
+
+def split_keys(keydata):
+    """Splits a bundle of keys, e.g. an exported keyring, into single keys
+
+    Each key is returned as binary data.  Trust packets are dropped.
+    """
+    data = memoryview(dearmor(keydata))
+
+    keys = []
+    for packet in iter_packets(data):
+        tag = packet.tag
+        if tag in PRIMARY_KEY_TAGS:
+            keys.append([])
+        elif not keys:
+            raise ValueError("Expected a key packet, but got tag %d" % tag)
+        elif tag == TAG_TRUST:
+            continue
+        keys[-1].append(packet)
+
+    return [b''.join(p.raw(data).tobytes() for p in packets)
+            for packets in keys]
+
+
+def _skip_mpi(body, offset):
+    bits = (body[offset] << 8) | body[offset + 1]
+    return offset + 2 + (bits + 7) // 8
+
+
+def public_key_length(body):
+    """Returns the length of the public part of a v4 key packet's body
+
+    For public keys, that is the full body.  For secret keys,
+    the secret material follows.
+    """
+    version = body[0]
+    if version != 4:
+        raise ValueError("Unsupported key version %d" % version)
+    algo = body[5]
+    offset = 6
+    if algo in PUBKEY_ALGO_MPIS:
+        for _ in range(PUBKEY_ALGO_MPIS[algo]):
+            offset = _skip_mpi(body, offset)
+    elif algo in (PUBKEY_ALGO_ECDH, PUBKEY_ALGO_ECDSA, PUBKEY_ALGO_EDDSA):
+        # The curve's OID is prefixed with its length
+        offset += 1 + body[offset]
+        offset = _skip_mpi(body, offset)
+        if algo == PUBKEY_ALGO_ECDH:
+            # The KDF parameters
+            offset += 1 + body[offset]
+    else:
+        raise ValueError("Unsupported public key algorithm %d" % algo)
+
+    if offset > len(body):
+        raise ValueError("Key packet is too short for algorithm %d" % algo)
+    return offset
+
+
+def fingerprint(body):
+    "Returns the v4 fingerprint of a key packet's body, RFC 4880, 12.2"
+    length = public_key_length(body)
+    sha1 = hashlib.sha1()
+    sha1.update(bytearray((0x99, length >> 8, length & 0xff)))
+    sha1.update(body[:length])
+    return sha1.hexdigest().upper()
+
+
+class Signature(namedtuple("Signature",
+        "sigtype created issuer issuer_fpr key_expiration primary_uid")):
+    "The parts of a signature packet we care about"
+
+    def is_issued_by(self, fpr):
+        if self.issuer_fpr:
+            return self.issuer_fpr == fpr
+        return bool(self.issuer) and fpr.endswith(self.issuer)
+
+
+def iter_subpackets(data):
+    "Yields the type and the body of each signature subpacket in data"
+    offset = 0
+    size = len(data)
+    while offset < size:
+        o1 = data[offset]
+        if o1 < 192:
+            length = o1
+            offset += 1
+        elif o1 < 255:
+            length = ((o1 - 192) << 8) + data[offset + 1] + 192
+            offset += 2
+        else:
+            length = int_from_bytes(data[offset + 1:offset + 5])
+            offset += 5
+        if length < 1 or offset + length > size:
+            raise ValueError("Invalid subpacket length %d" % length)
+        # The highest bit is the "critical" flag
+        subtype = data[offset] & 0x7f
+        yield subtype, data[offset + 1:offset + length]
+        offset += length
+
+
+def parse_signature(body):
+    "Returns a Signature for a signature packet's body"
+    version = body[0]
+    if version in (2, 3):
+        # RFC 4880, Section 5.2.2: the hashed material has a fixed size
+        return Signature(sigtype=body[2],
+                         created=int_from_bytes(body[3:7]),
+                         issuer=hexlify(body[7:15].tobytes()).decode('ascii').upper(),
+                         issuer_fpr=None,
+                         key_expiration=None,
+                         primary_uid=False)
+    elif version != 4:
+        raise ValueError("Unsupported signature version %d" % version)
+
+    sigtype = body[1]
+    hashed_end = 6 + int_from_bytes(body[4:6])
+    unhashed_end = hashed_end + 2 + int_from_bytes(body[hashed_end:hashed_end + 2])
+    if unhashed_end > len(body):
+        raise ValueError("Signature subpackets exceed the packet")
+
+    values = {}
+    for subtype, value in iter_subpackets(body[6:hashed_end]):
+        values[subtype] = value
+    # The unhashed area is not protected by the signature, so we
+    # only take the hints for finding the issuer from there.
+    for subtype, value in iter_subpackets(body[hashed_end + 2:unhashed_end]):
+        if subtype in (SUBPACKET_ISSUER, SUBPACKET_ISSUER_FINGERPRINT):
+            values.setdefault(subtype, value)
+
+    def hexvalue(subtype, skip=0):
+        value = values.get(subtype)
+        if value is None:
+            return None
+        return hexlify(value[skip:].tobytes()).decode('ascii').upper()
+
+    created = values.get(SUBPACKET_CREATION_TIME)
+    expiration = values.get(SUBPACKET_KEY_EXPIRATION_TIME)
+    primary = values.get(SUBPACKET_PRIMARY_UID)
+    return Signature(sigtype=sigtype,
+                     created=int_from_bytes(created) if created else 0,
+                     issuer=hexvalue(SUBPACKET_ISSUER),
+                     # The first octet is the key's version
+                     issuer_fpr=hexvalue(SUBPACKET_ISSUER_FINGERPRINT, skip=1),
+                     key_expiration=(int_from_bytes(expiration)
+                                     if expiration is not None else None),
+                     primary_uid=bool(primary and primary[0]))
+
+
+def parse_key(keydata):
+    """Returns a gpgkey.Key for the single key in keydata
+
+    Only UIDs with a certification issued by the key itself are
+    considered.  Note that we only compare the issuer and do not
+    verify the signatures, so a UID with a forged issuer is listed
+    here, while GnuPG would drop it on import.  The fingerprint can
+    be relied upon, the UIDs cannot.  The expiry is taken from
+    the most recent self-signature, preferring direct key signatures
+    and the primary UID as GnuPG does.
+
+    A ValueError is raised if the key cannot be parsed.  That
+    includes v3 keys, unknown algorithms, and data which does
+    not contain exactly one key.
+    """
+    data = memoryview(dearmor(keydata))
+    fpr = None
+    created = None
+    direct_sigs = []
+    uids = []
+    current = None
+    try:
+        for packet in iter_packets(data):
+            tag = packet.tag
+            if tag in PRIMARY_KEY_TAGS:
+                if fpr:
+                    raise ValueError("Expected exactly one key, "
+                                     "but found another one at %d" % packet.offset)
+                body = packet.body(data)
+                fpr = fingerprint(body)
+                created = int_from_bytes(body[1:5])
+                current = direct_sigs
+            elif fpr is None:
+                raise ValueError("Expected a key packet, but got tag %d" % tag)
+            elif tag == TAG_UID:
+                current = []
+                uids.append((packet.body(data).tobytes(), current))
+            elif tag in SUBKEY_TAGS or tag == TAG_UAT:
+                current = None
+            elif tag == TAG_SIGNATURE and current is not None:
+                sig = parse_signature(packet.body(data))
+                if sig.is_issued_by(fpr):
+                    current.append(sig)
+    except IndexError:
+        raise ValueError("Truncated packet")
+
+    if fpr is None:
+        raise ValueError("Expected exactly one key, but found none")
+
+    def latest(sigs, sigtypes):
+        sigs = [s for s in sigs if s.sigtype in sigtypes]
+        return max(sigs, key=lambda s: s.created) if sigs else None
+
+    uidslist = []
+    uid_sigs = []
+    for uid, sigs in uids:
+        selfsig = latest(sigs, SIGTYPE_CERTIFICATIONS)
+        if selfsig:
+            uidslist.append(UID.from_bytes(uid))
+            uid_sigs.append(selfsig)
+    if not uidslist:
+        raise ValueError("Key %s has no self-signed UID" % fpr)
+
+    expiration = None
+    direct_sig = latest(direct_sigs, (SIGTYPE_DIRECT_KEY,))
+    if direct_sig:
+        expiration = direct_sig.key_expiration
+    if expiration is None:
+        primary = [s for s in uid_sigs if s.primary_uid] or uid_sigs
+        expiration = latest(primary, SIGTYPE_CERTIFICATIONS).key_expiration
+    # Like gpgme, we use 0 for keys that do not expire
+    expiry = created + expiration if expiration else 0
+
+    log.debug("Parsed key %s with %d UIDs", fpr, len(uidslist))
+    return Key(expiry, fpr, uidslist)
@@ -16,12 +16,14 @@
 #    You should have received a copy of the GNU General Public License
 #    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
 
+import atexit
 import logging
 import re
 import os
 import signal
 import sys
 from textwrap import dedent
+import threading
 
 import gi
 gi.require_version('Gtk', '3.0')
@@ -51,11 +53,13 @@ if  __name__ == "__main__" and __package__ is None:
 from .avahidiscovery import AvahiKeysignDiscoveryWithMac
 from .discover import Discover
 from .errors import NoBluezDbus, UnpoweredAdapter, NoAdapter
-from .gpgmh import openpgpkey_from_data
+from .errors import SigningCancelled
+from .gpgmh import openpgpkey_from_data, sign_keydata_and_encrypt
+from .gpgmh import SigningSession
 from .i18n import _
 from .keyfprscan import KeyFprScanWidget
 from .keyconfirm import PreSignWidget
-from .util import sign_keydata_and_send, fix_infobar, get_local_bt_address
+from .util import send_signed_uids, fix_infobar, get_local_bt_address
 
 log = logging.getLogger(__name__)
 
@@ -105,10 +109,15 @@ class ReceiveApp:
         self.scanner = scanner
         self.stack = receive_stack
 
-        self.discovery = AvahiKeysignDiscoveryWithMac()
+        # We download the advertised keys as soon as we see them,
+        # so that the key is ready when the code has been scanned
+        self.discovery = AvahiKeysignDiscoveryWithMac(prefetch=True)
         ib = builder.get_object('infobar_discovery')
         fix_infobar(ib)
         self.discovery.connect('list-changed', self.on_list_changed, ib)
+        # The reactor waits for the kept connections to be closed
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      self.discovery.stop)
 
         self.discover = None
         self.rb = builder.get_object('box50')
@@ -122,6 +131,12 @@ class ReceiveApp:
 
         self.bt_usable = False
 
+        # We sign all keys of the party in the same signing keyring
+        self.signing_session = SigningSession()
+        atexit.register(self.signing_session.close)
+        # Set to cancel the signing currently in progress
+        self.signing_cancelled = None
+
         # We call this in async because it can take several seconds to complete and we don't want
         # to stall the UI boot. Also we don't care about having this information immediately.
         threads.deferToThread(self.check_bt_availability)
@@ -151,10 +166,12 @@ class ReceiveApp:
             log.debug("Bluetooth adapter is turned off: %s", e)
 
     def on_keydata_downloaded(self, keydata, pixbuf=None):
-        key = openpgpkey_from_data(keydata)
+        # We show the UIDs, so we want those that GnuPG accepts
+        key = openpgpkey_from_data(keydata, verified=True)
         psw = PreSignWidget(key, pixbuf)
         psw.connect('sign-key-confirmed',
             self.on_sign_key_confirmed, keydata)
+        psw.connect('sign-key-cancelled', self.on_sign_key_cancelled)
         self.stack.add_titled(psw, "presign", _("Sign Key"))
         psw.set_name("presign")
         psw.show()
@@ -197,12 +214,48 @@ class ReceiveApp:
         else:
             self.on_message_received(key_data, success, message)
 
+    def sign_keydata(self, keydata, progress_cb, cancelled):
+        "Signs and encrypts the UIDs. This runs in a thread."
+        try:
+            keydata = keydata.encode()
+        except AttributeError:
+            log.debug("keydata is probably already a bytes type")
+        return list(sign_keydata_and_encrypt(keydata,
+            session=self.signing_session,
+            progress_cb=progress_cb, cancel=cancelled))
+
+    @inlineCallbacks
     def on_sign_key_confirmed(self, keyPreSignWidget, key, keydata):
         self.log.debug ("Sign key confirmed! %r", key)
+        psw = keyPreSignWidget
+
+        def progress_cb(done, total, uid):
+            reactor.callFromThread(psw.emit, 'signing-progress',
+                                   done, total, uid)
+
+        cancelled = threading.Event()
+        self.signing_cancelled = cancelled
+        psw.signing_started()
+        # gpgme takes seconds to sign and encrypt,
+        # so we keep it away from the main loop.
+        try:
+            signed_uids = yield threads.deferToThread(self.sign_keydata,
+                keydata, progress_cb, cancelled)
+        except SigningCancelled:
+            log.info("Signing %s has been cancelled", key.fingerprint)
+            return
+        except Exception:
+            log.exception("Could not sign %s", key.fingerprint)
+            return
+        finally:
+            psw.signing_finished()
+            if self.signing_cancelled is cancelled:
+                self.signing_cancelled = None
+
         # We need to prevent tmpfiles from going out of
-        # scope too early so that they don't get deleted
-        self.tmpfiles = list(
-            sign_keydata_and_send(keydata))
+        # scope too early so that they don't get deleted.
+        # The mail client is spawned from the main loop.
+        self.tmpfiles = list(send_signed_uids(key.fingerprint, signed_uids))
 
         # After the user has signed, we switch back to the scanner,
         # because currently, there is not much to do on the
@@ -211,6 +264,11 @@ class ReceiveApp:
         self.stack.set_visible_child_name("scanner")
         # Do we also want to add an infobar message or so..?
 
+    def on_sign_key_cancelled(self, keyPreSignWidget, key):
+        self.log.debug("Sign key cancelled: %r", key)
+        if self.signing_cancelled:
+            self.signing_cancelled.set()
+
     def on_list_changed(self, discovery, number, userdata):
         """We show an infobar if we can only receive with Avahi and
         there are zero nearby servers"""
@@ -64,8 +64,9 @@ class SendApp:
         if not builder:
             builder = Gtk.Builder()
             builder.add_objects_from_file(ui_file_path, ["send_stack"])
-        keys = gpgmh.get_usable_secret_keys()
-        klw = KeyListWidget(keys, builder=builder)
+        # The keys are added while the keyring is being walked
+        chunks = gpgmh.iter_usable_secret_keys()
+        klw = KeyListWidget(chunks=chunks, builder=builder)
         klw.connect("key-activated", self.on_key_activated)
         self.klw = klw
 
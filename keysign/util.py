@@ -17,6 +17,7 @@
 #    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
 
+from collections import namedtuple
 import hashlib
 import hmac
 import json
@@ -38,6 +39,12 @@ except ImportError:
     from urllib2 import quote
 
 import requests
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import Protocol
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone
+from twisted.web.error import Error as WebError
+from twisted.web.http import PotentialDataLoss
+from twisted.web.iweb import UNKNOWN_LENGTH
 import dbus
 from wormhole._wordlist import PGPWordList
 from _dbus_bindings import BUS_DAEMON_NAME, BUS_DAEMON_PATH, BUS_DAEMON_IFACE
@@ -47,9 +54,12 @@ gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, Gdk, GLib
 
 from .errors import NoBluezDbus, UnpoweredAdapter, NoAdapter
+from .errors import KeyDataRejected
 from .gpgmh import fingerprint_from_keydata
+from .gpgmh import get_public_key_data
 from .gpgmh import sign_keydata_and_encrypt
 from .i18n import _
+from .ingest import KeyBuffer
 
 log = logging.getLogger(__name__)
 
@@ -69,6 +79,22 @@ def mac_verify(key, data, mac):
     return result
 
 
+class OfferPayload(namedtuple("OfferPayload", "fingerprint keydata text mac")):
+    """The key data of an offer, prepared once for all transports
+
+    keydata holds the armored key as bytes and text holds the same
+    as a string.  mac is computed over keydata.
+    """
+
+    @classmethod
+    def from_key(cls, key, minimal=True, homedir=None):
+        fingerprint = key.fingerprint
+        keydata = get_public_key_data(fingerprint, homedir=homedir,
+                                      minimal=minimal)
+        mac = mac_generate(fingerprint.encode('ascii'), keydata)
+        return cls(fingerprint, keydata, keydata.decode('utf-8'), mac)
+
+
 def _email_portal(to, subject=None, body=None, files=None):
     # The following checks are to ensure Python 2 compatibility
     if not hasattr(os, 'O_PATH'):
@@ -234,11 +260,12 @@ GNOME Keysign
 ''')
 
 
-def sign_keydata_and_send(keydata, error_cb=None):
+def sign_keydata_and_send(keydata, error_cb=None, session=None):
     """Creates, encrypts, and send signatures for each UID on the key
     
     You are supposed to give OpenPGP data which will be passed
-    onto sign_keydata_and_encrypt.
+    onto sign_keydata_and_encrypt.  If you sign several keys,
+    pass a gpgmh.SigningSession to reuse its signing keyring.
     
     For the resulting signatures, emails are created and
     sent via send_email.
@@ -250,8 +277,6 @@ def sign_keydata_and_send(keydata, error_cb=None):
     log = logging.getLogger(__name__ + ':sign_keydata')
 
     fingerprint = fingerprint_from_keydata(keydata)
-    # FIXME: We should rather use whatever GnuPG tells us
-    keyid = fingerprint[-8:]
     # We list() the signatures, because we believe that it's more
     # acceptable if all key operations are done before we go ahead
     # and spawn an email client.
@@ -261,7 +286,22 @@ def sign_keydata_and_send(keydata, error_cb=None):
     except AttributeError:
         log.debug("keydata is probably already a bytes type")
 
-    for uid, encrypted_key in list(sign_keydata_and_encrypt(keydata, error_cb)):
+    signed_uids = list(sign_keydata_and_encrypt(keydata, error_cb,
+                                                session=session))
+    for tmpfile in send_signed_uids(fingerprint, signed_uids):
+        yield tmpfile
+
+
+def send_signed_uids(fingerprint, signed_uids):
+    """Sends an email for each (UID, encrypted signature) in signed_uids
+
+    Yields the NamedTemporaryFiles holding the signatures,
+    see sign_keydata_and_send.
+    """
+    log = logging.getLogger(__name__ + ':sign_keydata')
+    # FIXME: We should rather use whatever GnuPG tells us
+    keyid = fingerprint[-8:]
+    for uid, encrypted_key in signed_uids:
         log.info("Using UID: %r", uid)
         # We expect uid.uid to be a consumable string
         uid_str = uid.uid
@@ -309,6 +349,38 @@ def format_fingerprint(fpr):
     return s
 
 
+# A TXT string must not exceed 255 bytes, so we advertise
+# the key IDs of the served keys in chunks of at most this many.
+KEYIDS_PER_TXT = 14
+
+def format_keys_txt(fingerprints):
+    """Returns the TXT record entries advertising the given keys
+
+    We cannot afford full fingerprints, so the 64bit key IDs
+    are put into keys0, keys1, ... entries, comma separated.
+    """
+    keyids = [fpr[-16:].upper() for fpr in fingerprints]
+    txt = {}
+    for i in range(0, len(keyids), KEYIDS_PER_TXT):
+        chunk = keyids[i:i+KEYIDS_PER_TXT]
+        txt['keys%d' % (i // KEYIDS_PER_TXT)] = ','.join(chunk)
+    return txt
+
+
+def parse_keys_txt(txt_dict):
+    """Returns the set of key IDs advertised by format_keys_txt
+
+    None is returned if the service does not advertise any,
+    i.e. it is an older one serving a single key on /.
+    """
+    keyids = set()
+    i = 0
+    while 'keys%d' % i in txt_dict:
+        keyids.update(k.upper() for k in txt_dict['keys%d' % i].split(',') if k)
+        i += 1
+    return keyids if i else None
+
+
 
 
 def parse_barcode(barcode_string):
@@ -356,21 +428,138 @@ def strip_fingerprint(input_string):
 
 
 
-def download_key_http(address, port):
+def download_key_http(address, port, fingerprint=None):
+    """Downloads the key from the given keyserver
+
+    If a fingerprint is given, the key is requested by its
+    fingerprint, which is necessary for servers offering many keys.
+    """
     url = ParseResult(
         scheme='http',
         # This seems to work well enough with both IPv6 and IPv4
         netloc="[[%s]]:%d" % (address, port),
-        path='/',
+        path='/keys/%s' % fingerprint if fingerprint else '/',
         params='',
         query='',
         fragment='')
     log.debug("Starting HTTP request")
-    data = requests.get(url.geturl(), timeout=5).content
+    response = requests.get(url.geturl(), timeout=5, stream=True)
+    try:
+        # A server offering many keys may not have the one we want
+        response.raise_for_status()
+        length = response.headers.get('Content-Length')
+        buf = KeyBuffer('http',
+                        expected_size=int(length) if length else None)
+        for chunk in response.iter_content(chunk_size=16 * 1024):
+            buf.write(chunk)
+        data = buf.getvalue()
+    finally:
+        response.close()
     log.debug("finished downloading %d bytes", len(data))
     return data
 
 
+def key_url(address, port, fingerprint=None):
+    "Returns the URL of the key on the given keyserver"
+    if ':' in address:
+        address = '[%s]' % address
+    path = '/keys/%s' % fingerprint if fingerprint else '/'
+    return 'http://%s:%d%s' % (address, port, path)
+
+
+class KeyBufferProtocol(Protocol):
+    """Receives an HTTP response body into a KeyBuffer
+
+    finished fires with the data, or fails with KeyDataRejected as
+    soon as the KeyBuffer rejects the data.
+    """
+    def __init__(self, buf):
+        self.buf = buf
+        self.finished = Deferred(lambda d: self.transport.stopProducing())
+        self.error = None
+
+    def dataReceived(self, data):
+        if self.error:
+            return
+        try:
+            self.buf.write(data)
+        except KeyDataRejected as e:
+            self.error = e
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        if self.error:
+            self.finished.errback(self.error)
+        elif reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(self.buf.getvalue())
+        else:
+            self.finished.errback(reason)
+
+
+class HTTPKeyDownloader(object):
+    """Downloads keys over HTTP from the reactor
+
+    Connections to a keyserver are kept open and reused for later
+    downloads.  Cancelling a download's Deferred aborts the request.
+    """
+    def __init__(self, timeout=5, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.timeout = timeout
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.agent = Agent(reactor, connectTimeout=timeout, pool=self.pool)
+        self.pending = set()
+
+    def download(self, address, port, fingerprint=None):
+        """Returns a Deferred firing with the key from the keyserver
+
+        Like download_key_http, but without blocking.
+        """
+        url = key_url(address, port, fingerprint)
+        log.debug("Starting HTTP request for %s", url)
+        d = self.agent.request(b'GET', url.encode('ascii'))
+        d.addCallback(self.read_response, url)
+        d.addTimeout(self.timeout, self.reactor)
+        self.pending.add(d)
+        def done(result):
+            self.pending.discard(d)
+            return result
+        d.addBoth(done)
+        return d
+
+    def read_response(self, response, url):
+        # A server offering many keys may not have the one we want
+        if response.code != 200:
+            response.deliverBody(Protocol())
+            raise WebError(response.code, response.phrase)
+        length = None if response.length == UNKNOWN_LENGTH else response.length
+        try:
+            buf = KeyBuffer('http', expected_size=length)
+        except KeyDataRejected:
+            response.deliverBody(Protocol())
+            raise
+        protocol = KeyBufferProtocol(buf)
+        response.deliverBody(protocol)
+        def log_size(data):
+            log.debug("finished downloading %d bytes from %s", len(data), url)
+            return data
+        protocol.finished.addCallback(log_size)
+        return protocol.finished
+
+    def cancel(self):
+        "Cancels all pending downloads"
+        for d in list(self.pending):
+            d.cancel()
+
+    def close(self):
+        "Cancels all pending downloads and closes the kept connections"
+        self.cancel()
+        return self.pool.closeCachedConnections()
+
+
 def encode_message(message):
     """Serialize a string to json object and encode it in utf-8"""
     return json.dumps(message).encode("utf-8")
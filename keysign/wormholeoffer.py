@@ -44,16 +44,19 @@ if __name__ == "__main__" and __package__ is None:
     os.sys.path.insert(0, os.path.join(parent_dir, 'monkeysign'))
     __package__ = str('keysign')
 
-from .gpgmh import get_usable_keys, get_public_key_data
-from .util import encode_message, decode_message
+from .gpgmh import get_usable_keys
+from .util import encode_message, decode_message, OfferPayload
 
 log = logging.getLogger(__name__)
 
 
 class WormholeOffer:
-    def __init__(self, key, app_id=None):
+    def __init__(self, key, app_id=None, minimal=True, payload=None):
         self.message_def = None
         self.key = key
+        if payload is None:
+            payload = OfferPayload.from_key(key, minimal=minimal)
+        self.payload = payload
         if not app_id:
             # the following id is needed for interoperability with wormhole cli
             app_id = "lothar.com/wormhole/text-or-file-xfer"
@@ -80,11 +83,9 @@ class WormholeOffer:
             ver_ascii = hexlify(verifier).decode("ascii")
             log.info("Verified key: %s", ver_ascii)
 
-            key_data = get_public_key_data(self.key.fingerprint)
-            kd_decoded = key_data.decode('utf-8')
             # The message needs to be encoded as a json with "message" and "offer" for ensures
             # wormhole cli interoperability
-            offer = {"message": kd_decoded}
+            offer = {"message": self.payload.text}
             data = {"offer": offer}
             m = encode_message(data)
             self.w.send_message(m)
@@ -32,7 +32,9 @@ if __name__ == "__main__":
 from twisted.internet import reactor
 
 from .gpgmh import fingerprint_from_keydata
+from .errors import KeyDataRejected
 from .i18n import _
+from .ingest import KeyBuffer
 from .util import decode_message, encode_message, parse_barcode, mac_verify
 
 log = logging.getLogger(__name__)
@@ -65,6 +67,13 @@ class WormholeReceive:
 
         try:
             message = yield self.w.get_message()
+            # Only now, so that waiting for the peer is not counted
+            buf = KeyBuffer('wormhole')
+            # The wormhole hands us the message as a whole, but we can
+            # at least refuse to decode a huge one.
+            if len(message) > 2 * buf.max_size:
+                buf.reject("wormhole sent %d bytes" % len(message),
+                           len(message))
             m = decode_message(message)
             key_data = None
             offer = m.get("offer", None)
@@ -72,7 +81,9 @@ class WormholeReceive:
                 key_data = offer.get("message", None)
             if key_data:
                 log.info("Message received: %s", key_data)
-                if self._is_verified(key_data.encode("utf-8")):
+                buf.write(key_data.encode("utf-8"))
+                key_data = buf.getvalue()
+                if self._is_verified(key_data):
                     log.debug("MAC is valid")
                     success = True
                     message = ""
@@ -80,7 +91,7 @@ class WormholeReceive:
                     reply = {"answer": {"message_ack": "ok"}}
                     reply_encoded = encode_message(reply)
                     self.w.send_message(reply_encoded)
-                    returnValue((key_data.encode("utf-8"), success, message))
+                    returnValue((key_data, success, message))
                 else:
                     log.warning("The received key has a different MAC")
                     self._reply_error(_("Wrong message authentication code"))
@@ -95,6 +106,9 @@ class WormholeReceive:
         except LonelyError as le:
             log.info("Closed the connection before we found anyone")
             self._handle_failure(le)
+        except KeyDataRejected as kdr:
+            self._reply_error(_("The key has been rejected"))
+            self._handle_failure(kdr)
 
     def _is_verified(self, key_data):
         if self.mac is None:
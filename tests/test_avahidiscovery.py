@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+#    Copyright 2018 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+from threading import Thread
+
+from nose.tools import *
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+
+from keysign.avahidiscovery import AvahiKeysignDiscovery, DiscoveredServices
+from keysign.avahidiscovery import KeyPrefetcher, race_downloads
+from keysign.Keyserver import KeyRequestHandlerBase, ThreadedKeyserver
+
+
+log = logging.getLogger(__name__)
+thisdir = os.path.dirname(os.path.realpath(__file__))
+
+FPR1 = "ADAB7FCC1F4DE2616ECFA402AF82244F9CD9FD55"
+FPR2 = "A297884664E12AB20F00DFC0A7109A46E21E1C46"
+
+
+def read_fixture_file(fixture):
+    fname = os.path.join(thisdir, "fixtures", fixture)
+    data = open(fname, 'rb').read()
+    return data
+
+
+class FakeDownloader(object):
+    "Serves the keys by port after a second of the clock"
+    def __init__(self, clock, keys):
+        self.clock = clock
+        self.keys = keys
+        self.started = []
+        self.closed = False
+
+    def download(self, address, port, fingerprint=None):
+        self.started.append(port)
+        d = Deferred()
+        self.clock.callLater(1, d.callback, self.keys[port])
+        return d
+
+    def close(self):
+        self.closed = True
+        return succeed(None)
+
+
+class FakeBrowser(object):
+    def connect(self, signal, handler):
+        pass
+
+
+def test_discovered_services():
+    services = DiscoveredServices()
+    services.add("one", "192.168.1.2", 9001, FPR1.lower())
+    # The same service via IPv6
+    services.add("one", "2001:db8::2", 9001, FPR1)
+    services.add("many", "192.168.1.3", 9001, keyids={FPR2[-16:]})
+    assert_equal(len(services), 3)
+
+    assert_equal(sorted(s.address for s in services.find(FPR1)),
+                 ["192.168.1.2", "2001:db8::2"])
+    assert_equal([s.name for s in services.find(FPR2)], ["many"])
+    assert_equal([s.name for s in services.with_keyids()], ["many"])
+
+    # Seeing it again replaces the entry
+    services.add("one", "192.168.1.2", 9001, FPR1)
+    assert_equal(len(services), 3)
+
+    assert_equal(len(services.remove("one")), 2)
+    assert_equal(services.find(FPR1), [])
+    assert_equal(services.remove("one"), [])
+    assert_equal(len(services), 1)
+
+
+def test_discovered_services_ttl():
+    now = [1000]
+    services = DiscoveredServices(ttl=60, clock=lambda: now[0])
+    services.add("old", "192.168.1.2", 9001, FPR1)
+    now[0] += 30
+    services.add("new", "192.168.1.3", 9001, FPR1)
+    now[0] += 40
+    assert_equal([s.name for s in services.find(FPR1)], ["new"])
+    assert_equal(len(services), 1)
+
+
+def test_iter_candidates():
+    discovery = AvahiKeysignDiscovery(avahi_browser=FakeBrowser())
+    services = discovery.discovered_services
+    services.add("one", "192.168.1.2", 9001, FPR1)
+    services.add("many", "192.168.1.3", 9001, keyids={FPR2[-16:]})
+    services.add("others", "192.168.1.4", 9001, keyids={FPR1[-16:]})
+    assert_equal(list(discovery.iter_candidates(FPR2)),
+                 [("192.168.1.3", 9001, FPR2)])
+    # Services not advertising the key are not asked
+    assert_equal(sorted(discovery.iter_candidates(FPR1)),
+                 [("192.168.1.2", 9001, None), ("192.168.1.4", 9001, FPR1)])
+
+
+def test_race_downloads():
+    clock = Clock()
+    downloads = {}
+    def download(candidate):
+        downloads[candidate] = d = Deferred()
+        return d
+    result = race_downloads(["slow", "fast", "late"], download,
+                            lambda data: data == b"key", stagger=1,
+                            clock=clock)
+    assert_equal(list(downloads), ["slow"])
+    clock.advance(1)
+    assert_equal(sorted(downloads), ["fast", "slow"])
+    downloads["fast"].callback(b"key")
+    assert_equal(result.result, b"key")
+    # The loser has been cancelled and no other download started
+    assert_true(downloads["slow"].called)
+    clock.advance(1)
+    assert_equal(sorted(downloads), ["fast", "slow"])
+
+
+def test_race_downloads_failures():
+    clock = Clock()
+    started = []
+    def download(candidate):
+        started.append(candidate)
+        if candidate == "broken":
+            return fail(ValueError("broken"))
+        d = Deferred()
+        clock.callLater(0.5, d.callback, b"wrong")
+        return d
+    result = race_downloads(["broken", "wrong"], download,
+                            lambda data: data == b"key", clock=clock)
+    # A failure starts the next one right away
+    assert_equal(started, ["broken", "wrong"])
+    clock.advance(1)
+    assert_equal(result.result, None)
+
+
+def test_key_prefetcher():
+    clock = Clock()
+    data1 = read_fixture_file("pubkey-1.asc")
+    data2 = read_fixture_file("pubkey-2-uids.asc")
+    downloader = FakeDownloader(clock, {1: data1, 2: data2, 3: data1})
+    prefetcher = KeyPrefetcher(lambda c: downloader.download(*c),
+                               size=1, concurrency=1)
+    prefetcher.add(FPR1, ("192.168.1.2", 1, None))
+    # This one claims to be FPR2, but serves FPR1
+    prefetcher.add(FPR2, ("192.168.1.3", 3, None))
+    # Only one download runs at a time
+    assert_equal(downloader.started, [1])
+    clock.advance(1)
+    assert_equal(downloader.started, [1, 3])
+    clock.advance(1)
+    # The mismatching key is dropped
+    assert_equal(list(prefetcher.keys), [FPR1])
+    assert_equal(prefetcher.get(FPR1, lambda keydata: False), None)
+    assert_equal(prefetcher.get(FPR1, lambda keydata: True), data1)
+
+    # The least recently used key is evicted
+    fpr2 = "A2ECF6A72BCFD74F4165B389034094FB8FD495FB"
+    prefetcher.add(fpr2, ("192.168.1.4", 2, None))
+    clock.advance(1)
+    assert_equal(list(prefetcher.keys), [fpr2])
+
+
+def test_fetch_prefetched_key():
+    clock = Clock()
+    data = read_fixture_file("pubkey-1.asc")
+    verified = []
+    class Discovery(AvahiKeysignDiscovery):
+        def verify_key(self, keydata, userdata):
+            verified.append(keydata)
+            return super(Discovery, self).verify_key(keydata, userdata)
+    discovery = Discovery(prefetch=True, avahi_browser=FakeBrowser())
+    downloader = discovery.downloader = FakeDownloader(clock, {9001: data})
+    discovery.on_new_service(None, "one", "192.168.1.2", 9001,
+                             {'fingerprint': FPR1})
+    clock.advance(1)
+    assert_equal(downloader.started, [9001])
+
+    assert_equal(discovery.fetch_key("OPENPGP4FPR:" + FPR1).result, data)
+    assert_equal(verified, [data])
+    # No further download was necessary
+    assert_equal(downloader.started, [9001])
+
+    discovery.stop()
+    assert_true(downloader.closed)
+    assert_equal(discovery.downloader, None)
+
+
+def test_find_key_after_garbage():
+    data = read_fixture_file("pubkey-1.asc")
+    servers = []
+    # A signature packet rather than a key is rejected while downloading
+    for keydata in (b"\x88\x05garbage" * 10, data):
+        class KeyRequestHandler(KeyRequestHandlerBase):
+            pass
+        KeyRequestHandler.keydata = keydata
+        httpd = ThreadedKeyserver(('', 0), KeyRequestHandler)
+        t = Thread(target=httpd.serve_forever)
+        t.daemon = True
+        t.start()
+        servers.append(httpd)
+
+    class Discovery(AvahiKeysignDiscovery):
+        def iter_candidates(self, fpr):
+            # The one serving garbage comes first
+            for httpd in servers:
+                yield "127.0.0.1", httpd.socket.getsockname()[1], None
+    discovery = Discovery(avahi_browser=FakeBrowser())
+    try:
+        assert_equal(discovery.find_key("OPENPGP4FPR:" + FPR1), data)
+    finally:
+        for httpd in servers:
+            httpd.shutdown()
+            httpd.server_close()
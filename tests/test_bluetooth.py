@@ -17,8 +17,7 @@ try:
     HAVE_BT = True
 except ImportError:
     HAVE_BT = False
-from keysign.gpgmh import get_public_key_data, openpgpkey_from_data
-from keysign.util import mac_generate
+from keysign.gpgmh import openpgpkey_from_data
 
 
 log = logging.getLogger(__name__)
@@ -52,11 +51,11 @@ def test_bt():
     """This test requires two working Bluetooth devices"""
     data = read_fixture_file("seckey-no-pw-1.asc")
     key = openpgpkey_from_data(data)
-    file_key_data = get_public_key_data(key.fingerprint)
     log.info("Running with key %r", key)
-    hmac = mac_generate(key.fingerprint.encode('ascii'), file_key_data)
     # Start offering the key
     offer = BluetoothOffer(key)
+    file_key_data = offer.payload.keydata
+    hmac = offer.payload.mac
     data = yield offer.allocate_code()
     # getting the code from "BT=code;...."
     code = data.split("=", 1)[1]
@@ -126,8 +125,7 @@ def test_bt_corrupted_key():
                     # We are sure that a connection is available, so we can call
                     # accept() without deferring it to a thread
                     client_socket, address = bo.server_socket.accept()
-                    key_data = get_public_key_data(bo.key.fingerprint)
-                    kd_decoded = key_data.decode('utf-8')
+                    kd_decoded = bo.payload.text
                     # We send only a part of the key. In this way we can simulate the case
                     # where the connection has been lost
                     half = len(kd_decoded)/2
@@ -142,10 +140,9 @@ def test_bt_corrupted_key():
     data = read_fixture_file("seckey-no-pw-1.asc")
     key = openpgpkey_from_data(data)
     log.info("Running with key %r", key)
-    file_key_data = get_public_key_data(key.fingerprint)
-    hmac = mac_generate(key.fingerprint.encode('ascii'), file_key_data)
     # Start offering the key
     offer = BluetoothOffer(key)
+    hmac = offer.payload.mac
     data = yield offer.allocate_code()
     # getting the code from "BT=code;...."
     code = data.split("=", 1)[1]
@@ -17,9 +17,11 @@
 #    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import multiprocessing
 import os, sys
-from subprocess import CalledProcessError, check_call
+from subprocess import CalledProcessError, check_call, check_output
 import tempfile
+import threading
 import unittest
 
 from nose.tools import *
@@ -27,6 +29,10 @@ from nose.tools import *
 import gpg
 
 from keysign.gpgmeh import TempContext
+from keysign.gpgmeh import TempContextPool
+from keysign.gpgmeh import KeyDataCache
+from keysign.gpgmeh import GpgconfDirs
+from keysign.gpgmeh import KeyringSnapshot
 from keysign.gpgmeh import DirectoryContext
 from keysign.gpgmeh import UIDExport
 from keysign.gpgmeh import export_uids
@@ -34,10 +40,18 @@ from keysign.gpgmeh import fingerprint_from_keydata
 from keysign.gpgmeh import openpgpkey_from_data
 from keysign.gpgmeh import get_usable_keys
 from keysign.gpgmeh import get_usable_secret_keys
+from keysign.gpgmeh import iter_usable_keys
 from keysign.gpgmeh import get_public_key_data
 from keysign.gpgmeh import sign_keydata_and_encrypt
+from keysign.gpgmeh import SigningSession
+from keysign.gpgmeh import GenEdit
+from keysign.gpgmeh import sign_key
 from keysign.gpgmeh import crashing_gpgme
+from keysign.gpgmeh import minimise_key
+from keysign.gpgmeh import temp_context_pool
+from keysign.SignKey import init_session
 
+from keysign.errors import SigningCancelled
 from keysign.gpgkey import to_valid_utf8_string
 
 log = logging.getLogger(__name__)
@@ -233,6 +247,95 @@ def test_export_alpha_uids():
 
 
 
+def test_temp_context_pool():
+    data = read_fixture_file("pubkey-1.asc")
+    pool = TempContextPool(maxsize=1)
+    with pool.context() as ctx:
+        ctx.op_import(data)
+        assert_equals(1, len(list(ctx.keylist())))
+        homedir = ctx.homedir
+
+    with pool.context() as ctx:
+        # We expect the same, but wiped, homedir
+        assert_equals(homedir, ctx.homedir)
+        assert_equals(0, len(list(ctx.keylist())))
+        with pool.context() as other_ctx:
+            # The pool is empty now, so we get a new one
+            assert_not_equals(homedir, other_ctx.homedir)
+            other_homedir = other_ctx.homedir
+
+    assert_equals(1, pool.hits)
+    assert_equals(2, pool.misses)
+    # Only one context fits into the pool, the other one must be gone
+    assert_equals(1, len([d for d in (homedir, other_homedir)
+                          if os.path.exists(d)]))
+    pool.close()
+    assert_false(os.path.exists(homedir))
+    assert_false(os.path.exists(other_homedir))
+
+
+def minimise_in_worker(keydata):
+    "Returns the homedirs the worker's pool holds after minimising"
+    minimise_key(keydata)
+    return [ctx.homedir for ctx in temp_context_pool._free]
+
+
+def test_temp_context_pool_in_workers():
+    data = read_fixture_file("pubkey-1.asc")
+    pool = multiprocessing.Pool(1, initializer=init_session)
+    try:
+        homedirs = pool.apply(minimise_in_worker, (data,))
+    finally:
+        pool.close()
+        pool.join()
+    assert_equals(1, len(homedirs))
+    # The workers do not run atexit handlers, but must clean up anyway
+    assert_false(os.path.exists(homedirs[0]))
+
+
+def test_gpgconf_dirs():
+    dirs = GpgconfDirs()
+    for i in range(3):
+        homedir = tempfile.mkdtemp()
+        cmd = ["gpgconf", "--homedir", homedir, "--list-dirs", "agent-socket"]
+        expected = check_output(cmd).decode('utf-8').strip()
+        assert_equals(expected, dirs.get(homedir)['agent-socket'])
+        # The second time, we answer from the cache
+        assert_equals(expected, dirs.get(homedir)['agent-socket'])
+    assert_true(dirs.verified)
+    # Once for the default homedir and once for the verification
+    assert_equals(2, dirs.calls)
+    assert_equals(5, dirs.avoided)
+
+
+def test_keydata_cache():
+    data = read_fixture_file("pubkey-1.asc")
+    cache = KeyDataCache(maxsize=1)
+    key = cache.get(data)
+    assert_equals(key, cache.get(data))
+    # The digest does not care whether we pass text or bytes
+    assert_equals(key, cache.get(data.decode('ascii')))
+    assert_equals(2, cache.hits)
+    assert_equals(1, cache.misses)
+
+    # The first key is evicted
+    cache.get(read_fixture_file("pubkey-2-uids.asc"))
+    cache.get(data)
+    assert_equals(3, cache.misses)
+    assert_equals(1, cache.stats()['size'])
+
+
+def test_keydata_cache_verified():
+    data = read_fixture_file("pubkey-1.asc")
+    cache = KeyDataCache()
+    key = cache.get(data)
+    # The parsed key is not good enough, GnuPG has to import it
+    assert_equals(key, cache.get(data, verified=True))
+    assert_equals(2, cache.misses)
+    cache.get(data)
+    assert_equals(1, cache.imports_saved)
+
+
 @raises(ValueError)
 def test_fingerprint_from_data():
     fingerprint = fingerprint_from_keydata("This is not a key...")
@@ -296,6 +399,12 @@ class TestGetPublicKeyData:
         newkey = openpgpkey_from_data(data)
         assert_equals(fpr, newkey.fingerprint)
 
+    def test_get_minimal_public_key_data(self):
+        fpr = self.originalkey.fingerprint
+        data = get_public_key_data(fpr, homedir=self.homedir, minimal=True)
+        assert_true(data.startswith(b"-----BEGIN PGP PUBLIC KEY BLOCK-----"))
+        assert_equals(self.originalkey, openpgpkey_from_data(data))
+
     @raises(ValueError)
     def test_no_match(self):
         data = get_public_key_data("nothing should match this",
@@ -343,6 +452,42 @@ class TestGetUsableKeys:
         assert_equals(fpr, self.originalkey.fingerprint)
 
 
+    def test_get_usable_key_patterns(self):
+        fpr = self.originalkey.fingerprint
+        for pattern in (fpr[-8:], "0x" + fpr[-16:].lower(),
+                        "<joe@example.com>", "Joe Random", "andom hac",
+                        # Substrings of a word and words in any order
+                        "jo", "hacker joe"):
+            keys = get_usable_keys(pattern, homedir=self.homedir)
+            assert_equals([self.originalkey], keys)
+        assert_equals([], get_usable_keys("nobody", homedir=self.homedir))
+
+
+    def test_iter_usable_keys(self):
+        fname = get_fixture_file("pubkey-2-uids.asc")
+        gpgcmd = ["gpg", "--homedir={}".format(self.homedir)]
+        check_call(gpgcmd + ["--import", fname])
+        chunks = list(iter_usable_keys(homedir=self.homedir, chunksize=1))
+        assert_equals(2, len(chunks))
+        assert_in([self.originalkey], chunks)
+        # The snapshot is fresh now, and is used for the next stream
+        assert_equals([sum(chunks, [])],
+                      list(iter_usable_keys(homedir=self.homedir)))
+
+
+    def test_keyring_snapshot_change(self):
+        snapshot = KeyringSnapshot(homedir=self.homedir)
+        assert_equals(1, len(snapshot.find()))
+        assert_equals(1, len(snapshot.find()))
+        assert_equals(1, snapshot.builds)
+
+        fname = get_fixture_file("pubkey-2-uids.asc")
+        gpgcmd = ["gpg", "--homedir={}".format(self.homedir)]
+        check_call(gpgcmd + ["--import", fname])
+        assert_equals(2, len(snapshot.find()))
+        assert_equals(2, snapshot.builds)
+
+
 
 class TestGetUsableSecretKeys:
     def setup(self):
@@ -548,6 +693,92 @@ class TestSignAndEncrypt:
 
         assert_greater(len(sigs_after), len(sigs_before))
 
+    @unittest.skipUnless(not crashing_gpgme, "Detected a crashing gpgme")
+    def test_signing_session(self):
+        "A session signs several keys without keeping them around"
+        keydata = read_fixture_file("pubkey-1.asc")
+        other_keydata = read_fixture_file("pubkey-2-uids.asc")
+        with SigningSession(homedir=self.key_receiver_homedir) as session:
+            assert_equals(1, len(session.sign_and_encrypt(keydata)))
+            assert_equals(2, len(session.sign_and_encrypt(other_keydata)))
+            assert_equals(2, session.signed)
+            ctx = session._ctx
+            homedir = ctx.homedir
+            # Only our own key is left in the signing keyring
+            assert_equals(1, len(list(ctx.keylist())))
+        assert_false(os.path.exists(homedir))
+
+    @unittest.skipUnless(not crashing_gpgme, "Detected a crashing gpgme")
+    def test_signing_progress_and_cancel(self):
+        keydata = read_fixture_file("pubkey-2-uids.asc")
+        progress = []
+        def progress_cb(done, total, uid):
+            progress.append((done, total))
+
+        with SigningSession(homedir=self.key_receiver_homedir) as session:
+            session.sign_and_encrypt(keydata, progress_cb=progress_cb)
+            assert_equals([(1, 2), (2, 2)], progress)
+
+            cancel = threading.Event()
+            cancel.set()
+            assert_raises(SigningCancelled, session.sign_and_encrypt,
+                          keydata, cancel=cancel)
+            # The cancelled key must not be left behind
+            assert_equals(1, len(list(session._ctx.keylist())))
+
+            # Cancelling halfway through also purges the key
+            cancel.clear()
+            assert_raises(SigningCancelled, session.sign_and_encrypt, keydata,
+                          progress_cb=lambda *args: cancel.set(), cancel=cancel)
+            assert_equals(1, len(list(session._ctx.keylist())))
+
+    @unittest.skipUnless(not crashing_gpgme, "Detected a crashing gpgme")
+    def test_only_new_certifications(self):
+        "Certifications the key brings along are not sent back"
+        sender = DirectoryContext(homedir=self.key_sender_homedir)
+        sender_key = list(sender.keylist())[0]
+        sink = gpg.Data()
+        sender.op_export_keys([sender_key], 0, sink)
+        sink.seek(0, 0)
+        public_sender_key = sink.read()
+
+        # Someone else has certified the key already
+        third = TempContext()
+        third.op_genkey("""<GnupgKeyParms format="internal">
+            %transient-key
+            Key-Type: RSA
+            Key-Length: 1024
+            Name-Real: Third Party
+            Name-Email: third@example.org
+            %no-protection
+        </GnupgKeyParms>
+        """, None, None)
+        third_keyid = third.op_genkey_result().fpr[-16:]
+        third.op_import(public_sender_key)
+        third.interact(third.get_key(sender_key.fpr),
+                       GenEdit(sign_key(uid=0)).edit_cb, sink=gpg.Data())
+        sink = gpg.Data()
+        third.op_export(sender_key.fpr, 0, sink)
+        sink.seek(0, 0)
+        certified_key = sink.read()
+
+        receiver = DirectoryContext(homedir=self.key_receiver_homedir)
+        receiver_keyid = list(receiver.keylist(secret=True))[0].fpr[-16:]
+        with SigningSession(homedir=self.key_receiver_homedir,
+                            only_new_certifications=True) as session:
+            uid_encrypted = session.sign_and_encrypt(certified_key)
+        assert_equals(len(sender_key.uids), len(uid_encrypted))
+
+        for uid, ciphertext in uid_encrypted:
+            plaintext, _, _ = sender.decrypt(ciphertext)
+            ctx = TempContext()
+            ctx.set_keylist_mode(gpg.constants.KEYLIST_MODE_SIGS)
+            ctx.op_import(plaintext)
+            key = ctx.get_key(sender_key.fpr)
+            keyids = set(sig.keyid for u in key.uids for sig in u.signatures)
+            assert_in(receiver_keyid, keyids)
+            assert_not_in(third_keyid, keyids)
+
 
 class TestLatin1(TestSignAndEncrypt):
     SENDER_KEY = "seckey-latin1.asc"
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#    Copyright 2018 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+
+from keysign.errors import KeyDataRejected
+from keysign.ingest import KeyBuffer, transport_stats
+from keysign.pgppackets import dearmor
+
+log = logging.getLogger(__name__)
+thisdir = os.path.dirname(os.path.realpath(__file__))
+
+
+def read_fixture_file(fixture):
+    fname = os.path.join(thisdir, "fixtures", fixture)
+    data = open(fname, 'rb').read()
+    return data
+
+
+def receive(buf, data, chunksize=100):
+    for i in range(0, len(data), chunksize):
+        buf.write(data[i:i+chunksize])
+    return buf.getvalue()
+
+
+def test_key_buffer():
+    transport_stats.clear()
+    data = read_fixture_file("pubkey-1.asc")
+    assert receive(KeyBuffer('test', expected_size=10), data) == data
+    binary = dearmor(data)
+    assert receive(KeyBuffer('test'), binary) == binary
+    stats = transport_stats.get()['test']
+    assert stats['transfers'] == 2
+    assert stats['bytes'] == len(data) + len(binary)
+
+
+def test_key_buffer_preamble():
+    "Some text may precede the armor"
+    data = read_fixture_file("seckey-utf8.asc")
+    assert receive(KeyBuffer('test'), data, chunksize=10) == data
+
+
+def test_key_buffer_text_preamble():
+    "A byte order mark or non-ASCII text may precede the armor"
+    data = read_fixture_file("pubkey-1.asc")
+    for prefix in (b'\xef\xbb\xbf', u'\xc4nderung:\n'.encode('utf-8')):
+        assert receive(KeyBuffer('test'), prefix + data, chunksize=1) == prefix + data
+
+
+def test_key_buffer_rejects():
+    data = read_fixture_file("pubkey-1.asc")
+    for buf, garbage in [
+            (KeyBuffer('test', max_size=1000), data),
+            # A signature packet rather than a key
+            (KeyBuffer('test'), b'\x88' + data),
+            (KeyBuffer('test', max_size=10000), b'garbage ' * 1000),
+            ]:
+        try:
+            receive(buf, garbage)
+        except KeyDataRejected:
+            pass
+        else:
+            assert False, "Expected %r to be rejected" % garbage[:20]
+
+
+def test_key_buffer_announced_size():
+    try:
+        KeyBuffer('test', max_size=1000, expected_size=1001)
+    except KeyDataRejected:
+        pass
+    else:
+        assert False, "Expected the size to be rejected"
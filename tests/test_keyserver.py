@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#    Copyright 2018 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+from threading import Thread
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+from nose.twistedtools import deferred, reactor
+from nose.tools import *
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.web.error import Error as WebError
+from twisted.web.client import Agent, readBody
+from twisted.web.http_headers import Headers
+
+from keysign.Keyserver import KeyServer, KeyRequestHandlerBase, ThreadedKeyserver
+from keysign.util import format_keys_txt, parse_keys_txt
+from keysign.util import HTTPKeyDownloader
+
+
+log = logging.getLogger(__name__)
+thisdir = os.path.dirname(os.path.realpath(__file__))
+
+
+def get_fixture_file(fixture):
+    fname = os.path.join(thisdir, "fixtures", fixture)
+    return fname
+
+
+def read_fixture_file(fixture):
+    fname = get_fixture_file(fixture)
+    data = open(fname, 'rb').read()
+    return data
+
+
+@deferred(timeout=10)
+@inlineCallbacks
+def test_keyserver():
+    data = read_fixture_file("pubkey-1.asc")
+    fpr = "ADAB7FCC1F4DE2616ECFA402AF82244F9CD9FD55"
+    server = KeyServer(data, fpr, port=19001, publish=False)
+    port = server.start()
+    try:
+        agent = Agent(reactor)
+        url = 'http://127.0.0.1:%d/' % port
+        response = yield agent.request(b'GET', url.encode('ascii'))
+        assert_equal(response.code, 200)
+        assert_equal(response.headers.getRawHeaders(b'Content-Type'),
+                     [b'application/pgp-keys'])
+        body = yield readBody(response)
+        assert_equal(body, data)
+    finally:
+        server.stop()
+
+
+@inlineCallbacks
+def get(url):
+    agent = Agent(reactor)
+    response = yield agent.request(b'GET', url.encode('ascii'))
+    body = yield readBody(response)
+    returnValue((response.code, body))
+
+
+@deferred(timeout=10)
+@inlineCallbacks
+def test_keyserver_many_keys():
+    data1 = read_fixture_file("pubkey-1.asc")
+    fpr1 = "ADAB7FCC1F4DE2616ECFA402AF82244F9CD9FD55"
+    data2 = read_fixture_file("pubkey-2-uids.asc")
+    server = KeyServer(data1, fpr1, port=19011, publish=False)
+    fpr2 = server.add_key(data2)
+    port = server.start()
+    try:
+        url = 'http://127.0.0.1:%d' % port
+        code, body = yield get(url + '/keys/' + fpr2.lower())
+        assert_equal((code, body), (200, data2))
+        code, body = yield get(url + '/')
+        assert_equal(json.loads(body.decode('utf-8')), {'keys': [fpr1, fpr2]})
+
+        server.remove_key(fpr2)
+        code, body = yield get(url + '/keys/' + fpr2)
+        assert_equal(code, 404)
+        code, body = yield get(url + '/')
+        assert_equal((code, body), (200, data1))
+    finally:
+        server.stop()
+
+
+@deferred(timeout=10)
+@inlineCallbacks
+def test_key_downloader():
+    data = read_fixture_file("pubkey-1.asc")
+    fpr = "ADAB7FCC1F4DE2616ECFA402AF82244F9CD9FD55"
+    server = KeyServer(data, fpr, publish=False)
+    port = server.start()
+    downloader = HTTPKeyDownloader(reactor=reactor)
+    try:
+        keydata = yield downloader.download('127.0.0.1', port, fpr)
+        assert_equal(keydata, data)
+        # The connection is reused
+        keydata = yield downloader.download('127.0.0.1', port)
+        assert_equal(keydata, data)
+        try:
+            yield downloader.download('127.0.0.1', port, "F" * 40)
+        except WebError as e:
+            assert_equal(int(e.status), 404)
+        else:
+            assert False, "Expected the unknown key to fail"
+    finally:
+        yield downloader.close()
+        server.stop()
+
+
+@deferred(timeout=10)
+@inlineCallbacks
+def test_keyserver_prepared_responses():
+    data = read_fixture_file("pubkey-1.asc")
+    fpr = "ADAB7FCC1F4DE2616ECFA402AF82244F9CD9FD55"
+    server = KeyServer(data, fpr, publish=False)
+    port = server.start()
+    url = ('http://127.0.0.1:%d/keys/%s' % (port, fpr)).encode('ascii')
+    agent = Agent(reactor)
+
+    @inlineCallbacks
+    def request(method, headers={}):
+        response = yield agent.request(method, url, Headers(
+            dict((k, [v]) for k, v in headers.items())))
+        body = yield readBody(response)
+        etag = response.headers.getRawHeaders(b'ETag', [None])[0]
+        returnValue((response.code, etag, body))
+
+    try:
+        code, etag, body = yield request(b'GET')
+        assert_equal((code, body), (200, data))
+        result = yield request(b'GET', {b'If-None-Match': etag})
+        assert_equal(result[0], 304)
+        result = yield request(b'HEAD')
+        assert_equal(result, (200, etag, b''))
+        result = yield request(b'GET', {b'Range': b'bytes=10-19'})
+        assert_equal(result, (206, etag, data[10:20]))
+        result = yield request(b'GET', {b'Range': b'bytes=99999-'})
+        assert_equal(result[0], 416)
+    finally:
+        server.stop()
+
+
+def test_keys_txt():
+    fprs = ["%040X" % i for i in range(30)]
+    txt = format_keys_txt(fprs)
+    assert_equal(sorted(txt), ['keys0', 'keys1', 'keys2'])
+    for value in txt.values():
+        assert_true(len('keys0=' + value) <= 255)
+    assert_equal(parse_keys_txt(txt), set(fpr[-16:] for fpr in fprs))
+    assert_equal(parse_keys_txt({'fingerprint': fprs[0]}), None)
+
+
+def test_prepared_responses():
+    data = read_fixture_file("pubkey-1.asc")
+    class KeyRequestHandler(KeyRequestHandlerBase):
+        keydata = data
+    httpd = ThreadedKeyserver(('', 0), KeyRequestHandler)
+    t = Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+
+    def request(method, headers={}):
+        c = HTTPConnection('localhost', httpd.socket.getsockname()[1])
+        c.request(method, '/', headers=headers)
+        r = c.getresponse()
+        return r.status, r.getheader('ETag'), r.read()
+
+    try:
+        status, etag, body = request('GET')
+        assert_equal((status, body), (200, data))
+        assert_equal(request('GET', {'If-None-Match': etag}), (304, etag, b''))
+        assert_equal(request('HEAD'), (200, etag, b''))
+        assert_equal(request('GET', {'Range': 'bytes=10-19'}),
+                     (206, etag, data[10:20]))
+        assert_equal(request('GET', {'Range': 'bytes=-5'})[2], data[-5:])
+        assert_equal(request('GET', {'Range': 'bytes=99999-'})[0], 416)
+    finally:
+        httpd.shutdown()
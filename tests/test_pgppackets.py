@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#    Copyright 2018 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""The packet handling does not need GnuPG, so we check it on
+the plain fixtures."""
+
+import logging
+import os
+
+from keysign.pgppackets import dearmor, iter_packets, parse_key
+from keysign.pgppackets import split_keys, split_uids
+from keysign.pgppackets import TAG_PUBLIC_KEY, TAG_UID, TAG_PUBLIC_SUBKEY
+
+log = logging.getLogger(__name__)
+thisdir = os.path.dirname(os.path.realpath(__file__))
+
+
+def get_fixture_file(fixture):
+    fname = os.path.join(thisdir, "fixtures", fixture)
+    return fname
+
+def read_fixture_file(fixture):
+    fname = get_fixture_file(fixture)
+    data = open(fname, 'rb').read()
+    return data
+
+
+def tags(data):
+    return [p.tag for p in iter_packets(data)]
+
+
+def uid_packets(data):
+    return [bytes(p.body(data)) for p in iter_packets(data)
+            if p.tag == TAG_UID]
+
+
+def test_dearmor_binary():
+    "Binary data must be passed through"
+    data = dearmor(read_fixture_file("pubkey-1.asc"))
+    assert dearmor(data) == data
+
+
+def test_dearmor_checksum():
+    data = read_fixture_file("pubkey-1.asc")
+    lines = data.splitlines()
+    # The line before the END line carries the checksum
+    lines[-2] = b"=AAAA"
+    try:
+        dearmor(b"\n".join(lines))
+    except ValueError:
+        pass
+    else:
+        assert False, "Expected the broken checksum to be detected"
+
+
+def test_packets():
+    data = dearmor(read_fixture_file("pubkey-1.asc"))
+    assert tags(data) == [6, 13, 2, 14, 2, 2]
+
+
+def test_split_single_uid():
+    data = read_fixture_file("pubkey-1.asc")
+    uids = split_uids(data)
+    assert len(uids) == 1
+    # Nothing to remove from a key with only one UID
+    assert uids[0] == dearmor(data)
+
+
+def test_split_double_uid():
+    data = read_fixture_file("pubkey-2-uids.asc")
+    uid1, uid2 = split_uids(data)
+    assert uid_packets(uid1) == [b"Test Key <test@test.test>"]
+    assert uid_packets(uid2) == [b"Another Test <second@uid>"]
+    for uid in (uid1, uid2):
+        # The primary key, the UID and its signature, the subkey and its binding
+        assert tags(uid) == [TAG_PUBLIC_KEY, TAG_UID, 2, TAG_PUBLIC_SUBKEY, 2]
+
+
+def test_split_alpha_uids():
+    "A UID's signatures must travel with the UID"
+    data = read_fixture_file("alpha.asc")
+    uids = split_uids(data)
+    assert len(uids) == 3
+    for uid in uids:
+        assert tags(uid) == [6, 13, 2, 2, 2, 2, 14, 2]
+
+
+def test_split_new_certifications():
+    "Only self-signatures and the wanted certifications are kept"
+    data = read_fixture_file("alpha.asc")
+    # alpha.asc has been certified by a key with this key ID
+    signer = "0" * 24 + "1C3419BF1BF98D6D"
+    uids = split_uids(data, certified_by=[signer])
+    for uid in uids:
+        assert tags(uid) == [6, 13, 2, 2]
+    # The certification on the first UID is a second older
+    uids = split_uids(data, certified_by=[signer], since=1480616557)
+    assert [tags(uid) for uid in uids] == [
+        [6, 13, 2], [6, 13, 2, 2], [6, 13, 2, 2]]
+    assert split_uids(data, certified_by=[])[0] == uids[0]
+
+def test_split_two_keys():
+    data = dearmor(read_fixture_file("pubkey-1.asc"))
+    try:
+        split_uids(data + data)
+    except ValueError:
+        pass
+    else:
+        assert False, "Expected two keys to be rejected"
+
+
+def test_split_garbage():
+    try:
+        split_uids(b"This is not a key...")
+    except ValueError:
+        pass
+    else:
+        assert False, "Expected garbage to be rejected"
+
+
+def test_split_keys():
+    "Armored keys can simply be concatenated"
+    key1 = read_fixture_file("pubkey-1.asc")
+    key2 = read_fixture_file("pubkey-2-uids.asc")
+    keys = split_keys(key1 + b"\n" + key2)
+    assert keys == [dearmor(key1), dearmor(key2)]
+    assert split_keys(dearmor(key1) + dearmor(key2)) == keys
+
+
+def test_parse_key():
+    key = parse_key(read_fixture_file("pubkey-1.asc"))
+    assert key.fingerprint == "ADAB7FCC1F4DE2616ECFA402AF82244F9CD9FD55"
+    assert key.expiry is None
+    uid, = key.uidslist
+    assert uid.name == "Joe Random Hacker"
+    assert uid.email == "joe@example.com"
+
+
+def test_parse_secret_key():
+    "The fingerprint is computed over the public part of a secret key"
+    key = parse_key(read_fixture_file("seckey-no-pw-1.asc"))
+    public_key = parse_key(read_fixture_file("pubkey-2-uids.asc"))
+    assert key == public_key
+
+
+def test_parse_key_preceding_text():
+    "Some fixtures have a listing in front of the armor"
+    key = parse_key(read_fixture_file("seckey-utf8.asc"))
+    assert key.fingerprint == "A297884664E12AB20F00DFC0A7109A46E21E1C46"
+    assert key.uidslist[0].name == "Test With \u00dcml\u00e4\u00fct\u00df"
+
+
+def test_parse_key_uid_without_email():
+    key = parse_key(read_fixture_file("alpha.asc"))
+    assert [u.email for u in key.uidslist] == [
+        "alfa@example.net", "alpha@example.net", ""]
+    assert key.uidslist[2].name == "Alice"
+
+
+def test_parse_garbage():
+    try:
+        parse_key(b"This is not a key...")
+    except ValueError:
+        pass
+    else:
+        assert False, "Expected garbage to be rejected"
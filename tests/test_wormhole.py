@@ -29,7 +29,6 @@ from twisted.internet.defer import inlineCallbacks
 from keysign.gpgmh import openpgpkey_from_data
 from keysign.wormholeoffer import WormholeOffer
 from keysign.wormholereceive import WormholeReceive
-from keysign.gpgmh import get_public_key_data
 
 
 log = logging.getLogger(__name__)
@@ -58,10 +57,10 @@ def read_fixture_file(fixture):
 def test_wrmhl():
     data = read_fixture_file("seckey-no-pw-1.asc")
     key = openpgpkey_from_data(data)
-    file_key_data = get_public_key_data(key.fingerprint)
     log.info("Running with key %r", key)
     # Start offering the key
     offer = WormholeOffer(key)
+    file_key_data = offer.payload.keydata
     info = yield offer.allocate_code()
     code, _ = info
     offer.start()
@@ -78,11 +77,11 @@ def test_wrmhl():
 def test_wrmhl_offline_code():
     data = read_fixture_file("seckey-no-pw-1.asc")
     key = openpgpkey_from_data(data)
-    file_key_data = get_public_key_data(key.fingerprint)
     # We assume that this channel, at execution time, is free
     code = "5556-penguin-paw-print"
     # Start offering the key
     offer = WormholeOffer(key)
+    file_key_data = offer.payload.keydata
     offer.allocate_code(code)
     offer.start()
     # Start receiving the key